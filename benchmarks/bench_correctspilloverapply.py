@@ -0,0 +1,130 @@
+"""Benchmark the NNLS compensation of CorrectSpilloverApply
+
+Compensates a synthetic IMC stack with the batched NNLS solver and with
+the per pixel scipy.optimize.nnls reference and prints the run times, the
+speedup, the largest difference between the compensated pixels and the
+largest excess of the squared residuals over the reference.
+
+The stack has Poisson counts of disk shaped objects, every object
+expresses a random subset of the channels. The spillover matrix has a
+unit diagonal and spills 0.2% to 4% into the neighbouring masses and into
+the oxide mass +16, as typical for IMC.
+
+    python -m benchmarks.bench_correctspilloverapply --size 1000 --channels 50
+
+The batched solver runs in 1 to --workers threads of the executor of the
+module, as in a pipeline run, and the benchmark fails unless the fastest
+run with up to as many threads as CPUs is --min-speedup times faster than
+a single thread, see check_scaling. With --tile-rows it compensates the
+image in tiles of that many rows. With --method
+ApproximateNonNegativeLeastSquares the approximate solver is timed and its
+relative residual gap bound is printed.
+
+The reference is slow, it is timed on a sample of the pixels and scaled
+to the whole image.
+"""
+
+import argparse
+import time
+
+import numpy
+import scipy.optimize
+
+# CellProfiler loads the settings the plugin uses before the plugins
+import cellprofiler_core.setting.do_something  # noqa: F401
+import plugins.correctspilloverapply as csa
+from benchmarks.bench_measurements import available_cpus, check_scaling, make_stack
+
+
+def make_spillover_matrix(channels, seed=0):
+    """A (channels, channels) spillover matrix with IMC like spillover"""
+    rng = numpy.random.default_rng(seed)
+    sm = numpy.eye(channels)
+    for channel in range(channels):
+        for target in (channel - 1, channel + 1, channel + 16):
+            if 0 <= target < channels:
+                sm[channel, target] = rng.uniform(0.002, 0.04)
+    return sm
+
+
+def nnls_reference(dat, sm):
+    """The compensation by a scipy.optimize.nnls call per pixel"""
+    return numpy.apply_along_axis(lambda x: scipy.optimize.nnls(sm.T, x)[0], 1, dat)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--size", type=int, default=500)
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--objects", type=int, default=2000)
+    parser.add_argument("--reference-pixels", type=int, default=20000)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=max(2, available_cpus()))
+    parser.add_argument("--min-speedup", type=float, default=1.2)
+    parser.add_argument("--tile-rows", type=int)
+    parser.add_argument(
+        "--method",
+        default=csa.METHOD_NNLS,
+        choices=[csa.METHOD_NNLS, csa.METHOD_APPROXIMATE_NNLS],
+    )
+    args = parser.parse_args()
+
+    rng = numpy.random.default_rng(0)
+    _, pixels = make_stack(args.size, args.channels, args.objects)
+    sm = make_spillover_matrix(args.channels)
+    # Spill the counts and draw the measured counts
+    dat = rng.poisson(pixels.reshape(-1, args.channels) @ sm).astype(float)
+    img = dat.reshape(pixels.shape)
+    print(f"{args.size} x {args.size} pixels, {args.channels} channels")
+
+    module = csa.CorrectSpilloverApply()
+    reference_comp = None
+    best_times = {}
+    for workers in range(1, args.workers + 1):
+        module.images[0].workers.value = workers
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            comp = csa.CorrectSpilloverApply.compensate_image_ls(
+                img,
+                sm,
+                args.method,
+                executor=module.get_executor(),
+                tile_rows=args.tile_rows,
+            )
+            times.append(time.perf_counter() - start)
+        if reference_comp is None:
+            reference_comp = comp
+        # The chunks are solved alike whatever the number of threads
+        assert numpy.array_equal(comp, reference_comp)
+        best_times[workers] = min(times)
+        print(
+            f"batched NNLS:   {min(times):10.3f} s ({workers} threads,"
+            f" speedup {best_times[1] / min(times):5.2f})"
+        )
+    module.post_run(None)
+    comp = comp.reshape(-1, args.channels)
+
+    sample = rng.choice(len(dat), min(args.reference_pixels, len(dat)), replace=False)
+    start = time.perf_counter()
+    reference = nnls_reference(dat[sample], sm)
+    reference_time = (time.perf_counter() - start) * len(dat) / len(sample)
+
+    if args.method == csa.METHOD_APPROXIMATE_NNLS:
+        gaps, residuals = csa.residual_gaps(dat, comp, sm)
+        print(f"relative gap:   {gaps.sum() / residuals.sum():10.3g}")
+    print(f"scipy per pixel:{reference_time:10.3f} s (estimated)")
+    print(f"speedup:        {reference_time / min(best_times.values()):10.1f}")
+    print(f"max difference: {numpy.abs(comp[sample] - reference).max():10.3g}")
+    # Positive if the batched solutions fit worse than the reference
+    excess = numpy.sum((comp[sample] @ sm - dat[sample]) ** 2, axis=1) - numpy.sum(
+        (reference @ sm - dat[sample]) ** 2, axis=1
+    )
+    print(f"max excess of the squared residuals: {excess.max():10.3g}")
+    check_scaling(best_times, args.min_speedup)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""Benchmark the measurement modules on synthetic IMC workloads
+
+Times MeasureObjectIntensityMultichannel.run and
+MeasureImageIntensityMultichannel.run on synthetic IMC-like stacks and
+records the run times and the peak memory of every case in a JSON results
+file. A results file of another version can be given to compare against.
+
+The stacks have Poisson distributed counts. The objects are disks around
+random seeds, every object expresses a random subset of the channels and
+the background has a low count rate.
+
+    python -m benchmarks.bench_measurements --cases small,medium
+    python -m benchmarks.bench_measurements --output new.json --compare old.json
+
+The cases range from 500 x 500 pixels with 10 channels and 1000 objects to
+4000 x 4000 pixels with 60 channels and 50000 objects. The largest case
+needs about 8 GB for the float64 stack alone.
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+
+import numpy
+import scipy
+import scipy.ndimage
+
+import cellprofiler_core.image
+import cellprofiler_core.measurement
+import cellprofiler_core.object
+import cellprofiler_core.pipeline
+import cellprofiler_core.preferences
+import cellprofiler_core.workspace
+
+cellprofiler_core.preferences.set_headless()
+
+import plugins.measureimageintensitymultichannel as mimc  # noqa: E402
+import plugins.measureobjectintensitymultichannel as momc  # noqa: E402
+
+IMAGE_NAME = "Stack"
+OBJECT_NAME = "Cells"
+
+CASES = {
+    "small": dict(size=500, channels=10, objects=1000),
+    "medium": dict(size=1000, channels=40, objects=5000),
+    "large": dict(size=2000, channels=60, objects=20000),
+    "xlarge": dict(size=4000, channels=60, objects=50000),
+}
+
+
+def make_stack(size, channels, objects, seed=0):
+    """A synthetic IMC stack with Poisson counts
+
+    size - the width and height of the image
+    channels - the number of channels
+    objects - the number of objects
+    seed - the seed of the random generator
+
+    returns the (size, size) labels and the (size, size, channels) counts
+    """
+    rng = numpy.random.default_rng(seed)
+    seeds = numpy.ones((size, size), bool)
+    positions = rng.choice(size * size, objects, replace=False)
+    seeds.flat[positions] = False
+    distances, indices = scipy.ndimage.distance_transform_edt(
+        seeds, return_indices=True
+    )
+    seed_labels = numpy.zeros((size, size), int)
+    seed_labels.flat[positions] = numpy.arange(1, objects + 1)
+    labels = seed_labels[tuple(indices)]
+    # Disks covering about half of the image, split between close seeds
+    radius = numpy.sqrt(0.6 * size * size / objects / numpy.pi)
+    labels[distances > radius] = 0
+
+    # Every object expresses about a third of the channels
+    expression = rng.gamma(0.5, 10.0, size=(labels.max() + 1, channels))
+    expression[rng.uniform(size=expression.shape) > 1.0 / 3.0] = 0
+    expression[0] = 0.1
+    pixels = numpy.empty((size, size, channels))
+    for channel in range(channels):
+        pixels[:, :, channel] = rng.poisson(expression[labels, channel])
+    return labels, pixels
+
+
+def available_cpus():
+    """The number of CPUs this process can run on"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def check_scaling(best_times, min_speedup=1.2):
+    """Check that more worker threads are faster than a single one
+
+    best_times - a dictionary of the number of workers to the best run time
+    min_speedup - the speedup over a single worker that the fastest run
+                  with up to as many workers as CPUs must reach
+
+    The check is skipped, with a message, if the process can only run on
+    one CPU, where the threads cannot be faster.
+    """
+    cpus = available_cpus()
+    parallel = {
+        workers: best_time
+        for workers, best_time in best_times.items()
+        if 1 < workers <= cpus
+    }
+    if len(parallel) == 0:
+        print(f"{cpus} CPU available, the thread scaling is not checked")
+        return
+    workers = min(parallel, key=parallel.get)
+    speedup = best_times[1] / parallel[workers]
+    assert speedup >= min_speedup, (
+        f"{workers} threads are only {speedup:.2f} times faster than 1 thread,"
+        f" expected at least {min_speedup}"
+    )
+    print(f"best speedup {speedup:.2f} with {workers} threads on {cpus} CPUs")
+
+
+def make_workspace(module, labels, pixels):
+    image = cellprofiler_core.image.Image(pixels)
+    objects = cellprofiler_core.object.Objects()
+    objects.segmented = labels
+    objects.parent_image = image
+    image_set_list = cellprofiler_core.image.ImageSetList()
+    image_set = image_set_list.get_image_set(0)
+    image_set.add(IMAGE_NAME, image)
+    object_set = cellprofiler_core.object.ObjectSet()
+    object_set.add_objects(objects, OBJECT_NAME)
+    return cellprofiler_core.workspace.Workspace(
+        cellprofiler_core.pipeline.Pipeline(),
+        module,
+        image_set,
+        object_set,
+        cellprofiler_core.measurement.Measurements(),
+        image_set_list,
+    )
+
+
+def make_object_module(channels, workers):
+    module = momc.MeasureObjectIntensityMultichannel()
+    module.images_list.value = IMAGE_NAME
+    module.objects_list.value = OBJECT_NAME
+    module.nchannels.value = channels
+    module.workers.value = workers
+    return module
+
+
+def make_image_module(channels, workers):
+    module = mimc.MeasureImageIntensityMultiChannel()
+    module.images_list.value = IMAGE_NAME
+    module.wants_objects.value = True
+    module.objects_list.value = OBJECT_NAME
+    module.nchannels.value = channels
+    return module
+
+
+MODULES = {
+    "MeasureObjectIntensityMultichannel": make_object_module,
+    "MeasureImageIntensityMultichannel": make_image_module,
+}
+
+
+def run_module(module, labels, pixels):
+    """Run a module on a fresh workspace, returns the run time"""
+    workspace = make_workspace(module, labels, pixels)
+    start = time.perf_counter()
+    module.run(workspace)
+    elapsed = time.perf_counter() - start
+    # Drop caches such as the label indices between the runs
+    module.post_run(workspace)
+    return elapsed
+
+
+def benchmark(case, labels, pixels, module_name, repeats, workers):
+    """Time a module on a stack and measure its peak memory
+
+    The peak memory is traced in a separate run, as tracing slows down
+    the allocations.
+    """
+    channels = pixels.shape[-1]
+    module = MODULES[module_name](channels, workers)
+    times = [run_module(module, labels, pixels) for _ in range(repeats)]
+    tracemalloc.start()
+    run_module(module, labels, pixels)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "case": case,
+        "module": module_name,
+        "size": pixels.shape[0],
+        "channels": channels,
+        "objects": int(labels.max()),
+        "workers": workers,
+        "times": times,
+        "best_time": min(times),
+        "peak_memory": peak,
+    }
+
+
+def get_revision():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, previous):
+    """Print the ratios of the times and peak memory to previous results"""
+    previous = {(r["case"], r["module"]): r for r in previous["results"]}
+    print(f"{'case':8s} {'module':36s} {'time':>8s} {'memory':>8s}")
+    for result in results:
+        before = previous.get((result["case"], result["module"]))
+        if before is None:
+            continue
+        print(
+            f"{result['case']:8s} {result['module']:36s}"
+            f" {result['best_time'] / before['best_time']:8.2f}"
+            f" {result['peak_memory'] / before['peak_memory']:8.2f}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--cases",
+        default="small,medium",
+        help=f"comma separated cases out of {', '.join(CASES)}",
+    )
+    parser.add_argument(
+        "--modules",
+        default=",".join(MODULES),
+        help="comma separated modules to benchmark",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="a results file to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for case in args.cases.split(","):
+        labels, pixels = make_stack(**CASES[case])
+        for module_name in args.modules.split(","):
+            result = benchmark(
+                case, labels, pixels, module_name, args.repeats, args.workers
+            )
+            results.append(result)
+            print(
+                f"{case:8s} {module_name:36s} {result['best_time']:8.3f} s"
+                f" {result['peak_memory'] / 2 ** 20:10.1f} MiB"
+            )
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": datetime.datetime.now().isoformat(),
+                "revision": get_revision(),
+                "python": platform.python_version(),
+                "numpy": numpy.__version__,
+                "scipy": scipy.__version__,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""Benchmark the thread scaling of MeasureObjectIntensityMultichannel
+
+Measures a synthetic 50 channel image with 10000 objects with 1 to N
+worker threads and prints the run time and the speedup per thread count.
+N defaults to the number of available CPUs, at least 2. The benchmark
+fails if no thread count up to the number of CPUs is at least
+--min-speedup times faster than a single thread, see check_scaling.
+
+    python -m benchmarks.bench_measureobjectintensitymultichannel --threads 8
+"""
+
+import argparse
+import time
+
+import numpy
+
+import plugins.measureobjectintensitymultichannel as momc
+from benchmarks.bench_measurements import available_cpus, check_scaling
+
+
+def make_image(nchannels=50, grid=100, size=10, seed=0):
+    """A grid x grid checkerboard of size x size objects with random pixels"""
+    rng = numpy.random.default_rng(seed)
+    shape = (grid * size, grid * size)
+    y, x = numpy.mgrid[: shape[0], : shape[1]]
+    labels = (y // size) * grid + x // size + 1
+    # Leave a background gap between the objects
+    labels[(y % size == 0) | (x % size == 0)] = 0
+    pixels = rng.gamma(2.0, size=shape + (nchannels,))
+    return labels, pixels
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=max(2, available_cpus()))
+    parser.add_argument("--channels", type=int, default=50)
+    parser.add_argument("--grid", type=int, default=100)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--min-speedup", type=float, default=1.2)
+    args = parser.parse_args()
+
+    labels, pixels = make_image(args.channels, args.grid)
+    label_index = momc.LabelIndex(
+        labels.reshape(1, *labels.shape), numpy.arange(1, labels.max() + 1)
+    )
+    pixels = pixels.reshape(1, *pixels.shape)
+    print(f"{labels.max()} objects, {pixels.shape[-1]} channels")
+
+    reference = None
+    best_times = {}
+    for workers in range(1, args.threads + 1):
+        times = []
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            result = momc.measure_channel_blocks(
+                pixels, label_index, 2, workers=workers
+            )
+            times.append(time.perf_counter() - start)
+        if reference is None:
+            reference = result
+        best_times[workers] = min(times)
+        assert all(
+            numpy.array_equal(result[f], reference[f], equal_nan=True)
+            for f in reference
+        )
+        print(
+            f"{workers:3d} threads: {min(times):8.3f} s,"
+            f" speedup {best_times[1] / min(times):5.2f}"
+        )
+    check_scaling(best_times, args.min_speedup)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,7 +10,7 @@ def tests(session):
     session.run("poetry", "run", "pytest", "--cov")
 
 
-locations = "plugins", "noxfile.py", "tests"
+locations = "plugins", "noxfile.py", "tests", "benchmarks"
 
 
 @nox.session(python=["3.8"])
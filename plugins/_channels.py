@@ -0,0 +1,47 @@
+"""Channel selection of the multichannel measurement modules
+
+This is not a CellProfiler module: CellProfiler does not load plugin files
+starting with an underscore, but the plugins import it from the plugin
+directory.
+"""
+
+
+def parse_channel_numbers(text):
+    """Parse comma separated 1 based channel numbers and ranges
+
+    text - e.g. "1-10, 12"
+
+    returns the sorted channel numbers
+    """
+    channel_numbers = set()
+    for part in text.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        if "-" in part:
+            start, stop = part.split("-", 1)
+            channel_numbers.update(range(int(start), int(stop) + 1))
+        else:
+            channel_numbers.add(int(part))
+    return sorted(channel_numbers)
+
+
+def get_channel_numbers_by_name(text, annotation_path):
+    """Look up comma separated channel names in a channel annotation file
+
+    text - e.g. "Ir191, Ir193"
+    annotation_path - a txt file without header with a channel name per line
+
+    returns the sorted 1 based channel numbers
+    """
+    with open(annotation_path, "r") as f:
+        annotations = [name.strip() for name in f.read().split("\n")]
+    channel_numbers = set()
+    for name in text.split(","):
+        name = name.strip()
+        if name == "":
+            continue
+        if name not in annotations:
+            raise ValueError(f"Channel {name} is not in {annotation_path}")
+        channel_numbers.add(annotations.index(name) + 1)
+    return sorted(channel_numbers)
@@ -0,0 +1,26 @@
+"""Precision choices of the plugins that can compute in single precision
+
+Like the other plugin files starting with an underscore, CellProfiler does
+not load this file as a module.
+"""
+
+import numpy
+
+PRECISION_IMAGE = "Same as the image"
+PRECISION_FLOAT64 = "float64"
+PRECISION_FLOAT32 = "float32"
+ALL_PRECISIONS = [PRECISION_IMAGE, PRECISION_FLOAT64, PRECISION_FLOAT32]
+
+
+def get_dtype(precision, dtype):
+    """Get the dtype to compute in
+
+    precision - one of ALL_PRECISIONS
+    dtype - the dtype of the image
+
+    returns the dtype of the image, promoted to at least single precision
+    floats, for PRECISION_IMAGE and the chosen dtype otherwise
+    """
+    if precision == PRECISION_IMAGE:
+        return numpy.promote_types(dtype, numpy.float32)
+    return numpy.dtype(precision)
@@ -0,0 +1,215 @@
+"""Spillover compensation shared by CorrectSpilloverApply and
+CorrectSpilloverMeasurements
+
+This is not a CellProfiler module: CellProfiler does not load plugin files
+starting with an underscore, but the plugins import it from the plugin
+directory.
+"""
+
+import hashlib
+import threading
+
+import numpy as np
+import scipy.optimize as spo
+
+METHOD_LS = "LeastSquares"
+METHOD_NNLS = "NonNegativeLeastSquares"
+METHOD_APPROXIMATE_NNLS = "ApproximateNonNegativeLeastSquares"
+# Coordinate descent sweeps of the approximate NNLS method
+APPROXIMATE_NNLS_SWEEPS = 3
+
+C_SPILLOVER = "Spillover"
+F_RESIDUAL_GAP = "Spillover_ResidualGap_%s"
+F_RELATIVE_RESIDUAL_GAP = "Spillover_RelativeResidualGap_%s"
+F_MAX_RESIDUAL_GAP = "Spillover_MaxResidualGap_%s"
+ALL_GAP_MEASUREMENTS = ["ResidualGap", "RelativeResidualGap", "MaxResidualGap"]
+
+
+def dot_blocks(dat, mat, out=None, block_size=4096):
+    """
+    The product of the (n, c) pixels dat and the matrix mat in blocks
+    BLAS libraries select their kernels by the shape of the product, which
+    changes the rounding. Every block is therefore multiplied in the shape
+    (block_size, c), the last block is padded with zeros. The product of a
+    pixel does then not depend on how the pixels are split into chunks or
+    tiles.
+    """
+    dtype = np.result_type(dat, mat)
+    if out is None or out.dtype != dtype:
+        compdat = np.empty((len(dat), mat.shape[1]), dtype)
+    else:
+        compdat = out
+    for start in range(0, len(dat), block_size):
+        block = dat[start : start + block_size]
+        if len(block) == block_size:
+            np.dot(block, mat, out=compdat[start : start + block_size])
+        else:
+            padded = np.zeros((block_size, dat.shape[1]), dat.dtype)
+            padded[: len(block)] = block
+            compdat[start:] = np.dot(padded, mat)[: len(block)]
+    return compdat
+
+
+def factorize(sm, method):
+    """
+    Precompute the solution of the spillover matrix sm for the method
+    Returns a dictionary with the pseudo-inverse "pinv" of sm, the least
+    squares solution of comp * sm = dat is dat * pinv. For NNLS also the
+    normal matrix "ata" = sm * sm.T and per channel with a nonzero diagonal
+    the channel, the channels it overlaps with in ata and their row of ata
+    as "channels".
+    """
+    factorization = {"pinv": np.linalg.pinv(sm)}
+    if method == METHOD_NNLS:
+        ata = np.dot(sm, sm.T)
+        channels = []
+        for j in np.flatnonzero(np.diag(ata) > 0):
+            # Only the overlapping channels enter the gradient of a channel
+            rows = np.flatnonzero(ata[j])
+            if len(rows) == len(ata):
+                rows = slice(None)
+            channels.append((j, rows, ata[j, rows]))
+        factorization.update(ata=ata, channels=channels)
+    return factorization
+
+
+class FactorizationCache:
+    """The factorizations of the spillover matrices used in this process
+
+    Usually the same spillover matrix is applied to all image sets of an
+    experiment. Its factorization is computed once and cached by a digest
+    of the matrix and the method. The least recently used factorizations
+    are dropped beyond max_entries matrices.
+    """
+
+    def __init__(self, max_entries=8):
+        self.max_entries = max_entries
+        self.entries = {}
+        # The worker threads compensate chunks with the same matrix
+        self.lock = threading.Lock()
+
+    def get(self, sm, method):
+        """Get the factorization of sm for the method, see factorize"""
+        sm = np.ascontiguousarray(sm)
+        key = (hashlib.md5(sm).hexdigest(), sm.shape, sm.dtype.str, method)
+        with self.lock:
+            factorization = self.entries.pop(key, None)
+            if factorization is None:
+                factorization = factorize(sm, method)
+            self.entries[key] = factorization
+            while len(self.entries) > self.max_entries:
+                del self.entries[next(iter(self.entries))]
+        return factorization
+
+    def clear(self):
+        self.entries = {}
+
+
+factorization_cache = FactorizationCache()
+
+
+def compensate_nnls(
+    dat, sm, block_size=4096, tol=1e-10, max_sweeps=200, exact=True, out=None
+):
+    """
+    Solve the non negative least squares problems of all pixels at once:
+        comp * sm = dat, comp >= 0
+    dat - the (n, c) pixels
+    sm - the (c, c) spillover matrix
+
+    The pixels are solved in blocks of block_size pixels. Pixels whose
+    least squares solution is non negative are solved by it. The others
+    are solved by projected coordinate descent on the normal equations,
+    which is vectorized over the pixels of a block and converges fast for
+    the diagonally dominant spillover matrices. The descent stops when no
+    pixel changes by more than tol times its largest intensity in a sweep
+    of all channels. Pixels that then violate the optimality (KKT)
+    conditions by more than 1000 tol times their largest gradient are
+    solved by scipy.optimize.nnls, unless exact is False.
+    The problems are solved in double precision, the solutions are written
+    into out if given.
+    """
+    dat = np.asarray(dat, dtype=np.float64)
+    sm = np.asarray(sm, dtype=np.float64)
+    factorization = factorization_cache.get(sm, METHOD_NNLS)
+    pinv = factorization["pinv"]
+    if out is None:
+        compdat = np.empty((len(dat), sm.shape[0]))
+    else:
+        compdat = out
+    for start in range(0, len(dat), block_size):
+        block = dat[start : start + block_size]
+        comp = np.dot(block, pinv)
+        negative = np.flatnonzero((comp < 0).any(axis=1))
+        if len(negative) > 0:
+            comp[negative] = _descend_nnls(
+                block[negative],
+                sm,
+                factorization,
+                comp[negative],
+                tol,
+                max_sweeps,
+                exact,
+            )
+        compdat[start : start + block_size] = comp
+    return compdat
+
+
+def _descend_nnls(dat, sm, factorization, comp, tol, max_sweeps, exact=True):
+    """Projected coordinate descent from the clipped solutions comp"""
+    ata = factorization["ata"]
+    channels = factorization["channels"]
+    comp = np.ascontiguousarray(np.maximum(comp.T, 0))
+    atb = np.dot(sm, dat.T)
+    diagonal = np.diag(ata)
+    tolerance = tol * np.abs(dat).max(axis=1)
+    change = np.empty(len(dat))
+    for _ in range(max_sweeps):
+        change[:] = 0
+        for j, rows, row in channels:
+            update = atb[j] - np.dot(row, comp[rows])
+            update /= diagonal[j]
+            update += comp[j]
+            np.maximum(update, 0, out=update)
+            delta = update - comp[j]
+            comp[j] = update
+            np.abs(delta, out=delta)
+            np.maximum(change, delta, out=change)
+        if np.all(change <= tolerance):
+            break
+    if not exact:
+        return comp.T
+    # Solve the pixels that do not satisfy the KKT conditions with scipy
+    grad = atb - np.dot(ata, comp)
+    violation = np.where(comp > 0, np.abs(grad), np.maximum(grad, 0)).max(axis=0)
+    for i in np.flatnonzero(violation > 1000 * tol * np.abs(atb).max(axis=0)):
+        comp[:, i] = spo.nnls(sm.T, dat[i])[0]
+    return comp.T
+
+
+def residual_gaps(dat, compdat, sm, block_size=4096):
+    """
+    Bound how much the compensation compdat of the (n, c) pixels dat fits
+    worse than the exact NNLS solution
+    Returns per pixel an upper bound of the excess of its squared residual
+    over the one of the exact NNLS solution and its squared residual.
+    The bound is the duality gap of the NNLS problem: for the residual
+    r = comp * sm - dat and the positive part g of its gradient r * sm.T,
+    u = g * inv(sm).T is dual feasible and the squared residual of every
+    non negative solution is at least -u * (u + 2 dat). The gap is zero
+    for the exact solution. It requires an invertible spillover matrix.
+    """
+    sm = np.asarray(sm, dtype=np.float64)
+    pinv = factorization_cache.get(sm, METHOD_LS)["pinv"]
+    gaps = np.empty(len(dat))
+    residuals = np.empty(len(dat))
+    for start in range(0, len(dat), block_size):
+        block = np.asarray(dat[start : start + block_size], dtype=np.float64)
+        comp = np.asarray(compdat[start : start + block_size], dtype=np.float64)
+        r = np.dot(comp, sm) - block
+        u = np.dot(np.maximum(np.dot(r, sm.T), 0), pinv.T)
+        residual = np.einsum("ij,ij->i", r, r)
+        lower = -np.einsum("ij,ij->i", u, u + 2 * block)
+        residuals[start : start + block_size] = residual
+        gaps[start : start + block_size] = np.maximum(residual - lower, 0)
+    return gaps, residuals
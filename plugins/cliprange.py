@@ -6,6 +6,8 @@
 #
 #################################
 
+import functools
+
 import numpy as np
 
 #################################
@@ -17,6 +19,23 @@ import numpy as np
 import cellprofiler_core.image
 import cellprofiler_core.module
 import cellprofiler_core.setting
+import cellprofiler_core.setting.choice
+
+try:
+    from ._precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
+except ImportError:
+    # CellProfiler imports the plugins as top level modules
+    from _precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
 
 __doc__ = """\
 ClipRange
@@ -52,7 +71,10 @@ TODO: potentially record the percentile value that was used for truncating. Howe
 
 Technical notes
 ^^^^^^^^^^^^^^^
-Nothing fancy done here.
+For images of counts, such as IMC ion counts, the percentiles of all
+channels are found exactly in histograms of the counts instead of by
+sorting. The counts are recognized automatically from the pixel values and
+the scale of the image.
 
 References
 ^^^^^^^^^^
@@ -66,6 +88,8 @@ References
 # if someone wants to change the text, that text will change everywhere.
 # Also, you can't misspell it by accident.
 #
+# The precision choices are shared with other plugins, see _precision.py.
+#
 
 #
 # The module class.
@@ -101,7 +125,7 @@ class ClipRange(cellprofiler_core.module.ImageProcessing):
     #
     module_name = "ClipRange"
 
-    variable_revision_number = 1
+    variable_revision_number = 2
 
     category = ["ImcPluginsCP", "Image Processing"]
     #
@@ -150,6 +174,17 @@ that is made available by a prior module.
 """,
         )
 
+        self.precision = cellprofiler_core.setting.choice.Choice(
+            "Precision of the output image",
+            ALL_PRECISIONS,
+            PRECISION_IMAGE,
+            doc=f"""\
+With *{PRECISION_IMAGE}* the image is clipped in its own precision.
+Select *{PRECISION_FLOAT32}* to clip a single precision copy of the image,
+which halves the memory of the output image and of the temporaries.
+""",
+        )
+
     #
     # The "settings" method tells CellProfiler about the settings you
     # have in your module. CellProfiler uses the list for saving
@@ -164,7 +199,7 @@ that is made available by a prior module.
         settings = super(ClipRange, self).settings()
 
         # Append additional settings here.
-        return settings + [self.outlier_percentile]
+        return settings + [self.outlier_percentile, self.precision]
 
     #
     # "visible_settings" tells CellProfiler which settings should be
@@ -182,7 +217,7 @@ that is made available by a prior module.
         visible_settings = super(ClipRange, self).visible_settings()
 
         # Configure the visibility of additional settings below.
-        visible_settings += [self.outlier_percentile]
+        visible_settings += [self.outlier_percentile, self.precision]
 
         #
         # Show the user the scale only if self.wants_smoothing is checked
@@ -191,6 +226,9 @@ that is made available by a prior module.
         return visible_settings
 
     def upgrade_settings(self, setting_values, variable_revision_number, module_name):
+        if variable_revision_number == 1:
+            setting_values = setting_values + [PRECISION_IMAGE]
+            variable_revision_number = 2
         return setting_values, variable_revision_number
 
     #
@@ -209,7 +247,12 @@ that is made available by a prior module.
         # the module settings as they are returned from "settings" (excluding
         # "self.y_data", or the output image).
         #
-        self.function = clip_percentile
+        # Images of counts are clipped with exact percentiles from their
+        # histograms, images without a scale are taken as they are
+        scale = workspace.image_set.get_image(self.x_name.value).scale
+        self.function = functools.partial(
+            clip_percentile, scale=1 if scale is None else scale
+        )
 
         super(ClipRange, self).run(workspace)
 
@@ -260,7 +303,12 @@ that is made available by a prior module.
 #
 # This function must return the output image data (as a numpy array).
 #
-def clip_percentile(pixels, outlier_percentile):
+def clip_percentile(pixels, outlier_percentile, precision=PRECISION_IMAGE, scale=None):
+    pixels = pixels.astype(get_dtype(precision, pixels.dtype), copy=False)
+    if scale is not None:
+        tresholds = _count_percentiles(pixels, outlier_percentile, scale)
+        if tresholds is not None:
+            return np.minimum(pixels, tresholds)
     if len(pixels.shape) == 3:
         output_pixels = pixels.copy()
         for channel in range(pixels.shape[2]):
@@ -275,3 +323,61 @@ def clip_percentile(pixels, outlier_percentile):
 def _clip_percentile_plane(img, percentile):
     tresh = np.percentile(img[:], percentile * 100, interpolation="nearest")
     return np.clip(img, a_min=None, a_max=tresh)
+
+
+def _count_percentiles(pixels, percentile, scale, block_size=2**16):
+    """The percentiles of the channels of an image of counts
+
+    pixels - a single or multichannel image whose pixels are counts divided
+             by the scale
+    percentile - the percentile between 0 and 1
+    scale - the scale of the image, e.g. 65535 for 16 bit images
+    block_size - the number of pixels counted at once
+
+    The pixels are taken as counts if they are exactly the pixel values of
+    their nearest counts. The percentiles are then found in the histograms
+    of the counts of all channels, which are counted in one pass over the
+    image. They are the same as numpy.percentile with nearest
+    interpolation.
+
+    returns the percentile of each channel, or None if the pixels are not
+    counts or there are more than 1/16 as many counts as pixels
+    """
+    nchannels = pixels.shape[2] if pixels.ndim == 3 else 1
+    pixels = pixels.reshape(-1, nchannels)
+    npixels = len(pixels)
+    if npixels == 0:
+        return None
+    maximum = pixels.max()
+    # NaN and inf are no counts either
+    if not (pixels.min() >= 0 and maximum * scale < npixels // 16):
+        return None
+    nbins = int(maximum * scale + 0.5) + 1
+    count_values = np.arange(nbins, dtype=pixels.dtype)
+    count_values /= pixels.dtype.type(scale)
+    offsets = np.arange(0, nchannels * nbins, nbins)
+    histograms = np.zeros(nchannels * nbins, np.intp)
+    # Check a sample of the pixels first to give up quickly on other images
+    sample = pixels[:: max(1, npixels // 1024)]
+    if not np.array_equal(count_values[_get_counts(sample, scale)], sample):
+        return None
+    for start in range(0, npixels, block_size):
+        block = pixels[start : start + block_size]
+        counts = _get_counts(block, scale)
+        if not np.array_equal(count_values[counts], block):
+            return None
+        counts += offsets
+        histograms += np.bincount(counts.ravel(), minlength=nchannels * nbins)
+    cumulative = np.cumsum(histograms.reshape(nchannels, nbins), axis=1)
+    # The rank of numpy.percentile's nearest interpolation
+    rank = int(np.around((npixels - 1) * np.true_divide(percentile * 100, 100)))
+    return count_values[np.argmax(cumulative > rank, axis=1)]
+
+
+def _get_counts(pixels, scale):
+    """The nearest counts of pixels that are counts divided by the scale"""
+    if scale == 1:
+        return pixels.astype(np.intp)
+    counts = pixels * scale
+    counts += 0.5
+    return counts.astype(np.intp)
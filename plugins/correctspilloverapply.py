@@ -21,28 +21,78 @@ Module: *CorrectSpilloverMeasurements*.
 
 """
 
+import concurrent.futures
+
 import numpy as np
-import scipy.optimize as spo
 
 import cellprofiler_core.image as cpi
 import cellprofiler_core.module as cpm
 import cellprofiler_core.setting as cps
+from cellprofiler_core.constants.measurement import COLTYPE_FLOAT
+
+try:
+    from ._precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_FLOAT64,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
+    from ._spillover import (
+        ALL_GAP_MEASUREMENTS,
+        APPROXIMATE_NNLS_SWEEPS,
+        C_SPILLOVER,
+        F_MAX_RESIDUAL_GAP,
+        F_RELATIVE_RESIDUAL_GAP,
+        F_RESIDUAL_GAP,
+        METHOD_APPROXIMATE_NNLS,
+        METHOD_LS,
+        METHOD_NNLS,
+        compensate_nnls,
+        dot_blocks,
+        factorization_cache,
+        residual_gaps,
+    )
+except ImportError:
+    # CellProfiler imports the plugins as top level modules
+    from _precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_FLOAT64,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
+    from _spillover import (
+        ALL_GAP_MEASUREMENTS,
+        APPROXIMATE_NNLS_SWEEPS,
+        C_SPILLOVER,
+        F_MAX_RESIDUAL_GAP,
+        F_RELATIVE_RESIDUAL_GAP,
+        F_RESIDUAL_GAP,
+        METHOD_APPROXIMATE_NNLS,
+        METHOD_LS,
+        METHOD_NNLS,
+        compensate_nnls,
+        dot_blocks,
+        factorization_cache,
+        residual_gaps,
+    )
 
 NONE = "None"
 
-SETTINGS_PER_IMAGE = 4
-METHOD_LS = "LeastSquares"
-METHOD_NNLS = "NonNegativeLeastSquares"
+SETTINGS_PER_IMAGE = 9
 
 
 class CorrectSpilloverApply(cpm.Module):
     category = ["ImcPluginsCP", "Image Processing"]
-    variable_revision_number = 1
+    variable_revision_number = 5
     module_name = "CorrectSpilloverApply"
 
     def create_settings(self):
         """Make settings here (and set the module name)"""
         self.images = []
+        self.executor = None
+        self.executor_workers = None
         self.add_image(can_delete=False)
         self.add_image_button = cps.do_something.DoSomething(
             "", "Add another image", self.add_image
@@ -76,7 +126,7 @@ class CorrectSpilloverApply(cpm.Module):
         )
         spill_correct_method = cps.choice.Choice(
             "Spillover correction method",
-            [METHOD_NNLS, METHOD_LS],
+            [METHOD_NNLS, METHOD_LS, METHOD_APPROXIMATE_NNLS],
             doc="""
             Select the spillover correction method.
             <ul>
@@ -87,10 +137,83 @@ class CorrectSpilloverApply(cpm.Module):
             solution: The most accurate solution, according to the least
             squares criterium, without any negative values.
             </li>
+            <li><i>%(METHOD_APPROXIMATE_NNLS)s:</i> Approximates the non
+            negative least squares solution by %(APPROXIMATE_NNLS_SWEEPS)d
+            sweeps of coordinate descent from the clipped least squares
+            solution, e.g. for fast screening runs. The solution has no
+            negative values, but fits the pixels less well than the exact
+            solution. An upper bound of how much the squared residuals
+            exceed those of the exact solution is measured per image as
+            <i>%(C_SPILLOVER)s_ResidualGap</i>, relative to the squared
+            residuals as <i>%(C_SPILLOVER)s_RelativeResidualGap</i> and for
+            the worst pixel as <i>%(C_SPILLOVER)s_MaxResidualGap</i>.
+            </li>
             </ul>
             """
             % globals(),
         )
+        precision = cps.choice.Choice(
+            "Precision of the corrected image",
+            ALL_PRECISIONS,
+            PRECISION_IMAGE,
+            doc=f"""
+            With <i>{PRECISION_IMAGE}</i> the image is corrected in its own
+            precision, which is single precision for images loaded by
+            CellProfiler. Select <i>{PRECISION_FLOAT64}</i> to correct the
+            image in double precision, or <i>{PRECISION_FLOAT32}</i> to
+            correct it in single precision, e.g. to save memory with large
+            images and many channels.
+            """,
+        )
+        unique_pixels = cps.Binary(
+            "Compensate repeated pixels once?",
+            False,
+            doc="""
+            Select <i>Yes</i> to compensate every distinct pixel only once
+            and copy the result to its repetitions. IMC images often consist
+            mostly of background pixels without counts and of low count
+            pixels that repeat, which then do not need to be solved again.
+            The corrected image is the same up to rounding errors.
+            """,
+        )
+
+        workers = cps.text.Integer(
+            "Number of worker threads",
+            1,
+            minval=1,
+            doc="""
+            The pixels are split into chunks that are compensated in this
+            many parallel threads. The numerical work is done in NumPy and
+            SciPy, which release the GIL, such that several cores are used.
+            The threads are started once per analysis run and share the
+            image and the factorization of the spillover matrix. The
+            corrected image does not depend on the number of threads.
+            """,
+        )
+
+        wants_tiles = cps.Binary(
+            "Compensate the image in tiles?",
+            False,
+            doc="""
+            Select <i>Yes</i> to compensate the image in tiles of rows that
+            are written into the corrected image one by one. Only a tile of
+            the image is converted to the selected precision and compensated
+            at a time, which saves memory with large images and many
+            channels. The tiles are compensated in the worker threads. The
+            corrected image is the same as without tiles.
+            """,
+        )
+
+        tile_rows = cps.text.Integer(
+            "Tile height",
+            256,
+            minval=1,
+            doc="""
+            <i>(Used only if compensating in tiles)</i>
+
+            The number of image rows per tile.
+            """,
+        )
 
         image_settings = cps.SettingsGroup()
         image_settings.append("image_name", image_name)
@@ -99,6 +222,11 @@ class CorrectSpilloverApply(cpm.Module):
             "spill_correct_function_image_name", spill_correct_function_image_name
         )
         image_settings.append("spill_correct_method", spill_correct_method)
+        image_settings.append("precision", precision)
+        image_settings.append("unique_pixels", unique_pixels)
+        image_settings.append("workers", workers)
+        image_settings.append("wants_tiles", wants_tiles)
+        image_settings.append("tile_rows", tile_rows)
 
         if can_delete:
             image_settings.append(
@@ -125,6 +253,11 @@ class CorrectSpilloverApply(cpm.Module):
                 image.corrected_image_name,
                 image.spill_correct_function_image_name,
                 image.spill_correct_method,
+                image.precision,
+                image.unique_pixels,
+                image.workers,
+                image.wants_tiles,
+                image.tile_rows,
             ]
         return result
 
@@ -137,7 +270,13 @@ class CorrectSpilloverApply(cpm.Module):
                 image.corrected_image_name,
                 image.spill_correct_function_image_name,
                 image.spill_correct_method,
+                image.precision,
+                image.unique_pixels,
+                image.workers,
+                image.wants_tiles,
             ]
+            if image.wants_tiles:
+                result.append(image.tile_rows)
             #
             # Get the "remover" button if there is one
             #
@@ -167,6 +306,34 @@ class CorrectSpilloverApply(cpm.Module):
         while len(self.images) < image_count:
             self.add_image()
 
+    def prepare_run(self, workspace):
+        """Start the worker threads for the run"""
+        self.get_executor()
+        return True
+
+    def post_run(self, workspace):
+        """Stop the worker threads of the run"""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+            self.executor_workers = None
+
+    def get_executor(self):
+        """Get the thread pool of the run, None for a single thread
+
+        The pool is started in prepare_run. Worker processes of an analysis
+        do not run prepare_run, they start the pool with the first image set.
+        """
+        workers = max(image.workers.value for image in self.images)
+        if workers <= 1:
+            return None
+        if self.executor is None or self.executor_workers != workers:
+            if self.executor is not None:
+                self.executor.shutdown()
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            self.executor_workers = workers
+        return self.executor
+
     def run(self, workspace):
         """Run the module
 
@@ -197,8 +364,32 @@ class CorrectSpilloverApply(cpm.Module):
         #
         method = image.spill_correct_method.value
         output_pixels = self.compensate_image_ls(
-            orig_image.pixel_data, spillover_mat.pixel_data, method
+            orig_image.pixel_data,
+            spillover_mat.pixel_data,
+            method,
+            image.precision.value,
+            image.unique_pixels.value,
+            self.get_executor() if image.workers.value > 1 else None,
+            image.tile_rows.value if image.wants_tiles else None,
         )
+        if method == METHOD_APPROXIMATE_NNLS:
+            c = output_pixels.shape[-1]
+            gaps, residuals = residual_gaps(
+                np.reshape(orig_image.pixel_data, (-1, c)),
+                np.reshape(output_pixels, (-1, c)),
+                spillover_mat.pixel_data,
+            )
+            residual_gap = np.sum(gaps)
+            residual = np.sum(residuals)
+            m = workspace.measurements
+            m.add_image_measurement(F_RESIDUAL_GAP % corrected_image_name, residual_gap)
+            m.add_image_measurement(
+                F_RELATIVE_RESIDUAL_GAP % corrected_image_name,
+                residual_gap / residual if residual > 0 else 0.0,
+            )
+            m.add_image_measurement(
+                F_MAX_RESIDUAL_GAP % corrected_image_name, np.max(gaps, initial=0)
+            )
         # Save the output image in the image set and have it inherit
         # mask & cropping from the original image.
         #
@@ -217,26 +408,100 @@ class CorrectSpilloverApply(cpm.Module):
                 ] = spillover_mat.pixel_data
 
     @staticmethod
-    def compensate_image_ls(img, sm, method):
+    def compensate_image_ls(
+        img,
+        sm,
+        method,
+        precision=PRECISION_IMAGE,
+        unique=False,
+        executor=None,
+        tile_rows=None,
+    ):
         """
         Compensate an img with dimensions (x, y, c) with a spillover matrix
         with dimensions (c, c) by first reshaping the matrix to the shape dat=(x*y,
         c) and the solving the linear system:
             comp * sm = dat -> comp = dat * inv(sm)
+        The image is compensated in the given precision, by default in the
+        precision of the image. NNLS always solves in double precision.
+        If unique is True, every distinct pixel is compensated once and
+        pixels without counts are not solved at all.
+        If an executor is given, chunks of pixels are compensated in its
+        threads.
+        If tile_rows is given, the image is compensated in tiles of this
+        many rows that are written into the output image, such that only a
+        tile is converted and solved at a time. The tiles are compensated
+        in the threads of the executor. The LS result is the same as
+        without tiles.
         """
+        dtype = get_dtype(precision, img.dtype)
+        sm = sm.astype(dtype, copy=False)
         x, y, c = img.shape
-        dat = np.ravel(img, order="C")
-        dat = np.reshape(dat, (x * y, c), order="C")
-        if method == METHOD_LS:
-            compdat = np.linalg.lstsq(sm.T, dat.T, rcond=None)[0]
-            compdat = compdat.T
-        if method == METHOD_NNLS:
-            nnls = lambda x: spo.nnls(sm.T, x)[0]
-            compdat = np.apply_along_axis(nnls, 1, dat)
-        compdat = compdat.ravel(order="C")
-        comp_img = np.reshape(compdat, (x, y, c), order="C")
+        if tile_rows is None:
+            img = img.astype(dtype, copy=False)
+            dat = np.ravel(img, order="C")
+            dat = np.reshape(dat, (x * y, c), order="C")
+            compdat = compensate_pixels(dat, sm, method, unique, executor)
+            compdat = compdat.astype(dtype, copy=False).ravel(order="C")
+            comp_img = np.reshape(compdat, (x, y, c), order="C")
+            return comp_img
+        comp_img = np.empty((x, y, c), dtype)
+
+        def compensate_tile(start):
+            tile = img[start : start + tile_rows].astype(dtype, copy=False)
+            compensate_pixels(
+                np.reshape(tile, (-1, c), order="C"),
+                sm,
+                method,
+                unique,
+                out=np.reshape(comp_img[start : start + tile_rows], (-1, c)),
+            )
+
+        tiles = range(0, x, tile_rows)
+        if executor is None:
+            for start in tiles:
+                compensate_tile(start)
+        else:
+            # Propagate the exceptions of the threads
+            for _ in executor.map(compensate_tile, tiles):
+                pass
         return comp_img
 
+    def get_gap_image_names(self):
+        """The corrected images with residual gap measurements"""
+        return [
+            image.corrected_image_name.value
+            for image in self.images
+            if image.spill_correct_method.value == METHOD_APPROXIMATE_NNLS
+        ]
+
+    def get_measurement_columns(self, pipeline):
+        """Return column definitions for measurements made by this module"""
+        columns = []
+        for image_name in self.get_gap_image_names():
+            for feature in (
+                F_RESIDUAL_GAP,
+                F_RELATIVE_RESIDUAL_GAP,
+                F_MAX_RESIDUAL_GAP,
+            ):
+                columns.append(("Image", feature % image_name, COLTYPE_FLOAT))
+        return columns
+
+    def get_categories(self, pipeline, object_name):
+        if object_name == "Image" and len(self.get_gap_image_names()) > 0:
+            return [C_SPILLOVER]
+        return []
+
+    def get_measurements(self, pipeline, object_name, category):
+        if category in self.get_categories(pipeline, object_name):
+            return ALL_GAP_MEASUREMENTS
+        return []
+
+    def get_measurement_images(self, pipeline, object_name, category, measurement):
+        if measurement in self.get_measurements(pipeline, object_name, category):
+            return self.get_gap_image_names()
+        return []
+
     def display(self, workspace, figure):
         """ Display one row of orig / illum / output per image setting group"""
         figure.set_subplots((3, len(self.images)))
@@ -301,4 +566,137 @@ class CorrectSpilloverApply(cpm.Module):
                 for i in range(n_images)
             ][0]
             variable_revision_number = +1
+        if variable_revision_number == 1:
+            n_settings_old = 4
+            setting_values = sum(
+                [
+                    setting_values[i : i + n_settings_old] + [PRECISION_IMAGE]
+                    for i in range(0, len(setting_values), n_settings_old)
+                ],
+                [],
+            )
+            variable_revision_number = 2
+        if variable_revision_number == 2:
+            n_settings_old = 5
+            setting_values = sum(
+                [
+                    setting_values[i : i + n_settings_old] + ["No"]
+                    for i in range(0, len(setting_values), n_settings_old)
+                ],
+                [],
+            )
+            variable_revision_number = 3
+        if variable_revision_number == 3:
+            n_settings_old = 6
+            setting_values = sum(
+                [
+                    setting_values[i : i + n_settings_old] + ["1"]
+                    for i in range(0, len(setting_values), n_settings_old)
+                ],
+                [],
+            )
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            n_settings_old = 7
+            setting_values = sum(
+                [
+                    setting_values[i : i + n_settings_old] + ["No", "256"]
+                    for i in range(0, len(setting_values), n_settings_old)
+                ],
+                [],
+            )
+            variable_revision_number = 5
         return setting_values, variable_revision_number
+
+
+def compensate_pixels(dat, sm, method, unique=False, executor=None, out=None):
+    """
+    Compensate the (n, c) pixels dat, see compensate_image_ls
+    Returns the compensated pixels, or writes them into out if given.
+    """
+    if not unique:
+        return compensate_chunks(dat, sm, method, executor, out)
+    index, inverse = unique_pixels(dat)
+    dat = dat[index]
+    compdat = np.zeros(dat.shape, sm.dtype)
+    nonzero = np.flatnonzero(dat.any(axis=1))
+    if len(nonzero) > 0:
+        compdat[nonzero] = compensate_chunks(dat[nonzero], sm, method, executor)
+    return np.take(compdat, inverse, axis=0, out=out)
+
+
+def compensate_chunks(dat, sm, method, executor=None, out=None, chunk_size=2**16):
+    """
+    Compensate the (n, c) pixels dat in chunks of chunk_size pixels
+    The chunks are compensated in the threads of the executor and written
+    into one output array, out if given. The threads share the pixels and
+    the cached factorization, nothing is copied to them. chunk_size is a
+    multiple of the NNLS block size, so the result is the same as without
+    an executor.
+    """
+    if executor is None or len(dat) <= chunk_size:
+        return compensate_dat(dat, sm, method, out)
+    if out is not None:
+        compdat = out
+    elif method in (METHOD_NNLS, METHOD_APPROXIMATE_NNLS):
+        compdat = np.empty((len(dat), sm.shape[0]), np.float64)
+    else:
+        compdat = np.empty((len(dat), sm.shape[0]), np.result_type(dat, sm))
+
+    def compensate_chunk(start):
+        chunk = slice(start, start + chunk_size)
+        compensate_dat(dat[chunk], sm, method, compdat[chunk])
+
+    # Propagate the exceptions of the threads
+    for _ in executor.map(compensate_chunk, range(0, len(dat), chunk_size)):
+        pass
+    return compdat
+
+
+def compensate_dat(dat, sm, method, out=None):
+    """
+    Compensate the (n, c) pixels dat with the spillover matrix sm
+    Returns the compensated pixels, or writes them into out if given.
+    """
+    if method == METHOD_LS:
+        compdat = dot_blocks(dat, factorization_cache.get(sm, method)["pinv"], out)
+    if method == METHOD_NNLS:
+        compdat = compensate_nnls(dat, sm, out=out)
+    if method == METHOD_APPROXIMATE_NNLS:
+        compdat = compensate_nnls(
+            dat, sm, max_sweeps=APPROXIMATE_NNLS_SWEEPS, exact=False, out=out
+        )
+    if out is not None and compdat is not out:
+        out[...] = compdat
+    return compdat if out is None else out
+
+
+def unique_pixels(dat, block_size=4096):
+    """
+    Find the distinct pixels of the (n, c) pixels dat
+    Returns the indices of one pixel per distinct pixel and the index of
+    the distinct pixel of every pixel.
+    The pixels are hashed and grouped by their hashes, which is much
+    faster than sorting the pixels. Pixels that differ from the first
+    pixel of their group, i.e. hash collisions, form their own groups.
+    """
+    n, c = dat.shape
+    bits = np.ascontiguousarray(dat).view("u%d" % dat.dtype.itemsize)
+    multipliers = np.random.default_rng(0).integers(1, 2**63, c, dtype=np.uint64)
+    multipliers |= np.uint64(1)
+    hashes = np.empty(n, np.uint64)
+    for start in range(0, n, block_size):
+        block = bits[start : start + block_size].astype(np.uint64)
+        # Mix the high bits into the low bits before multiplying
+        block ^= block >> np.uint64(32)
+        hashes[start : start + block_size] = np.dot(block, multipliers)
+    _, index, inverse, counts = np.unique(
+        hashes, return_index=True, return_inverse=True, return_counts=True
+    )
+    inverse = inverse.ravel()
+    # Only pixels of groups with more than one pixel can collide
+    repeated = np.flatnonzero(counts[inverse] > 1)
+    collisions = repeated[(dat[index[inverse[repeated]]] != dat[repeated]).any(axis=1)]
+    inverse[collisions] = len(index) + np.arange(len(collisions))
+    index = np.concatenate([index, collisions])
+    return index, inverse
@@ -31,10 +31,40 @@ import cellprofiler_core.measurement as cpmeas
 
 from cellprofiler_core.constants.measurement import COLTYPE_FLOAT
 
+try:
+    from ._spillover import (
+        ALL_GAP_MEASUREMENTS,
+        APPROXIMATE_NNLS_SWEEPS,
+        C_SPILLOVER,
+        F_MAX_RESIDUAL_GAP,
+        F_RELATIVE_RESIDUAL_GAP,
+        F_RESIDUAL_GAP,
+        METHOD_APPROXIMATE_NNLS,
+        METHOD_LS,
+        METHOD_NNLS,
+        compensate_nnls,
+        factorization_cache,
+        residual_gaps,
+    )
+except ImportError:
+    # CellProfiler imports the plugins as top level modules
+    from _spillover import (
+        ALL_GAP_MEASUREMENTS,
+        APPROXIMATE_NNLS_SWEEPS,
+        C_SPILLOVER,
+        F_MAX_RESIDUAL_GAP,
+        F_RELATIVE_RESIDUAL_GAP,
+        F_RESIDUAL_GAP,
+        METHOD_APPROXIMATE_NNLS,
+        METHOD_LS,
+        METHOD_NNLS,
+        compensate_nnls,
+        factorization_cache,
+        residual_gaps,
+    )
+
 
 SETTINGS_PER_IMAGE = 5
-METHOD_LS = "LeastSquares"
-METHOD_NNLS = "NonNegativeLeastSquares"
 
 
 class PatchedMeasurementSetting(cps.Measurement):
@@ -91,7 +121,7 @@ class CorrectSpilloverMeasurements(cpm.Module):
         )
         spill_correct_method = cps.choice.Choice(
             "Spillover correction method",
-            [METHOD_NNLS, METHOD_LS],
+            [METHOD_NNLS, METHOD_LS, METHOD_APPROXIMATE_NNLS],
             doc="""
             Select the spillover correction method.
             <ul>
@@ -102,6 +132,16 @@ class CorrectSpilloverMeasurements(cpm.Module):
             solution: The most accurate solution, according to the least
             squares criterium, without any negative values.
             </li>
+            <li><i>%(METHOD_APPROXIMATE_NNLS)s:</i> Approximates the non
+            negative least squares solution by %(APPROXIMATE_NNLS_SWEEPS)d
+            sweeps of coordinate descent from the clipped least squares
+            solution, e.g. for fast screening runs. An upper bound of how
+            much the squared residuals of the objects exceed those of the
+            exact solution is measured per image as
+            <i>%(C_SPILLOVER)s_ResidualGap</i>, relative to the squared
+            residuals as <i>%(C_SPILLOVER)s_RelativeResidualGap</i> and for
+            the worst object as <i>%(C_SPILLOVER)s_MaxResidualGap</i>.
+            </li>
             </ul>
             """
             % globals(),
@@ -229,15 +269,38 @@ class CorrectSpilloverMeasurements(cpm.Module):
         return outcol
 
 
+    def _get_gap_name(self, cm):
+        """The name of the residual gap measurements of a compmeasurement"""
+        outcol = self._generate_outcolname(
+            cm.compmeasurement_name.value, cm.corrected_compmeasurement_suffix.value
+        )
+        return f"{cm.object_name.value}_{outcol}"
+
+    def _get_gap_names(self):
+        return [
+            self._get_gap_name(cm)
+            for cm in self.compmeasurements
+            if cm.spill_correct_method.value == METHOD_APPROXIMATE_NNLS
+        ]
+
     def get_measurement_columns(self, pipeline):
         """Return column definitions for compmeasurements made by this module"""
         columns = []
         for cm in self.compmeasurements:
             nchan = self._get_nchannels_measurement(cm, pipeline)
             columns += self._get_compmeasurement_output_columns(nchan, cm)
+        for gap_name in self._get_gap_names():
+            for feature in (
+                F_RESIDUAL_GAP,
+                F_RELATIVE_RESIDUAL_GAP,
+                F_MAX_RESIDUAL_GAP,
+            ):
+                columns.append(("Image", feature % gap_name, COLTYPE_FLOAT))
         return columns
 
     def get_categories(self, pipeline, object_name):
+        if object_name == "Image" and len(self._get_gap_names()) > 0:
+            return [C_SPILLOVER]
         for cm in self.compmeasurements:
             if object_name == self._get_obj(cm, pipeline):
                 return ["Intensity"]
@@ -252,6 +315,8 @@ class CorrectSpilloverMeasurements(cpm.Module):
         return outmeas
 
     def get_measurements(self, pipeline, object_name, category):
+        if object_name == "Image" and category == C_SPILLOVER:
+            return ALL_GAP_MEASUREMENTS if len(self._get_gap_names()) > 0 else []
         results = []
         for cm in self.compmeasurements:
             if (object_name == self._get_obj(cm, pipeline)) and (
@@ -261,6 +326,8 @@ class CorrectSpilloverMeasurements(cpm.Module):
         return results
 
     def get_measurement_images(self, pipeline, object_name, category, measurement):
+        if measurement in self.get_measurements(pipeline, object_name, C_SPILLOVER):
+            return self._get_gap_names()
         results = []
         for cm in self.compmeasurements:
             if (
@@ -338,6 +405,20 @@ class CorrectSpilloverMeasurements(cpm.Module):
         for i in range(sm_nchannels_output):
             corr_meas = compdat.T[i]
             measurements.add_measurement(object_name, out_names[i][1], corr_meas)
+        if method == METHOD_APPROXIMATE_NNLS:
+            fil = np.all(np.isfinite(data), 1)
+            gaps, residuals = residual_gaps(data[fil], compdat[fil], sm)
+            residual_gap = np.sum(gaps)
+            residual = np.sum(residuals)
+            gap_name = self._get_gap_name(compmeasurement)
+            measurements.add_image_measurement(F_RESIDUAL_GAP % gap_name, residual_gap)
+            measurements.add_image_measurement(
+                F_RELATIVE_RESIDUAL_GAP % gap_name,
+                residual_gap / residual if residual > 0 else 0.0,
+            )
+            measurements.add_image_measurement(
+                F_MAX_RESIDUAL_GAP % gap_name, np.max(gaps, initial=0)
+            )
 
     def compensate_dat(self, dat, sm, method):
         """
@@ -355,14 +436,15 @@ class CorrectSpilloverMeasurements(cpm.Module):
             compdat[fil, :] = self.compensate_ls(dat[fil, :], sm)
         if method == METHOD_NNLS:
             compdat[fil, :] = self.compensate_nnls(dat[fil, :], sm)
+        if method == METHOD_APPROXIMATE_NNLS:
+            compdat[fil, :] = self.compensate_approximate_nnls(dat[fil, :], sm)
         # columns with any not finite value are set to np.nan
         compdat[~fil, :] = np.nan
         return compdat
 
     @staticmethod
     def compensate_ls(dat, sm):
-        compdat = np.linalg.lstsq(sm.T, dat.T, None)[0]
-        return compdat.T
+        return np.dot(dat, factorization_cache.get(sm, METHOD_LS)["pinv"])
 
     @staticmethod
     def compensate_nnls(dat, sm):
@@ -371,6 +453,16 @@ class CorrectSpilloverMeasurements(cpm.Module):
 
         return np.apply_along_axis(nnls, 1, dat)
 
+    @staticmethod
+    def compensate_approximate_nnls(dat, sm, sweeps=APPROXIMATE_NNLS_SWEEPS):
+        """
+        Approximate the NNLS solution by sweeps of projected coordinate
+        descent on the normal equations from the clipped LS solution
+        This is the approximate NNLS method of CorrectSpilloverApply, only
+        the objects with a negative LS solution are updated.
+        """
+        return compensate_nnls(dat, sm, max_sweeps=sweeps, exact=False)
+
     def display(self, workspace, figure):
         """ Display one row of orig / illum / output per image setting group"""
         pass
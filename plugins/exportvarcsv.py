@@ -437,12 +437,26 @@ def parse_intensity_col(col):
         f"(?P<{CATEGORY}>[a-zA-Z0-9]+)_"
         f"(?P<{FEATURE_NAME}>[a-zA-Z0-9]+(_[XYZ]+)?)"
         f"(_(?P<{IMAGE_NAME}>[a-zA-Z0-9]+))?"
-        f"(_(?P<{PARAMETERS}>[0-9of_]+))?"
+        f"(_(?P<{PARAMETERS}>[0-9of]+(_[0-9of]+)*))?"
         f"(_c(?P<{CHANNEL}>[0-9]+))?"
     )
     return {COLUMN_NAME: col, **re.match(re_exp, col).groupdict()}
 
 
+def parse_correlation_col(col):
+    """
+    Correlations of two channels of the same image have the channel of the
+    first and the parameters the channel of the second channel
+    """
+    re_exp = (
+        f"(?P<{CATEGORY}>[a-zA-Z0-9]+)_"
+        f"(?P<{FEATURE_NAME}>[a-zA-Z0-9]+)"
+        f"_(?P<{IMAGE_NAME}>[a-zA-Z0-9]+)"
+        f"(_c(?P<{CHANNEL}>[0-9]+)_c(?P<{PARAMETERS}>[0-9]+))?"
+    )
+    return {COLUMN_NAME: col, **re.match(re_exp, col).groupdict()}
+
+
 def parse_areashape_col(col):
     re_exp = f"(?P<{CATEGORY}>[a-zA-Z0-9]+)_" f"(?P<{FEATURE_NAME}>.*)"
     return {COLUMN_NAME: col, **re.match(re_exp, col).groupdict()}
@@ -530,6 +544,7 @@ category_parsers = {
         ],
         [("ObjectNumber", "ImageNumber", "Number", "Group", "ImageSet"), parse_id_col],
         [("AreaShape", "Math"), parse_areashape_col],
+        [["Correlation"], parse_correlation_col],
         [["Neighbors"], parse_neighbors_col],
         [["Children", "Parent", "Count"], parse_objectmeta_col],
         [["Distance"], parse_distance_col],
@@ -1,17 +1,31 @@
+import json
 import logging
+import os
 
 import numpy
-from cellprofiler_core.constants.measurement import COLTYPE_FLOAT
+from cellprofiler_core.constants.measurement import (
+    COLTYPE_FLOAT,
+    COLTYPE_LONGBLOB,
+    EXPERIMENT,
+)
 from cellprofiler_core.module import Module
+from cellprofiler_core.preferences import DEFAULT_INPUT_FOLDER_NAME
 from cellprofiler_core.setting import Binary, ValidationError, Divider
+from cellprofiler_core.setting.choice import Choice
 from cellprofiler_core.setting.subscriber import (
     LabelListSubscriber,
     ImageListSubscriber,
 )
-from cellprofiler_core.setting.text import Integer
+from cellprofiler_core.setting.text import Directory, Filename, Float, Integer, Text
 
 from cellprofiler.modules import _help
 
+try:
+    from ._channels import get_channel_numbers_by_name, parse_channel_numbers
+except ImportError:
+    # CellProfiler imports the plugins as top level modules
+    from _channels import get_channel_numbers_by_name, parse_channel_numbers
+
 __doc__ = """
 MeasureImageIntensityMultichannel
 =================================
@@ -21,6 +35,26 @@ entire image over multiple channels (excluding masked pixels).
 
 The name of the measurements will have a suffix `_c[channelnr]` where channelnr is 1 based index of the plane.
 
+Optionally only a subset of the channels is measured, selected by channel
+numbers (e.g. `1-10, 12`) or by channel names from a channel annotation
+file (a txt file without header with a channel name on each line, as used
+by **ExportVarCsv**). The measured channels keep their channel number in
+the measurement names.
+
+For images of counts, such as IMC ion counts, the quartiles, median and
+MAD of channels with mostly nonzero pixels are computed exactly from
+histograms of the counts instead of by selection. The counts are
+recognized automatically from the pixel values and the scale of the image.
+
+Optionally the intensities of every channel are summarized over all image
+sets, e.g. to find dataset wide percentiles for normalization or for the
+thresholds of **ClipRange**. The summary of each image set is stored as an
+image measurement and the summaries of all image sets are merged at the
+end of the run into experiment measurements. Count images are summarized
+exactly, other images by a quantile sketch whose percentiles are within a
+relative accuracy of the exact percentiles, see *Relative accuracy of the
+summary*.
+
 For example, this module will sum all pixel values to measure the total image
 intensity. You can choose to measure all pixels in the image or restrict
 the measurement to pixels within objects that were identified in a prior
@@ -66,6 +100,13 @@ Measurements made by this module
    75% of the pixels in the object have lower values.
 -  *TotalArea:* Number of pixels measured, e.g., the area of the image
    excluding masked regions.
+-  *Summary:* (Optional) The summary of the pixel intensity values as
+   JSON, an image measurement per image set and an experiment measurement
+   merged over all image sets.
+-  *PercentileIntensity:* (Optional) Experiment measurements of the
+   percentiles of the merged summary. The percentile is given by its
+   decimal digits, e.g. `Intensity_PercentileIntensity_image_999_c1` is
+   the 0.999 percentile of channel 1.
 
 """.format(
     **{"HELP_ON_MEASURING_INTENSITIES": _help.HELP_ON_MEASURING_INTENSITIES}
@@ -105,6 +146,20 @@ F_PERCENT_MAXIMAL = "Intensity_PercentMaximal_%s"
 F_UPPER_QUARTILE = "Intensity_UpperQuartileIntensity_%s"
 F_LOWER_QUARTILE = "Intensity_LowerQuartileIntensity_%s"
 
+"""Measurement feature name format for the intensity summary"""
+F_SUMMARY = "Intensity_Summary_%s"
+
+"""Measurement feature name format for the percentiles of the summary"""
+F_PERCENTILE_INTENSITY = "Intensity_PercentileIntensity_%s"
+
+"""The default relative accuracy of the intensity summaries"""
+DEFAULT_SUMMARY_ACCURACY = 0.01
+
+"""Channel selection methods"""
+CHANNELS_ALL = "All"
+CHANNELS_NUMBERS = "Channel numbers"
+CHANNELS_NAMES = "Channel names"
+
 ALL_MEASUREMENTS = [
     "TotalIntensity",
     "MeanIntensity",
@@ -123,7 +178,7 @@ ALL_MEASUREMENTS = [
 class MeasureImageIntensityMultiChannel(Module):
     module_name = "MeasureImageIntensityMultichannel"
     category = ["ImcPluginsCP", "Measurement"]
-    variable_revision_number = 3
+    variable_revision_number = 5
 
     def create_settings(self):
         """Create the settings & name the module"""
@@ -161,6 +216,128 @@ class MeasureImageIntensityMultiChannel(Module):
             """,
         )
 
+        self.channel_choice = Choice(
+            "Select the channels to measure",
+            [CHANNELS_ALL, CHANNELS_NUMBERS, CHANNELS_NAMES],
+            CHANNELS_ALL,
+            doc=f"""
+            Select *{CHANNELS_ALL}* to measure every channel of the images.
+            Select *{CHANNELS_NUMBERS}* to measure only the channels with
+            the given channel numbers.
+            Select *{CHANNELS_NAMES}* to measure only the channels with the
+            given names in a channel annotation file.
+            """,
+        )
+        self.channel_numbers = Text(
+            "Channel numbers",
+            "1",
+            doc="""
+            Enter the 1 based numbers of the channels to measure, separated by
+            commas. Ranges of channels can be given as e.g. `1-10`.
+            """,
+        )
+        self.channel_names = Text(
+            "Channel names",
+            "",
+            doc="""
+            Enter the names of the channels to measure, separated by commas.
+            """,
+        )
+        self.annotation_location = Directory(
+            "Channel annotation file location",
+            Directory.static_join_string(DEFAULT_INPUT_FOLDER_NAME, ""),
+            doc="""
+            Location of a txt file without header that contains on each new
+            line the name of a channel. Must have exactly the same number of
+            rows than the multichannel image has channels.
+            """,
+        )
+        self.annotation_filename = Filename(
+            "Channel annotation file name",
+            "None",
+            browse_msg="Choose txt/csv file",
+            exts=[("Data file (*.csv)", "*.csv"), ("Data file (*.txt)", "*.txt")],
+            doc="Provide the file name of the channel annotation file.",
+            get_directory_fn=self.annotation_location.get_absolute_path,
+            set_directory_fn=lambda path: self.annotation_location.join_parts(
+                *self.annotation_location.get_parts_from_path(path)
+            ),
+        )
+
+        self.wants_summary = Binary(
+            "Summarize the intensities over all image sets?",
+            False,
+            doc="""
+            Select *Yes* to summarize the intensities of every channel over
+            all image sets. The summaries of the image sets are merged at the
+            end of the run into the experiment measurements of the summary
+            and its percentiles.
+
+            The summaries are merged over the image sets of a run. The merged
+            summaries of several runs, e.g. of batches on a cluster, can be
+            merged in turn with *IntensitySummary* of this module.
+            """,
+        )
+        self.summary_percentiles = Text(
+            "Percentiles of the summary",
+            "0.5, 0.99, 0.999",
+            doc="""
+            Enter the percentiles to measure from the merged summaries,
+            separated by commas. The percentiles are between 0 and 1, the
+            pixel at the nearest rank is measured as in **ClipRange**.
+            """,
+        )
+        self.summary_accuracy = Float(
+            "Relative accuracy of the summary",
+            DEFAULT_SUMMARY_ACCURACY,
+            minval=0.0001,
+            maxval=0.5,
+            doc="""
+            Images that are not count images are summarized by a quantile
+            sketch. Every percentile of the sketch differs by at most this
+            fraction of its value from the exact percentile. The size of the
+            sketch grows about with the logarithm of the range of the
+            intensities divided by twice the accuracy. Count images are
+            summarized exactly.
+            """,
+        )
+
+    def get_channels(self):
+        """Get the 0 based indices of the channels to measure"""
+        nchannels = self.nchannels.value
+        if self.channel_choice == CHANNELS_ALL:
+            return list(range(nchannels))
+        if self.channel_choice == CHANNELS_NUMBERS:
+            channel_numbers = parse_channel_numbers(self.channel_numbers.value)
+        else:
+            channel_numbers = get_channel_numbers_by_name(
+                self.channel_names.value,
+                os.path.join(
+                    self.annotation_location.get_absolute_path(),
+                    self.annotation_filename.value,
+                ),
+            )
+        for channel_number in channel_numbers:
+            if not 1 <= channel_number <= nchannels:
+                raise ValueError(
+                    f"Channel {channel_number} is not within the {nchannels} "
+                    "channels of the images"
+                )
+        return [channel_number - 1 for channel_number in channel_numbers]
+
+    def get_column_channels(self):
+        """Get the channels to list measurement columns for
+
+        Channels selected by name are only known once the annotation file
+        exists. Until then the columns of all channels are listed, so that
+        listing the measurements does not fail, and validate_module reports
+        the problem.
+        """
+        try:
+            return self.get_channels()
+        except (OSError, ValueError):
+            return list(range(self.nchannels.value))
+
     def validate_module(self, pipeline):
         """Make sure chosen objects and images are selected only once"""
         images = set()
@@ -182,6 +359,21 @@ class MeasureImageIntensityMultiChannel(Module):
                         "%s has already been selected" % object_name, object_name
                     )
                 objects.add(object_name)
+        if self.channel_choice == CHANNELS_NUMBERS:
+            channel_setting = self.channel_numbers
+        else:
+            channel_setting = self.channel_names
+        try:
+            channels = self.get_channels()
+        except (OSError, ValueError) as e:
+            raise ValidationError(str(e), channel_setting)
+        if len(channels) == 0:
+            raise ValidationError("No channels selected", channel_setting)
+        if self.wants_summary:
+            try:
+                parse_percentiles(self.summary_percentiles.value)
+            except ValueError as e:
+                raise ValidationError(str(e), self.summary_percentiles)
 
     def settings(self):
         result = [
@@ -189,13 +381,33 @@ class MeasureImageIntensityMultiChannel(Module):
             self.wants_objects,
             self.objects_list,
             self.nchannels,
+            self.channel_choice,
+            self.channel_numbers,
+            self.channel_names,
+            self.annotation_location,
+            self.annotation_filename,
+            self.wants_summary,
+            self.summary_percentiles,
+            self.summary_accuracy,
         ]
         return result
 
     def visible_settings(self):
-        result = [self.images_list, self.nchannels, self.wants_objects]
+        result = [self.images_list, self.nchannels, self.channel_choice]
+        if self.channel_choice == CHANNELS_NUMBERS:
+            result += [self.channel_numbers]
+        elif self.channel_choice == CHANNELS_NAMES:
+            result += [
+                self.channel_names,
+                self.annotation_location,
+                self.annotation_filename,
+            ]
+        result += [self.wants_objects]
         if self.wants_objects:
             result += [self.objects_list]
+        result += [self.wants_summary]
+        if self.wants_summary:
+            result += [self.summary_percentiles, self.summary_accuracy]
         return result
 
     def run(self, workspace):
@@ -203,6 +415,7 @@ class MeasureImageIntensityMultiChannel(Module):
         col_labels = ["Image", "Masking object", "Channel", "Feature", "Value"]
         statistics = []
         nchannels = self.nchannels.value
+        channels = self.get_channels()
 
         for im in self.images_list.value:
             image = workspace.image_set.get_image(im, must_be_grayscale=False)
@@ -221,10 +434,12 @@ class MeasureImageIntensityMultiChannel(Module):
                     Did you adapt the number of channels to the actual number of channels?
                     """
                 )
+            # Images without a scale are measured as they are
+            scale = 1 if image.scale is None else image.scale
             measurement_name = im
             if self.wants_objects.value:
+                masks = []
                 for object_set in self.objects_list.value:
-                    measurement_name += "_" + object_set
                     objects = workspace.get_objects(object_set)
                     if objects.shape != input_pixels.shape[:2]:
                         raise ValueError(
@@ -243,20 +458,71 @@ class MeasureImageIntensityMultiChannel(Module):
                         mask = numpy.logical_and(objects.segmented != 0, image.mask)
                     else:
                         mask = objects.segmented != 0
+                    masks.append(mask.ravel())
+                #
+                # Gather the pixels of all object sets once, the pixels of
+                # each object set are selected from them.
+                #
+                union = numpy.logical_or.reduce(masks)
+                indices = numpy.flatnonzero(union)
+                values = gather_channels(input_pixels, indices, channels)
+                for object_set, mask in zip(self.objects_list.value, masks):
+                    measurement_name += "_" + object_set
+                    if len(masks) > 1:
+                        object_values = numpy.compress(mask[indices], values, axis=1)
+                    else:
+                        object_values = values
                     statistics += self.measure(
-                        input_pixels, im, object_set, measurement_name, mask, workspace
+                        object_values,
+                        im,
+                        object_set,
+                        measurement_name,
+                        workspace,
+                        channels,
+                        scale,
                     )
             else:
                 if image.has_mask:
-                    mask = image.mask
+                    indices = numpy.flatnonzero(image.mask)
                 else:
-                    mask = None
+                    indices = None
+                values = gather_channels(input_pixels, indices, channels)
                 statistics += self.measure(
-                    input_pixels, im, None, measurement_name, mask, workspace
+                    values, im, None, measurement_name, workspace, channels, scale
                 )
         workspace.display_data.statistics = statistics
         workspace.display_data.col_labels = col_labels
 
+    def post_run(self, workspace):
+        """Merge the intensity summaries of all image sets
+
+        The summaries are merged here rather than in post_group, as
+        post_run sees the measurements of the image sets of all groups and
+        worker processes of the run.
+        """
+        if not self.wants_summary.value:
+            return
+        m = workspace.measurements
+        image_numbers = m.get_image_numbers()
+        percentiles = parse_percentiles(self.summary_percentiles.value)
+        for measurement_name in self.get_measurement_names():
+            for channel in self.get_channels():
+                feature = F_SUMMARY % f"{measurement_name}_c{channel+1}"
+                summary = IntensitySummary().merge(
+                    *[
+                        IntensitySummary.from_json(text)
+                        for text in m.get_measurement("Image", feature, image_numbers)
+                        if text is not None
+                    ]
+                )
+                m.add_experiment_measurement(feature, summary.to_json())
+                for percentile in percentiles:
+                    m.add_experiment_measurement(
+                        F_PERCENTILE_INTENSITY
+                        % get_percentile_name(measurement_name, percentile, channel),
+                        summary.quantile(percentile),
+                    )
+
     def display(self, workspace, figure):
         figure.set_subplots((1, 1))
         figure.subplot_table(
@@ -267,23 +533,46 @@ class MeasureImageIntensityMultiChannel(Module):
         )
 
     def measure(
-        self, pixels, image_name, object_name, measurement_name, mask, workspace
+        self,
+        values,
+        image_name,
+        object_name,
+        measurement_name,
+        workspace,
+        channels=None,
+        scale=None,
     ):
-        """Perform measurements on an array of pixels
-        pixels - image pixel data, masked to objects if applicable
+        """Perform measurements on the pixels of the channels
+        values - (C, N) array with the N measured pixels of each channel, it
+                 is used as scratch space
         image_name - name of the current input image
         object_name - name of the current object set pixels are masked to
         measurement_name - group title to be used in data tables
         workspace - has all the details for current image set
+        channels - the 0 based indices of the channels in values, all if None
+        scale - the scale of the image, count images are measured exactly
+                from histograms if given
         """
+        if channels is None:
+            channels = range(len(values))
+        if len(channels) == 0:
+            return []
+        if self.wants_summary.value:
+            # Summarize before the values are reordered by the measurements
+            m = workspace.measurements
+            for pixels, chan in zip(values, channels):
+                summary = IntensitySummary.from_pixels(
+                    pixels, scale, self.summary_accuracy.value
+                )
+                m.add_image_measurement(
+                    F_SUMMARY % f"{measurement_name}_c{chan+1}", summary.to_json()
+                )
+        statistics = measure_intensities(values, scale=scale)
         measurements = []
-        for chan in range(pixels.shape[2]):
-            pixel_plane = pixels[:, :, chan]
-            if mask is not None:
-                pixel_plane = pixel_plane[mask]
+        for i, chan in enumerate(channels):
             cur_measurement_name = f"{measurement_name}_c{chan+1}"
-            measurements += self.measure_plane(
-                pixel_plane,
+            measurements += self.add_plane_measurements(
+                {feature: value[i] for feature, value in statistics.items()},
                 image_name,
                 object_name,
                 cur_measurement_name,
@@ -292,48 +581,27 @@ class MeasureImageIntensityMultiChannel(Module):
             )
         return measurements
 
-    def measure_plane(
-        self, pixels, image_name, object_name, measurement_name, channel, workspace
+    def add_plane_measurements(
+        self, statistics, image_name, object_name, measurement_name, channel, workspace
     ):
-        """Perform measurements on an array of pixels
-        pixels - image pixel data, masked to objects if applicable
+        """Add the measurements of a channel
+        statistics - the intensity statistics of the channel by feature name
         image_name - name of the current input image
         object_name - name of the current object set pixels are masked to
         measurement_name - group title to be used in data tables
         workspace - has all the details for current image set
         """
-        pixel_count = numpy.product(pixels.shape)
-        if pixel_count == 0:
-            pixel_sum = 0
-            pixel_mean = 0
-            pixel_std = 0
-            pixel_mad = 0
-            pixel_median = 0
-            pixel_min = 0
-            pixel_max = 0
-            pixel_pct_max = 0
-            pixel_lower_qrt = 0
-            pixel_upper_qrt = 0
-        else:
-            pixels = pixels.flatten()
-            pixels = pixels[
-                numpy.nonzero(numpy.isfinite(pixels))[0]
-            ]  # Ignore NaNs, Infs
-            pixel_count = numpy.product(pixels.shape)
-
-            pixel_sum = numpy.sum(pixels)
-            pixel_mean = pixel_sum / float(pixel_count)
-            pixel_std = numpy.std(pixels)
-            pixel_median = numpy.median(pixels)
-            pixel_mad = numpy.median(numpy.abs(pixels - pixel_median))
-            pixel_min = numpy.min(pixels)
-            pixel_max = numpy.max(pixels)
-            pixel_pct_max = (
-                100.0 * float(numpy.sum(pixels == pixel_max)) / float(pixel_count)
-            )
-            sorted_pixel_data = sorted(pixels)
-            pixel_lower_qrt = sorted_pixel_data[int(len(sorted_pixel_data) * 0.25)]
-            pixel_upper_qrt = sorted_pixel_data[int(len(sorted_pixel_data) * 0.75)]
+        pixel_sum = statistics["TotalIntensity"]
+        pixel_mean = statistics["MeanIntensity"]
+        pixel_std = statistics["StdIntensity"]
+        pixel_mad = statistics["MADIntensity"]
+        pixel_median = statistics["MedianIntensity"]
+        pixel_min = statistics["MinIntensity"]
+        pixel_max = statistics["MaxIntensity"]
+        pixel_count = statistics["TotalArea"]
+        pixel_pct_max = statistics["PercentMaximal"]
+        pixel_lower_qrt = statistics["LowerQuartileIntensity"]
+        pixel_upper_qrt = statistics["UpperQuartileIntensity"]
 
         m = workspace.measurements
         m.add_image_measurement(F_TOTAL_INTENSITY % measurement_name, pixel_sum)
@@ -374,7 +642,7 @@ class MeasureImageIntensityMultiChannel(Module):
         """Return column definitions for measurements made by this module"""
         columns = []
         for im in self.images_list.value:
-            for channel in range(self.nchannels.value):
+            for channel in self.get_column_channels():
                 for feature, coltype in (
                     (F_TOTAL_INTENSITY, COLTYPE_FLOAT),
                     (F_MEAN_INTENSITY, COLTYPE_FLOAT),
@@ -404,37 +672,77 @@ class MeasureImageIntensityMultiChannel(Module):
                                 coltype,
                             )
                         )
+        if self.wants_summary.value:
+            percentiles = parse_percentiles(self.summary_percentiles.value)
+            for measurement_name in self.get_measurement_names():
+                for channel in self.get_column_channels():
+                    feature = F_SUMMARY % f"{measurement_name}_c{channel+1}"
+                    columns += [
+                        ("Image", feature, COLTYPE_LONGBLOB),
+                        (EXPERIMENT, feature, COLTYPE_LONGBLOB),
+                    ]
+                    columns += [
+                        (
+                            EXPERIMENT,
+                            F_PERCENTILE_INTENSITY
+                            % get_percentile_name(
+                                measurement_name, percentile, channel
+                            ),
+                            COLTYPE_FLOAT,
+                        )
+                        for percentile in percentiles
+                    ]
         return columns
 
+    def get_measurement_names(self):
+        """The measurement names of the images and object sets, as in run"""
+        measurement_names = []
+        for im in self.images_list.value:
+            measurement_name = im
+            if self.wants_objects.value:
+                for object_set in self.objects_list.value:
+                    measurement_name += "_" + object_set
+                    measurement_names.append(measurement_name)
+            else:
+                measurement_names.append(measurement_name)
+        return measurement_names
+
     def get_categories(self, pipeline, object_name):
         if object_name == "Image":
             return ["Intensity"]
+        elif object_name == EXPERIMENT and self.wants_summary.value:
+            return ["Intensity"]
         else:
             return []
 
     def get_measurements(self, pipeline, object_name, category):
         if object_name == "Image" and category == "Intensity":
+            if self.wants_summary.value:
+                return ALL_MEASUREMENTS + ["Summary"]
             return ALL_MEASUREMENTS
-        return []
-
-    def get_measurement_images(self, pipeline, object_name, category, measurement):
         if (
-            object_name == "Image"
+            object_name == EXPERIMENT
             and category == "Intensity"
-            and measurement in ALL_MEASUREMENTS
+            and self.wants_summary.value
         ):
-            result = []
-            for im in self.images_list.value:
-                image_name = im
-                if self.wants_objects:
-                    for object_name in self.objects_list.value:
-                        image_name += "_" + object_name
-                        result += [image_name]
-                else:
-                    result += [image_name]
-            return result
+            # The percentiles are only measured from the merged summaries
+            if parse_percentiles(self.summary_percentiles.value):
+                return ["Summary", "PercentileIntensity"]
+            return ["Summary"]
         return []
 
+    def get_measurement_images(self, pipeline, object_name, category, measurement):
+        if measurement not in self.get_measurements(pipeline, object_name, category):
+            return []
+        if measurement == "PercentileIntensity":
+            # The percentile is part of the image name, e.g. image_999
+            return [
+                get_percentile_name(measurement_name, percentile)
+                for measurement_name in self.get_measurement_names()
+                for percentile in parse_percentiles(self.summary_percentiles.value)
+            ]
+        return self.get_measurement_names()
+
     def upgrade_settings(self, setting_values, variable_revision_number, module_name):
         if variable_revision_number == 1:
             variable_revision_number = 2
@@ -473,7 +781,450 @@ class MeasureImageIntensityMultiChannel(Module):
                     "copy of the module.",
                 )
             variable_revision_number = 3
+        if variable_revision_number == 3:
+            setting_values = setting_values + [
+                CHANNELS_ALL,
+                "1",
+                "",
+                Directory.static_join_string(DEFAULT_INPUT_FOLDER_NAME, ""),
+                "None",
+            ]
+            variable_revision_number = 4
+        if variable_revision_number == 4:
+            setting_values = setting_values + [
+                "No",
+                "0.5, 0.99, 0.999",
+                str(DEFAULT_SUMMARY_ACCURACY),
+            ]
+            variable_revision_number = 5
         return setting_values, variable_revision_number
 
     def volumetric(self):
         return False
+
+
+def gather_channels(pixels, indices=None, channels=None, block_size=4096):
+    """Gather the pixels of the channels into a contiguous (C, N) array
+
+    pixels - an (H, W, C) image stack
+    indices - the flat indices of the N gathered pixels, all if None
+    channels - the 0 based indices of the C gathered channels, all if None
+    block_size - the number of pixels gathered and transposed at once
+
+    The pixels are transposed block by block, which keeps the
+    transposition in the cache.
+    """
+    stack = pixels.reshape(-1, pixels.shape[-1])
+    if indices is None:
+        count = len(stack)
+    else:
+        count = len(indices)
+    if channels is None:
+        channels = range(stack.shape[1])
+    all_channels = list(channels) == list(range(stack.shape[1]))
+    values = numpy.empty((len(channels), count), stack.dtype)
+    for start in range(0, count, block_size):
+        stop = min(start + block_size, count)
+        if indices is None:
+            block = stack[start:stop]
+        else:
+            block = stack[indices[start:stop]]
+        if not all_channels:
+            block = block[:, channels]
+        values[:, start:stop] = block.T
+    return values
+
+
+def measure_intensities(values, block_size=2**19, scale=None):
+    """Intensity statistics of the pixels of several channels
+
+    values - a (C, N) array with the N pixels of each of C channels. It is
+             used as scratch space and is reordered.
+    block_size - the number of pixels measured at once. The channels are
+                 measured in blocks of about this size, which stay in the
+                 cache while all their statistics are computed.
+    scale - the scale of the image. If given and the pixels are counts
+            divided by the scale, the quantiles, median and MAD are
+            computed from histograms of the counts, see count_histograms.
+
+    Pixels that are NaN or infinite are ignored. The quartiles are the
+    pixels at the nearest lower index of the sorted pixels, the median and
+    the MAD are the mean of the two middle pixels for an even count.
+
+    returns a dictionary with an array of C values per feature name of
+    ALL_MEASUREMENTS. The statistics are double precision whatever the
+    dtype of the values.
+    """
+    nchannels, count = values.shape
+    statistics = {feature: numpy.zeros(nchannels) for feature in ALL_MEASUREMENTS}
+    statistics["TotalArea"] = numpy.zeros(nchannels, int)
+    step = max(1, block_size // max(count, 1))
+    for start in range(0, nchannels, step):
+        block = values[start : start + step]
+        finite = numpy.isfinite(block)
+        if finite.all():
+            _measure_intensities(block, statistics, start, scale)
+            continue
+        for channel, pixels in enumerate(block):
+            _measure_intensities(
+                pixels[finite[channel]][None], statistics, start + channel, scale
+            )
+    return statistics
+
+
+def _measure_intensities(values, statistics, start, scale=None):
+    """Measure the finite (C, N) values into the statistics from channel start"""
+    nchannels, count = values.shape
+    if count == 0:
+        return
+    channels = slice(start, start + nchannels)
+    statistics["TotalArea"][channels] = count
+    # The total is numpy.sum of the pixels, the mean is divided in double
+    # precision
+    total = numpy.sum(values, axis=1).astype(numpy.float64)
+    maximum = numpy.max(values, axis=1)
+    minimum = numpy.min(values, axis=1)
+    statistics["TotalIntensity"][channels] = total
+    statistics["MeanIntensity"][channels] = total / float(count)
+    statistics["StdIntensity"][channels] = numpy.std(values, axis=1)
+    statistics["MinIntensity"][channels] = minimum
+    statistics["MaxIntensity"][channels] = maximum
+    lower = int(count * 0.25)
+    upper = int(count * 0.75)
+    middle = sorted({(count - 1) // 2, count // 2})
+    histograms = None
+    sample = values[:, :: max(1, count // 1024)]
+    if scale is not None and 2 * numpy.count_nonzero(sample) > sample.size:
+        # Mostly zero channels are faster to select from their nonzero pixels
+        histograms = count_histograms(values, scale)
+    if histograms is not None:
+        #
+        # Exact statistics from the histograms of the counts
+        #
+        histograms, bin_values = histograms
+        nbins = histograms.shape[1]
+        maximum_bins = nbins - 1 - numpy.argmax(histograms[:, ::-1] != 0, axis=1)
+        statistics["PercentMaximal"][channels] = (
+            100.0 * histograms[numpy.arange(nchannels), maximum_bins] / float(count)
+        )
+        selected = bin_values[histogram_ranks(histograms, [lower, upper] + middle)]
+        median = numpy.mean(selected[:, 2:], axis=1)
+        statistics["MedianIntensity"][channels] = median
+        statistics["LowerQuartileIntensity"][channels] = selected[:, 0]
+        statistics["UpperQuartileIntensity"][channels] = selected[:, 1]
+        deviations = numpy.abs(bin_values - median[:, None])
+        order = numpy.argsort(deviations, axis=1, kind="stable")
+        deviations = numpy.take_along_axis(deviations, order, axis=1)
+        histograms = numpy.take_along_axis(histograms, order, axis=1)
+        selected = numpy.take_along_axis(
+            deviations, histogram_ranks(histograms, middle), axis=1
+        )
+        statistics["MADIntensity"][channels] = numpy.mean(selected, axis=1)
+        return
+    statistics["PercentMaximal"][channels] = (
+        100.0 * numpy.count_nonzero(values == maximum[:, None], axis=1) / float(count)
+    )
+    for channel, pixels in enumerate(values, start):
+        non_negative = statistics["MinIntensity"][channel] >= 0
+        selected = select_order_statistics(
+            pixels, [lower, upper] + middle, non_negative
+        )
+        median = numpy.mean(numpy.array([selected[k] for k in middle], values.dtype))
+        statistics["MedianIntensity"][channel] = median
+        statistics["LowerQuartileIntensity"][channel] = selected[lower]
+        statistics["UpperQuartileIntensity"][channel] = selected[upper]
+        if median == 0 and non_negative:
+            # The absolute deviations are the pixels themselves
+            continue
+        numpy.subtract(pixels, median, out=pixels)
+        numpy.abs(pixels, out=pixels)
+        selected = select_order_statistics(pixels, middle, True)
+        statistics["MADIntensity"][channel] = numpy.mean(
+            numpy.array([selected[k] for k in middle], values.dtype)
+        )
+
+
+def count_histograms(values, scale):
+    """Histograms of pixels that are counts divided by the scale
+
+    values - a (C, N) array of finite pixels
+    scale - the scale of the image, e.g. 65535 for 16 bit images
+
+    Count images such as IMC ion counts are loaded as pixels that are the
+    counts divided by the scale. The pixels are taken as counts if they
+    are exactly the pixel values of their nearest counts, so that every
+    count stands for one pixel value.
+
+    returns the (C, B) histograms of the counts 0 to B - 1 and the (B,)
+    pixel values of the counts, or None if the pixels are not counts or
+    there are more than N / 16 counts, where the histograms are no faster
+    than selecting the pixels
+    """
+    nchannels, count = values.shape
+    maximum = values.max()
+    if values.min() < 0 or maximum * scale >= count // 16:
+        return None
+    nbins = int(maximum * scale + 0.5) + 1
+    bin_values = numpy.arange(nbins, dtype=values.dtype)
+    bin_values /= values.dtype.type(scale)
+    # Check a sample of the pixels first to give up quickly on other images
+    sample = values[:, :: max(1, count // 1024)]
+    if not numpy.array_equal(bin_values[get_counts(sample, scale)], sample):
+        return None
+    counts = get_counts(values, scale)
+    if not numpy.array_equal(bin_values[counts], values):
+        return None
+    counts += numpy.arange(0, nchannels * nbins, nbins)[:, None]
+    histograms = numpy.bincount(counts.ravel(), minlength=nchannels * nbins)
+    return histograms.reshape(nchannels, nbins), bin_values
+
+
+def get_counts(pixels, scale):
+    """The nearest counts of pixels that are counts divided by the scale"""
+    if scale == 1:
+        return pixels.astype(numpy.intp)
+    counts = pixels * scale
+    counts += 0.5
+    return counts.astype(numpy.intp)
+
+
+def histogram_ranks(histograms, ranks):
+    """Find the order statistics in histograms
+
+    histograms - a (C, B) array of the pixel counts per bin, the bins are
+                 in the order of their values
+    ranks - the 0 based ranks of the order statistics
+
+    returns a (C, R) array of the bins of the order statistics
+    """
+    cumulative = numpy.cumsum(histograms, axis=1)
+    return numpy.stack(
+        [numpy.argmax(cumulative > rank, axis=1) for rank in ranks], axis=1
+    )
+
+
+def select_order_statistics(pixels, ranks, non_negative=False):
+    """Select order statistics of pixels by partitioning
+
+    pixels - a 1d array of pixels, it is reordered
+    ranks - the 0 based ranks of the order statistics
+    non_negative - True if no pixel is negative. Only the nonzero pixels
+                   are partitioned then, which is fast for the typical IMC
+                   channels where most pixels are zero.
+
+    returns a dictionary of the k-th smallest pixel per rank k
+    """
+    ranks = sorted(set(ranks))
+    if not non_negative:
+        return _select_ranks(pixels, ranks)
+    nonzero = pixels[pixels != 0]
+    zeros = len(pixels) - len(nonzero)
+    zero = pixels.dtype.type(0)
+    selected = {k: zero for k in ranks if k < zeros}
+    nonzero_ranks = [k - zeros for k in ranks if k >= zeros]
+    for k, value in _select_ranks(nonzero, nonzero_ranks).items():
+        selected[zeros + k] = value
+    return selected
+
+
+def _select_ranks(pixels, ranks):
+    """Partition pixels at the middle one of the sorted ranks and recurse
+
+    numpy.partition with several ranks at once is much slower than this.
+    """
+    if len(ranks) == 0:
+        return {}
+    middle = len(ranks) // 2
+    rank = ranks[middle]
+    pixels.partition(rank)
+    selected = {rank: pixels[rank]}
+    selected.update(_select_ranks(pixels[:rank], ranks[:middle]))
+    upper_ranks = [k - rank - 1 for k in ranks[middle + 1 :]]
+    for k, value in _select_ranks(pixels[rank + 1 :], upper_ranks).items():
+        selected[rank + 1 + k] = value
+    return selected
+
+
+class IntensitySummary:
+    """A mergeable summary of the pixel intensities of a channel
+
+    The summary holds the sorted distinct values of the summarized pixels
+    and the number of pixels per value. Count images are summarized
+    exactly. Other images are summarized by a quantile sketch with
+    logarithmic bins: every pixel x is replaced by the value v of its bin
+    with |v - x| <= accuracy * |x|. As replacing the pixels keeps their
+    order, every quantile of the sketch is within the relative accuracy of
+    the exact quantile.
+
+    Summaries are merged by adding up the pixels per value. A merged
+    summary has the accuracy of its least accurate summary, so summaries
+    can be merged across image sets, worker processes and runs.
+    """
+
+    def __init__(self, values=(), counts=(), accuracy=0.0):
+        """Create a summary
+
+        values - the sorted distinct pixel values
+        counts - the number of pixels per value
+        accuracy - the relative accuracy of the values, 0 if exact
+        """
+        self.values = numpy.asarray(values, float)
+        self.counts = numpy.asarray(counts, numpy.int64)
+        self.accuracy = accuracy
+
+    @classmethod
+    def from_pixels(cls, pixels, scale=None, accuracy=DEFAULT_SUMMARY_ACCURACY):
+        """Summarize the pixels of a channel
+
+        pixels - a 1d array of pixels, NaN and infinite pixels are ignored
+        scale - the scale of the image, pixels that are counts divided by
+                the scale are summarized exactly
+        accuracy - the relative accuracy of the sketch of other pixels
+        """
+        pixels = pixels[numpy.isfinite(pixels)]
+        if scale is not None:
+            summary = summarize_counts(pixels, scale)
+            if summary is not None:
+                return cls(*summary)
+        return cls(*sketch_pixels(pixels, accuracy), accuracy)
+
+    @classmethod
+    def from_json(cls, text):
+        summary = json.loads(text)
+        return cls(summary["values"], summary["counts"], summary["accuracy"])
+
+    def to_json(self):
+        return json.dumps(
+            {
+                "accuracy": self.accuracy,
+                "values": self.values.tolist(),
+                "counts": self.counts.tolist(),
+            }
+        )
+
+    def merge(self, *others):
+        """The summary of the pixels of this and the other summaries"""
+        summaries = (self,) + others
+        values, inverse = numpy.unique(
+            numpy.concatenate([summary.values for summary in summaries]),
+            return_inverse=True,
+        )
+        counts = numpy.zeros(len(values), numpy.int64)
+        numpy.add.at(
+            counts,
+            inverse,
+            numpy.concatenate([summary.counts for summary in summaries]),
+        )
+        return IntensitySummary(
+            values, counts, max(summary.accuracy for summary in summaries)
+        )
+
+    @property
+    def count(self):
+        """The number of summarized pixels"""
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        """The pixel at the nearest rank of the quantile q, NaN if empty
+
+        The rank is rounded as by numpy.percentile with nearest
+        interpolation and ClipRange.
+        """
+        if self.count == 0:
+            return numpy.nan
+        rank = int(numpy.around((self.count - 1) * q))
+        return self.values[numpy.argmax(numpy.cumsum(self.counts) > rank)]
+
+
+def summarize_counts(pixels, scale, max_count=2**20):
+    """The distinct values of pixels that are counts divided by the scale
+
+    pixels - a 1d array of finite pixels
+    scale - the scale of the image
+    max_count - the largest count that is summarized by its histogram
+
+    returns the distinct pixel values and their numbers of pixels or None
+    if the pixels are not counts, see count_histograms
+    """
+    if len(pixels) == 0:
+        return [], []
+    maximum = pixels.max()
+    if pixels.min() < 0 or maximum * scale > max_count:
+        return None
+    nbins = int(maximum * scale + 0.5) + 1
+    bin_values = numpy.arange(nbins, dtype=pixels.dtype)
+    bin_values /= pixels.dtype.type(scale)
+    counts = get_counts(pixels, scale)
+    if not numpy.array_equal(bin_values[counts], pixels):
+        return None
+    histogram = numpy.bincount(counts, minlength=nbins)
+    bins = numpy.flatnonzero(histogram)
+    return bin_values[bins], histogram[bins]
+
+
+def sketch_pixels(pixels, accuracy):
+    """The values of a quantile sketch of the pixels
+
+    pixels - a 1d array of finite pixels
+    accuracy - the relative accuracy of the sketch
+
+    The pixels x with gamma^(k-1) < |x| <= gamma^k are counted in the bin
+    k, where gamma = (1 + accuracy) / (1 - accuracy). The value of the bin
+    is 2 gamma^k / (gamma + 1), which is within the relative accuracy of
+    all its pixels. Zero pixels keep their value.
+
+    returns the sorted distinct values of the bins and their numbers of
+    pixels
+    """
+    gamma = (1.0 + accuracy) / (1.0 - accuracy)
+    values = []
+    counts = []
+    for sign in (-1, 1):
+        magnitudes = sign * pixels[numpy.sign(pixels) == sign].astype(float)
+        if len(magnitudes) == 0:
+            continue
+        keys = numpy.ceil(numpy.log(magnitudes) / numpy.log(gamma)).astype(numpy.int64)
+        offset = keys.min()
+        histogram = numpy.bincount(keys - offset)
+        bins = numpy.flatnonzero(histogram)
+        values.append(sign * 2.0 * gamma ** (bins + offset) / (gamma + 1.0))
+        counts.append(histogram[bins])
+    zeros = numpy.count_nonzero(pixels == 0)
+    if zeros > 0:
+        values.append([0.0])
+        counts.append([zeros])
+    if len(values) == 0:
+        return [], []
+    values = numpy.concatenate(values)
+    order = numpy.argsort(values)
+    return values[order], numpy.concatenate(counts)[order]
+
+
+def parse_percentiles(text):
+    """Parse comma separated percentiles between 0 and 1
+
+    text - e.g. "0.5, 0.99, 0.999"
+
+    returns the percentiles
+    """
+    percentiles = []
+    for part in text.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        percentile = float(part)
+        if not 0 < percentile < 1:
+            raise ValueError(f"Percentile {part} is not between 0 and 1")
+        percentiles.append(percentile)
+    return percentiles
+
+
+def get_percentile_name(measurement_name, percentile, channel=None):
+    """The measurement name of a percentile, e.g. image_999_c1 for 0.999
+
+    Without a channel, the name lacks the channel suffix, e.g. image_999.
+    """
+    digits = numpy.format_float_positional(percentile)[2:]
+    if channel is None:
+        return f"{measurement_name}_{digits}"
+    return f"{measurement_name}_{digits}_c{channel+1}"
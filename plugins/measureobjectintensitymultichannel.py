@@ -1,23 +1,47 @@
 # coding=utf-8
 
-import centrosome.cpmorphology
-import centrosome.filter
-import centrosome.outline
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import weakref
+
 import numpy
 import scipy.ndimage
+import scipy.sparse
 import skimage.segmentation
 from cellprofiler_core.constants.measurement import C_LOCATION, COLTYPE_FLOAT
 from cellprofiler_core.module import Module
-from cellprofiler_core.setting import Divider, ValidationError
+from cellprofiler_core.preferences import DEFAULT_INPUT_FOLDER_NAME
+from cellprofiler_core.setting import Binary, Divider, ValidationError
+from cellprofiler_core.setting.choice import Choice
 from cellprofiler_core.setting.subscriber import (
     ImageListSubscriber,
     LabelListSubscriber,
 )
-from cellprofiler_core.setting.text import Integer
+from cellprofiler_core.setting.text import Directory, Filename, Integer, Text
 from cellprofiler_core.utilities.core.object import crop_labels_and_image
 
 from cellprofiler.modules import _help
 
+try:
+    from ._channels import get_channel_numbers_by_name, parse_channel_numbers
+    from ._precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
+except ImportError:
+    # CellProfiler imports the plugins as top level modules
+    from _channels import get_channel_numbers_by_name, parse_channel_numbers
+    from _precision import (
+        ALL_PRECISIONS,
+        PRECISION_FLOAT32,
+        PRECISION_IMAGE,
+        get_dtype,
+    )
+
 __doc__ = """
 MeasureObjectIntensityMultichannel
 ==================================
@@ -27,6 +51,12 @@ identified objects for each plane of an entire image over multiple channels (exc
 
 The name of the measurements will have a suffix `_c[channelnr] ` where channelnr is 1 based index of the plane.
 
+Optionally only a subset of the channels is measured, selected by channel
+numbers (e.g. `1-10, 12`) or by channel names from a channel annotation
+file (a txt file without header with a channel name on each line, as used
+by **ExportVarCsv**). The measured channels keep their channel number in
+the measurement names.
+
 Given an image with objects identified (e.g., nuclei or cells), this
 module extracts intensity features for each object based on one or more
 corresponding grayscale images. Measurements are recorded for each
@@ -86,6 +116,18 @@ Measurements made by this module
 -  *Location\_MaxIntensity\_X, Location\_MaxIntensity\_Y:* The
    (X,Y) coordinates of the pixel with the maximum intensity within the
    object.
+-  *IntegratedIntensityInnerRing, MeanIntensityInnerRing:* The sum and
+   the average of the pixel intensities of the object that are closer
+   than the ring width to its edge. These measurements have the ring
+   width in pixels as suffix before the channel number.
+-  *IntegratedIntensityOuterRing, MeanIntensityOuterRing:* The sum and
+   the average of the intensities of the background pixels within the
+   ring width around the object. Background pixels close to several
+   objects belong to the ring of the closest one.
+-  *Correlation\_Covariance, Correlation\_Correlation:* The covariance
+   and the Pearson correlation coefficient of the intensities of two
+   channels within the object. These measurements have the suffix
+   `_c[channelnr]_c[channelnr]` of the two channels.
 
 """.format(
     **{"HELP_ON_MEASURING_INTENSITIES": _help.HELP_ON_MEASURING_INTENSITIES}
@@ -139,11 +181,57 @@ ALL_LOCATION_MEASUREMENTS = [
     LOC_MAX_Y,
     LOC_MAX_Z,
 ]
+"""Channel selection methods"""
+CHANNELS_ALL = "All"
+CHANNELS_NUMBERS = "Channel numbers"
+CHANNELS_NAMES = "Channel names"
+
+ALL_FEATURES = [(INTENSITY, feature) for feature in ALL_MEASUREMENTS] + [
+    (C_LOCATION, feature) for feature in ALL_LOCATION_MEASUREMENTS
+]
+BASIC_MEASUREMENTS = [
+    INTEGRATED_INTENSITY,
+    MEAN_INTENSITY,
+    STD_INTENSITY,
+    MIN_INTENSITY,
+    MAX_INTENSITY,
+]
+EDGE_MEASUREMENTS = [
+    INTEGRATED_INTENSITY_EDGE,
+    MEAN_INTENSITY_EDGE,
+    STD_INTENSITY_EDGE,
+    MIN_INTENSITY_EDGE,
+    MAX_INTENSITY_EDGE,
+]
+QUANTILE_MEASUREMENTS = [
+    LOWER_QUARTILE_INTENSITY,
+    MEDIAN_INTENSITY,
+    MAD_INTENSITY,
+    UPPER_QUARTILE_INTENSITY,
+]
+
+"""Features of the rings inside and outside of the objects"""
+INTEGRATED_INTENSITY_INNER_RING = "IntegratedIntensityInnerRing"
+MEAN_INTENSITY_INNER_RING = "MeanIntensityInnerRing"
+INTEGRATED_INTENSITY_OUTER_RING = "IntegratedIntensityOuterRing"
+MEAN_INTENSITY_OUTER_RING = "MeanIntensityOuterRing"
+RING_MEASUREMENTS = [
+    INTEGRATED_INTENSITY_INNER_RING,
+    MEAN_INTENSITY_INNER_RING,
+    INTEGRATED_INTENSITY_OUTER_RING,
+    MEAN_INTENSITY_OUTER_RING,
+]
+
+"""Features of pairs of channels"""
+C_CORRELATION = "Correlation"
+COVARIANCE = "Covariance"
+CORRELATION = "Correlation"
+ALL_PAIR_MEASUREMENTS = [COVARIANCE, CORRELATION]
 
 
 class MeasureObjectIntensityMultichannel(Module):
     module_name = "MeasureObjectIntensityMultichannel"
-    variable_revision_number = 4
+    variable_revision_number = 11
     category = ["ImcPluginsCP", "Measurement"]
 
     def create_settings(self):
@@ -169,14 +257,338 @@ class MeasureObjectIntensityMultichannel(Module):
             """,
         )
 
+        self.channel_choice = Choice(
+            "Select the channels to measure",
+            [CHANNELS_ALL, CHANNELS_NUMBERS, CHANNELS_NAMES],
+            CHANNELS_ALL,
+            doc=f"""
+            Select *{CHANNELS_ALL}* to measure every channel of the images.
+            Select *{CHANNELS_NUMBERS}* to measure only the channels with
+            the given channel numbers.
+            Select *{CHANNELS_NAMES}* to measure only the channels with the
+            given names in a channel annotation file.
+            """,
+        )
+        self.channel_numbers = Text(
+            "Channel numbers",
+            "1",
+            doc="""
+            Enter the 1 based numbers of the channels to measure, separated by
+            commas. Ranges of channels can be given as e.g. `1-10`.
+            """,
+        )
+        self.channel_names = Text(
+            "Channel names",
+            "",
+            doc="""
+            Enter the names of the channels to measure, separated by commas.
+            """,
+        )
+        self.annotation_location = Directory(
+            "Channel annotation file location",
+            Directory.static_join_string(DEFAULT_INPUT_FOLDER_NAME, ""),
+            doc="""
+            Location of a txt file without header that contains on each new
+            line the name of a channel. Must have exactly the same number of
+            rows than the multichannel image has channels.
+            """,
+        )
+        self.annotation_filename = Filename(
+            "Channel annotation file name",
+            "None",
+            browse_msg="Choose txt/csv file",
+            exts=[("Data file (*.csv)", "*.csv"), ("Data file (*.txt)", "*.txt")],
+            doc="Provide the file name of the channel annotation file.",
+            get_directory_fn=self.annotation_location.get_absolute_path,
+            set_directory_fn=lambda path: self.annotation_location.join_parts(
+                *self.annotation_location.get_parts_from_path(path)
+            ),
+        )
+
+        self.workers = Integer(
+            "Number of worker threads",
+            1,
+            minval=1,
+            doc="""
+            The channels are split into this many blocks that are measured in
+            parallel threads. The numerical work is done in NumPy and SciPy,
+            which release the GIL, such that several cores are used.
+            The measurements do not depend on the number of threads.
+            """,
+        )
+
+        self.wants_tiles = Binary(
+            "Measure the image in tiles?",
+            False,
+            doc="""
+            Select *Yes* to measure large images tile by tile to bound the
+            memory use. Every object is measured as a whole together with the
+            other objects whose bounding box starts in the same tile, such
+            that the measurements are the same as without tiles. The memory
+            use is proportional to the tile size plus the object size.
+            """,
+        )
+        self.tile_size = Integer(
+            "Tile size",
+            1024,
+            minval=16,
+            doc="""
+            The width and height in pixels of the tiles.
+            """,
+        )
+
+        self.precision = Choice(
+            "Precision of the computations",
+            ALL_PRECISIONS,
+            PRECISION_IMAGE,
+            doc=f"""
+            With *{PRECISION_IMAGE}* the image is measured in its own
+            precision, which is single precision for images loaded by
+            CellProfiler. With *{PRECISION_FLOAT32}* the image is converted to
+            single precision before it is measured, which halves the memory of
+            the gathered pixels and the sort buffers. The sums are still
+            accumulated in double precision.
+            """,
+        )
+
+        self.feature_divider = Divider()
+        self.wants_intensity = Binary(
+            "Measure the intensity statistics?",
+            True,
+            doc="""
+            Select *Yes* to measure the integrated, mean, standard deviation,
+            minimal and maximal intensity of the objects.
+            """,
+        )
+        self.wants_quantiles = Binary(
+            "Measure the intensity quartiles?",
+            True,
+            doc="""
+            Select *Yes* to measure the lower quartile, median, upper quartile
+            and MAD intensity of the objects. These need the intensities to be
+            sorted within each object and are the most expensive features.
+            """,
+        )
+        self.wants_edge = Binary(
+            "Measure the edge intensities?",
+            True,
+            doc="""
+            Select *Yes* to measure the intensity statistics of the edge pixels
+            of the objects.
+            """,
+        )
+        self.wants_mass_displacement = Binary(
+            "Measure the mass displacement?",
+            True,
+            doc="""
+            Select *Yes* to measure the distance between the center of mass of
+            the binary and of the intensity image of the objects.
+            """,
+        )
+        self.wants_location = Binary(
+            "Measure the intensity locations?",
+            True,
+            doc="""
+            Select *Yes* to measure the location of the intensity weighted
+            center of mass and of the intensity maximum of the objects.
+            """,
+        )
+        self.wants_rings = Binary(
+            "Measure the ring intensities?",
+            False,
+            doc="""
+            Select *Yes* to measure the integrated and mean intensity of a
+            ring of pixels inside the objects along their edge and of a ring
+            of background pixels around them, e.g. to measure membrane or
+            peri-cellular intensities without expanding or shrinking the
+            objects and measuring them again. The rings are computed once
+            from the labels and reduced in the same pass as the other
+            features.
+            """,
+        )
+        self.ring_width = Integer(
+            "Ring width",
+            2,
+            minval=1,
+            doc="""
+            The width in pixels of the inner and outer rings. A width of 1
+            gives the edge pixels of the objects and the background pixels
+            touching them.
+            """,
+        )
+        self.wants_correlation = Binary(
+            "Measure the channel correlations?",
+            False,
+            doc="""
+            Select *Yes* to measure the covariance and the Pearson correlation
+            of the intensities of pairs of channels within the objects. All
+            pairs are measured in one pass over the objects, instead of one
+            **MeasureColocalization** run per pair.
+            """,
+        )
+        self.correlation_pairs = Text(
+            "Channel pairs",
+            "",
+            doc="""
+            Enter the pairs of channel numbers to correlate, separated by
+            commas, e.g. `1:2, 1:5`. Both channels of a pair must be measured.
+            Leave empty to correlate all pairs of the measured channels, that
+            is n * (n - 1) / 2 pairs for n channels.
+            """,
+        )
+
     def settings(self):
-        result = [self.images_list, self.objects_list, self.nchannels]
+        result = [
+            self.images_list,
+            self.objects_list,
+            self.nchannels,
+            self.channel_choice,
+            self.channel_numbers,
+            self.channel_names,
+            self.annotation_location,
+            self.annotation_filename,
+            self.wants_intensity,
+            self.wants_quantiles,
+            self.wants_edge,
+            self.wants_mass_displacement,
+            self.wants_location,
+            self.workers,
+            self.wants_tiles,
+            self.tile_size,
+            self.precision,
+            self.wants_correlation,
+            self.correlation_pairs,
+            self.wants_rings,
+            self.ring_width,
+        ]
         return result
 
     def visible_settings(self):
-        result = [self.images_list, self.nchannels, self.divider, self.objects_list]
+        result = [self.images_list, self.nchannels, self.channel_choice]
+        if self.channel_choice == CHANNELS_NUMBERS:
+            result += [self.channel_numbers]
+        elif self.channel_choice == CHANNELS_NAMES:
+            result += [
+                self.channel_names,
+                self.annotation_location,
+                self.annotation_filename,
+            ]
+        result += [
+            self.divider,
+            self.objects_list,
+            self.feature_divider,
+            self.wants_intensity,
+            self.wants_quantiles,
+            self.wants_edge,
+            self.wants_mass_displacement,
+            self.wants_location,
+            self.wants_rings,
+        ]
+        if self.wants_rings:
+            result += [self.ring_width]
+        result += [self.wants_correlation]
+        if self.wants_correlation:
+            result += [self.correlation_pairs]
+        result += [
+            self.workers,
+            self.wants_tiles,
+        ]
+        if self.wants_tiles:
+            result += [self.tile_size]
+        result += [self.precision]
         return result
 
+    def get_channels(self):
+        """Get the 0 based indices of the channels to measure"""
+        nchannels = self.nchannels.value
+        if self.channel_choice == CHANNELS_ALL:
+            return list(range(nchannels))
+        if self.channel_choice == CHANNELS_NUMBERS:
+            channel_numbers = parse_channel_numbers(self.channel_numbers.value)
+        else:
+            channel_numbers = get_channel_numbers_by_name(
+                self.channel_names.value,
+                os.path.join(
+                    self.annotation_location.get_absolute_path(),
+                    self.annotation_filename.value,
+                ),
+            )
+        for channel_number in channel_numbers:
+            if not 1 <= channel_number <= nchannels:
+                raise ValueError(
+                    f"Channel {channel_number} is not within the {nchannels} "
+                    "channels of the images"
+                )
+        return [channel_number - 1 for channel_number in channel_numbers]
+
+    def get_column_channels(self):
+        """Get the channels to list measurement columns for
+
+        Channels selected by name are only known once the annotation file
+        exists. Until then the columns of all channels are listed, so that
+        listing the measurements does not fail, and validate_module reports
+        the problem.
+        """
+        try:
+            return self.get_channels()
+        except (OSError, ValueError):
+            return list(range(self.nchannels.value))
+
+    def get_features(self):
+        """Get the (category, feature) pairs of the selected feature groups"""
+        features = []
+        for wants, category, group in (
+            (self.wants_intensity, INTENSITY, BASIC_MEASUREMENTS),
+            (self.wants_edge, INTENSITY, EDGE_MEASUREMENTS),
+            (self.wants_mass_displacement, INTENSITY, [MASS_DISPLACEMENT]),
+            (self.wants_quantiles, INTENSITY, QUANTILE_MEASUREMENTS),
+            (self.wants_location, C_LOCATION, ALL_LOCATION_MEASUREMENTS),
+            (self.wants_rings, INTENSITY, RING_MEASUREMENTS),
+        ):
+            if wants.value:
+                features += [(category, feature) for feature in group]
+        return features
+
+    def get_ring_width(self):
+        """Get the width of the rings, 0 if they are not measured"""
+        return self.ring_width.value if self.wants_rings else 0
+
+    def get_measurement_name(self, category, feature, image_name, channel):
+        """Get the name of the measurement of a feature of a 0 based channel"""
+        if feature in RING_MEASUREMENTS:
+            return "%s_%s_%s_%s_c%s" % (
+                category,
+                feature,
+                image_name,
+                self.ring_width.value,
+                channel + 1,
+            )
+        return "%s_%s_%s_c%s" % (category, feature, image_name, channel + 1)
+
+    def get_pair_features(self):
+        """Get the (category, feature) pairs measured for pairs of channels"""
+        if not self.wants_correlation:
+            return []
+        return [(C_CORRELATION, feature) for feature in ALL_PAIR_MEASUREMENTS]
+
+    def get_channel_pairs(self):
+        """Get the pairs of 0 based indices of the channels to correlate"""
+        if not self.wants_correlation:
+            return []
+        channels = self.get_channels()
+        if self.correlation_pairs.value.strip() == "":
+            return list(itertools.combinations(channels, 2))
+        pairs = []
+        for first, second in parse_channel_pairs(self.correlation_pairs.value):
+            for channel_number in (first, second):
+                if channel_number - 1 not in channels:
+                    raise ValueError(
+                        f"Channel {channel_number} of the pair {first}:{second} "
+                        "is not measured"
+                    )
+            pairs.append((first - 1, second - 1))
+        return pairs
+
     def upgrade_settings(self, setting_values, variable_revision_number, module_name):
         if variable_revision_number <= 3:
             num_imgs = int(setting_values[0])
@@ -189,6 +601,37 @@ class MeasureObjectIntensityMultichannel(Module):
                 nchannels_list[0],
             ]
             variable_revision_number = 4
+        if variable_revision_number == 4:
+            setting_values = setting_values + ["Yes"] * 5
+            variable_revision_number = 5
+        if variable_revision_number == 5:
+            setting_values = (
+                setting_values[:3]
+                + [
+                    CHANNELS_ALL,
+                    "1",
+                    "",
+                    Directory.static_join_string(DEFAULT_INPUT_FOLDER_NAME, ""),
+                    "None",
+                ]
+                + setting_values[3:]
+            )
+            variable_revision_number = 6
+        if variable_revision_number == 6:
+            setting_values = setting_values + ["1"]
+            variable_revision_number = 7
+        if variable_revision_number == 7:
+            setting_values = setting_values + ["No", "1024"]
+            variable_revision_number = 8
+        if variable_revision_number == 8:
+            setting_values = setting_values + [PRECISION_IMAGE]
+            variable_revision_number = 9
+        if variable_revision_number == 9:
+            setting_values = setting_values + ["No", ""]
+            variable_revision_number = 10
+        if variable_revision_number == 10:
+            setting_values = setting_values + ["No", "2"]
+            variable_revision_number = 11
         return setting_values, variable_revision_number
 
     def validate_module(self, pipeline):
@@ -198,6 +641,26 @@ class MeasureObjectIntensityMultichannel(Module):
             raise ValidationError("No images selected", self.images_list)
         elif len(self.objects_list.value) == 0:
             raise ValidationError("No objects selected", self.objects_list)
+        elif len(self.get_features()) + len(self.get_pair_features()) == 0:
+            raise ValidationError("No features selected", self.wants_intensity)
+        if self.channel_choice == CHANNELS_NUMBERS:
+            channel_setting = self.channel_numbers
+        else:
+            channel_setting = self.channel_names
+        try:
+            channels = self.get_channels()
+        except (OSError, ValueError) as e:
+            raise ValidationError(str(e), channel_setting)
+        if len(channels) == 0:
+            raise ValidationError("No channels selected", channel_setting)
+        try:
+            pairs = self.get_channel_pairs()
+        except ValueError as e:
+            raise ValidationError(str(e), self.correlation_pairs)
+        if self.wants_correlation and len(pairs) == 0:
+            raise ValidationError(
+                "No channel pairs to correlate", self.correlation_pairs
+            )
         for image_name in self.images_list.value:
             if image_name in images:
                 raise ValidationError(
@@ -216,25 +679,40 @@ class MeasureObjectIntensityMultichannel(Module):
     def get_measurement_columns(self, pipeline):
         """Return the column definitions for measurements made by this module"""
         columns = []
+        try:
+            pairs = self.get_channel_pairs()
+        except (OSError, ValueError):
+            pairs = []
         for image_name in self.images_list.value:
-            for channel in range(self.nchannels.value):
+            for channel in self.get_column_channels():
                 for object_name in self.objects_list.value:
-                    for category, features in (
-                        (INTENSITY, ALL_MEASUREMENTS),
-                        (
-                            C_LOCATION,
-                            ALL_LOCATION_MEASUREMENTS,
-                        ),
-                    ):
-                        for feature in features:
-                            columns.append(
-                                (
-                                    object_name,
-                                    "%s_%s_%s_c%s"
-                                    % (category, feature, image_name, channel + 1),
-                                    COLTYPE_FLOAT,
-                                )
+                    for category, feature in self.get_features():
+                        columns.append(
+                            (
+                                object_name,
+                                self.get_measurement_name(
+                                    category, feature, image_name, channel
+                                ),
+                                COLTYPE_FLOAT,
+                            )
+                        )
+            for first, second in pairs:
+                for object_name in self.objects_list.value:
+                    for category, feature in self.get_pair_features():
+                        columns.append(
+                            (
+                                object_name,
+                                "%s_%s_%s_c%s_c%s"
+                                % (
+                                    category,
+                                    feature,
+                                    image_name,
+                                    first + 1,
+                                    second + 1,
+                                ),
+                                COLTYPE_FLOAT,
                             )
+                        )
 
         return columns
 
@@ -247,37 +725,51 @@ class MeasureObjectIntensityMultichannel(Module):
         """
         for object_set in self.objects_list.value:
             if object_set == object_name:
-                return [INTENSITY, C_LOCATION]
+                categories = []
+                for category, _ in self.get_features() + self.get_pair_features():
+                    if category not in categories:
+                        categories.append(category)
+                return categories
         return []
 
     def get_measurements(self, pipeline, object_name, category):
         """Get the measurements made on the given object in the given category"""
-        if category == C_LOCATION:
-            all_measurements = ALL_LOCATION_MEASUREMENTS
-        elif category == INTENSITY:
-            all_measurements = ALL_MEASUREMENTS
-        else:
-            return []
         for object_set in self.objects_list.value:
             if object_set == object_name:
-                return all_measurements
+                return [
+                    feature
+                    for feature_category, feature in self.get_features()
+                    + self.get_pair_features()
+                    if feature_category == category
+                ]
         return []
 
     def get_measurement_images(self, pipeline, object_name, category, measurement):
         """Get the images used to make the given measurement in the given category on the given object"""
-        if category == INTENSITY:
-            if measurement not in ALL_MEASUREMENTS:
-                return []
-        elif category == C_LOCATION:
-            if measurement not in ALL_LOCATION_MEASUREMENTS:
-                return []
-        else:
+        if (
+            category,
+            measurement,
+        ) not in self.get_features() + self.get_pair_features():
             return []
         for object_set in self.objects_list.value:
             if object_set == object_name:
                 return self.images_list.value
         return []
 
+    def get_measurement_scales(
+        self, pipeline, object_name, category, measurement, image_name
+    ):
+        """Get the ring width of the ring measurements"""
+        if (
+            category != INTENSITY
+            or measurement not in RING_MEASUREMENTS
+            or not self.wants_rings
+            or object_name not in self.objects_list.value
+            or image_name not in self.images_list.value
+        ):
+            return []
+        return [str(self.ring_width.value)]
+
     def run(self, workspace):
         if self.show_window:
             workspace.display_data.col_labels = (
@@ -295,340 +787,153 @@ class MeasureObjectIntensityMultichannel(Module):
                 "This module needs at least 1 image and object set selected"
             )
         nchannels = self.nchannels.value
-        for channel in range(nchannels):
-            for image_name in self.images_list.value:
-                image = workspace.image_set.get_image(
-                    image_name, must_be_grayscale=False
+        channels = self.get_channels()
+        features = self.get_features()
+        ring_width = self.get_ring_width()
+        pair_features = self.get_pair_features()
+        channel_pairs = self.get_channel_pairs()
+        # The positions of the channels of the pairs in the measured channels
+        pairs = [
+            (channels.index(first), channels.index(second))
+            for first, second in channel_pairs
+        ]
+        for image_name in self.images_list.value:
+            image = workspace.image_set.get_image(image_name, must_be_grayscale=False)
+            img = image.pixel_data
+
+            if img.ndim == 2:
+                img_channels = 1
+            else:
+                img_channels = img.shape[2]
+
+            if img_channels != nchannels:
+                raise ValueError(
+                    f"""
+                The module configuration suggests the image should have {nchannels} channels\n
+                but the image "{image_name}" has only {img_channels} channels. \n
+                Are you sure the image is set as color and not set as grayscale in NamesAndTypes?\n
+                Did you adapt the number of channels to the actual number of channels?
+                """
                 )
-                img = image.pixel_data
-
-                if img.ndim == 2:
-                    img_channels = 1
-                else:
-                    img_channels = img.shape[2]
-
-                if img_channels != nchannels:
+            # All channels are measured together: the pixels are kept as a
+            # (z, y, x, c) stack and every object feature is computed for all
+            # channels at once.
+            img = img.reshape(img.shape[:2] + (nchannels,))
+            dtype = get_dtype(self.precision.value, img.dtype)
+            if not self.wants_tiles:
+                if len(channels) < nchannels:
+                    img = img[:, :, channels]
+                img = img.astype(dtype, copy=False)
+            if image.has_mask:
+                image_mask = image.mask
+            else:
+                image_mask = None
+
+            if image.dimensions == 2:
+                img = img.reshape(1, *img.shape)
+                if image_mask is not None:
+                    image_mask = image_mask.reshape(1, *image_mask.shape)
+
+            for object_name in self.objects_list.value:
+                if object_name not in workspace.object_set.object_names:
                     raise ValueError(
-                        f"""
-                    The module configuration suggests the image should have {nchannels} channels\n
-                    but the image "{image_name}" has only {img_channels} channels. \n
-                    Are you sure the image is set as color and not set as grayscale in NamesAndTypes?\n
-                    Did you adapt the number of channels to the actual number of channels?
-                    """
+                        "The %s objects are missing from the pipeline." % object_name
                     )
-                for object_name in self.objects_list.value:
-                    if object_name not in workspace.object_set.object_names:
-                        raise ValueError(
-                            "The %s objects are missing from the pipeline."
-                            % object_name
-                        )
-                    # Need to refresh image after each iteration...
-                    if nchannels == 1:
-                        img = img.squeeze()
-                    else:
-                        img = img[:, :, channel].squeeze()
-
-                    if image.has_mask:
-                        masked_image = img.copy()
-                        masked_image[~image.mask] = 0
-                        image_mask = image.mask
-                    else:
-                        masked_image = img
-                        image_mask = numpy.ones_like(img, dtype=numpy.bool)
-
-                    if image.dimensions == 2:
-                        img = img.reshape(1, *img.shape)
-                        masked_image = masked_image.reshape(1, *masked_image.shape)
-                        image_mask = image_mask.reshape(1, *image_mask.shape)
-
-                    objects = workspace.object_set.get_objects(object_name)
-                    nobjects = objects.count
-                    integrated_intensity = numpy.zeros((nobjects,))
-                    integrated_intensity_edge = numpy.zeros((nobjects,))
-                    mean_intensity = numpy.zeros((nobjects,))
-                    mean_intensity_edge = numpy.zeros((nobjects,))
-                    std_intensity = numpy.zeros((nobjects,))
-                    std_intensity_edge = numpy.zeros((nobjects,))
-                    min_intensity = numpy.zeros((nobjects,))
-                    min_intensity_edge = numpy.zeros((nobjects,))
-                    max_intensity = numpy.zeros((nobjects,))
-                    max_intensity_edge = numpy.zeros((nobjects,))
-                    mass_displacement = numpy.zeros((nobjects,))
-                    lower_quartile_intensity = numpy.zeros((nobjects,))
-                    median_intensity = numpy.zeros((nobjects,))
-                    mad_intensity = numpy.zeros((nobjects,))
-                    upper_quartile_intensity = numpy.zeros((nobjects,))
-                    cmi_x = numpy.zeros((nobjects,))
-                    cmi_y = numpy.zeros((nobjects,))
-                    cmi_z = numpy.zeros((nobjects,))
-                    max_x = numpy.zeros((nobjects,))
-                    max_y = numpy.zeros((nobjects,))
-                    max_z = numpy.zeros((nobjects,))
-                    for labels, lindexes in objects.get_labels():
-                        lindexes = lindexes[lindexes != 0]
-
-                        if image.dimensions == 2:
-                            labels = labels.reshape(1, *labels.shape)
-
-                        labels, img = crop_labels_and_image(labels, img)
-                        _, masked_image = crop_labels_and_image(labels, masked_image)
-                        outlines = skimage.segmentation.find_boundaries(
-                            labels, mode="inner"
-                        )
-
-                        if image.has_mask:
-                            _, mask = crop_labels_and_image(labels, image_mask)
-                            masked_labels = labels.copy()
-                            masked_labels[~mask] = 0
-                            masked_outlines = outlines.copy()
-                            masked_outlines[~mask] = 0
-                        else:
-                            masked_labels = labels
-                            masked_outlines = outlines
-
-                        lmask = masked_labels > 0 & numpy.isfinite(
-                            img
-                        )  # Ignore NaNs, Infs
-                        has_objects = numpy.any(lmask)
-                        if has_objects:
-                            limg = img[lmask]
-
-                            llabels = labels[lmask]
-
-                            mesh_z, mesh_y, mesh_x = numpy.mgrid[
-                                0 : masked_image.shape[0],
-                                0 : masked_image.shape[1],
-                                0 : masked_image.shape[2],
-                            ]
-
-                            mesh_x = mesh_x[lmask]
-                            mesh_y = mesh_y[lmask]
-                            mesh_z = mesh_z[lmask]
-
-                            lcount = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(
-                                    numpy.ones(len(limg)), llabels, lindexes
-                                )
-                            )
-
-                            integrated_intensity[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(limg, llabels, lindexes)
-                            )
-
-                            mean_intensity[lindexes - 1] = (
-                                integrated_intensity[lindexes - 1] / lcount
-                            )
-
-                            std_intensity[lindexes - 1] = numpy.sqrt(
-                                centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                    scipy.ndimage.mean(
-                                        (limg - mean_intensity[llabels - 1]) ** 2,
-                                        llabels,
-                                        lindexes,
-                                    )
-                                )
-                            )
-
-                            min_intensity[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.minimum(limg, llabels, lindexes)
-                            )
-
-                            max_intensity[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.maximum(limg, llabels, lindexes)
-                            )
-
-                            # Compute the position of the intensity maximum
-                            max_position = numpy.array(
-                                centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                    scipy.ndimage.maximum_position(
-                                        limg, llabels, lindexes
-                                    )
-                                ),
-                                dtype=int,
-                            )
-                            max_position = numpy.reshape(
-                                max_position, (max_position.shape[0],)
-                            )
-
-                            max_x[lindexes - 1] = mesh_x[max_position]
-                            max_y[lindexes - 1] = mesh_y[max_position]
-                            max_z[lindexes - 1] = mesh_z[max_position]
-
-                            # The mass displacement is the distance between the center
-                            # of mass of the binary image and of the intensity image. The
-                            # center of mass is the average X or Y for the binary image
-                            # and the sum of X or Y * intensity / integrated intensity
-                            cm_x = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.mean(mesh_x, llabels, lindexes)
-                            )
-                            cm_y = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.mean(mesh_y, llabels, lindexes)
-                            )
-                            cm_z = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.mean(mesh_z, llabels, lindexes)
-                            )
-
-                            i_x = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(mesh_x * limg, llabels, lindexes)
-                            )
-                            i_y = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(mesh_y * limg, llabels, lindexes)
-                            )
-                            i_z = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(mesh_z * limg, llabels, lindexes)
-                            )
-
-                            cmi_x[lindexes - 1] = (
-                                i_x / integrated_intensity[lindexes - 1]
-                            )
-                            cmi_y[lindexes - 1] = (
-                                i_y / integrated_intensity[lindexes - 1]
-                            )
-                            cmi_z[lindexes - 1] = (
-                                i_z / integrated_intensity[lindexes - 1]
-                            )
-
-                            diff_x = cm_x - cmi_x[lindexes - 1]
-                            diff_y = cm_y - cmi_y[lindexes - 1]
-                            diff_z = cm_z - cmi_z[lindexes - 1]
-
-                            mass_displacement[lindexes - 1] = numpy.sqrt(
-                                diff_x * diff_x + diff_y * diff_y + diff_z * diff_z
-                            )
-
-                            #
-                            # Sort the intensities by label, then intensity.
-                            # For each label, find the index above and below
-                            # the 25%, 50% and 75% mark and take the weighted
-                            # average.
-                            #
-                            order = numpy.lexsort((limg, llabels))
-                            areas = lcount.astype(int)
-                            indices = numpy.cumsum(areas) - areas
-                            for dest, fraction in (
-                                (lower_quartile_intensity, 1.0 / 4.0),
-                                (median_intensity, 1.0 / 2.0),
-                                (upper_quartile_intensity, 3.0 / 4.0),
-                            ):
-                                qindex = indices.astype(float) + areas * fraction
-                                qfraction = qindex - numpy.floor(qindex)
-                                qindex = qindex.astype(int)
-                                qmask = qindex < indices + areas - 1
-                                qi = qindex[qmask]
-                                qf = qfraction[qmask]
-                                dest[lindexes[qmask] - 1] = (
-                                    limg[order[qi]] * (1 - qf)
-                                    + limg[order[qi + 1]] * qf
-                                )
-
-                                #
-                                # In some situations (e.g., only 3 points), there may
-                                # not be an upper bound.
-                                #
-                                qmask = (~qmask) & (areas > 0)
-                                dest[lindexes[qmask] - 1] = limg[order[qindex[qmask]]]
-
-                            #
-                            # Once again, for the MAD
-                            #
-                            madimg = numpy.abs(limg - median_intensity[llabels - 1])
-                            order = numpy.lexsort((madimg, llabels))
-                            qindex = indices.astype(float) + areas / image.dimensions
-                            qfraction = qindex - numpy.floor(qindex)
-                            qindex = qindex.astype(int)
-                            qmask = qindex < indices + areas - 1
-                            qi = qindex[qmask]
-                            qf = qfraction[qmask]
-                            mad_intensity[lindexes[qmask] - 1] = (
-                                madimg[order[qi]] * (1 - qf)
-                                + madimg[order[qi + 1]] * qf
-                            )
-                            qmask = (~qmask) & (areas > 0)
-                            mad_intensity[lindexes[qmask] - 1] = madimg[
-                                order[qindex[qmask]]
-                            ]
-
-                        emask = masked_outlines > 0
-                        eimg = img[emask]
-                        elabels = labels[emask]
-                        has_edge = len(eimg) > 0
-
-                        if has_edge:
-                            ecount = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(
-                                    numpy.ones(len(eimg)), elabels, lindexes
-                                )
-                            )
-
-                            integrated_intensity_edge[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.sum(eimg, elabels, lindexes)
-                            )
-
-                            mean_intensity_edge[lindexes - 1] = (
-                                integrated_intensity_edge[lindexes - 1] / ecount
-                            )
-
-                            std_intensity_edge[lindexes - 1] = numpy.sqrt(
-                                centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                    scipy.ndimage.mean(
-                                        (eimg - mean_intensity_edge[elabels - 1]) ** 2,
-                                        elabels,
-                                        lindexes,
-                                    )
-                                )
-                            )
-
-                            min_intensity_edge[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.minimum(eimg, elabels, lindexes)
-                            )
-
-                            max_intensity_edge[
-                                lindexes - 1
-                            ] = centrosome.cpmorphology.fixup_scipy_ndimage_result(
-                                scipy.ndimage.maximum(eimg, elabels, lindexes)
-                            )
+            if not self.wants_tiles:
+                #
+                # The pixels of all object sets are gathered in one sweep
+                # over the image.
+                #
+                label_indices = {
+                    object_name: label_index_cache.get(
+                        workspace.measurements.image_set_number,
+                        object_name,
+                        workspace.object_set.get_objects(object_name),
+                        img,
+                        image_mask,
+                        image.dimensions,
+                        ring_width,
+                    )
+                    for object_name in self.objects_list.value
+                }
+                pixel_gather = PixelGather(
+                    img,
+                    [
+                        label_index
+                        for object_label_indices in label_indices.values()
+                        for label_index in object_label_indices
+                    ],
+                )
 
-                    m = workspace.measurements
-
-                    for category, feature_name, measurement in (
-                        (INTENSITY, INTEGRATED_INTENSITY, integrated_intensity),
-                        (INTENSITY, MEAN_INTENSITY, mean_intensity),
-                        (INTENSITY, STD_INTENSITY, std_intensity),
-                        (INTENSITY, MIN_INTENSITY, min_intensity),
-                        (INTENSITY, MAX_INTENSITY, max_intensity),
-                        (
-                            INTENSITY,
-                            INTEGRATED_INTENSITY_EDGE,
-                            integrated_intensity_edge,
-                        ),
-                        (INTENSITY, MEAN_INTENSITY_EDGE, mean_intensity_edge),
-                        (INTENSITY, STD_INTENSITY_EDGE, std_intensity_edge),
-                        (INTENSITY, MIN_INTENSITY_EDGE, min_intensity_edge),
-                        (INTENSITY, MAX_INTENSITY_EDGE, max_intensity_edge),
-                        (INTENSITY, MASS_DISPLACEMENT, mass_displacement),
-                        (INTENSITY, LOWER_QUARTILE_INTENSITY, lower_quartile_intensity),
-                        (INTENSITY, MEDIAN_INTENSITY, median_intensity),
-                        (INTENSITY, MAD_INTENSITY, mad_intensity),
-                        (INTENSITY, UPPER_QUARTILE_INTENSITY, upper_quartile_intensity),
-                        (C_LOCATION, LOC_CMI_X, cmi_x),
-                        (C_LOCATION, LOC_CMI_Y, cmi_y),
-                        (C_LOCATION, LOC_CMI_Z, cmi_z),
-                        (C_LOCATION, LOC_MAX_X, max_x),
-                        (C_LOCATION, LOC_MAX_Y, max_y),
-                        (C_LOCATION, LOC_MAX_Z, max_z),
+            for object_name in self.objects_list.value:
+                objects = workspace.object_set.get_objects(object_name)
+                nobjects = objects.count
+                measurements = {
+                    feature_name: numpy.zeros((len(channels), nobjects))
+                    for _, feature_name in features
+                }
+                pair_measurements = {
+                    feature_name: numpy.zeros((len(pairs), nobjects))
+                    for _, feature_name in pair_features
+                }
+                feature_names = [feature_name for _, feature_name in features]
+                if self.wants_tiles:
+                    #
+                    # The label indices of the tiles are not cached, they
+                    # would take as much memory as the label index of the
+                    # whole image.
+                    #
+                    for labels, lindexes, labels_mask in iter_labels(
+                        objects, img, image_mask, image.dimensions
                     ):
-                        measurement_name = "{}_{}_{}_c{}".format(
-                            category, feature_name, image_name, channel + 1
+                        plane_measurements = measure_object_tiles(
+                            img,
+                            labels,
+                            lindexes,
+                            labels_mask,
+                            image.dimensions,
+                            self.tile_size.value,
+                            feature_names,
+                            self.workers.value,
+                            pairs,
+                            ring_width,
+                            channels if len(channels) < nchannels else None,
+                            dtype,
+                        )
+                        for feature_name, values in plane_measurements.items():
+                            if feature_name in pair_measurements:
+                                pair_measurements[feature_name][
+                                    :, lindexes - 1
+                                ] = values.T
+                            else:
+                                measurements[feature_name][:, lindexes - 1] = values.T
+                else:
+                    for label_index in label_indices[object_name]:
+                        values = pixel_gather.get(label_index)
+                        plane_measurements = measure_channel_blocks(
+                            img,
+                            label_index,
+                            image.dimensions,
+                            feature_names,
+                            self.workers.value,
+                            values,
+                            pairs,
+                        )
+                        lindexes = label_index.lindexes
+                        for feature_name, value in plane_measurements.items():
+                            if feature_name in pair_measurements:
+                                pair_measurements[feature_name][
+                                    :, lindexes - 1
+                                ] = value.T
+                            else:
+                                measurements[feature_name][:, lindexes - 1] = value.T
+
+                m = workspace.measurements
+                for index, channel in enumerate(channels):
+                    for category, feature_name in features:
+                        measurement = measurements[feature_name][index]
+                        measurement_name = self.get_measurement_name(
+                            category, feature_name, image_name, channel
                         )
                         m.add_measurement(object_name, measurement_name, measurement)
                         if self.show_window and len(measurement) > 0:
@@ -643,6 +948,16 @@ class MeasureObjectIntensityMultichannel(Module):
                                     numpy.round(numpy.std(measurement), 3),
                                 )
                             )
+                for index, (first, second) in enumerate(channel_pairs):
+                    for category, feature_name in pair_features:
+                        measurement = pair_measurements[feature_name][index]
+                        measurement_name = "{}_{}_{}_c{}_c{}".format(
+                            category, feature_name, image_name, first + 1, second + 1
+                        )
+                        m.add_measurement(object_name, measurement_name, measurement)
+
+    def post_run(self, workspace):
+        label_index_cache.clear()
 
     def display(self, workspace, figure):
         figure.set_subplots((1, 1))
@@ -656,3 +971,1108 @@ class MeasureObjectIntensityMultichannel(Module):
 
     def volumetric(self):
         return False
+
+
+def parse_channel_pairs(text):
+    """Parse comma separated pairs of 1 based channel numbers
+
+    text - e.g. "1:2, 1:5"
+
+    returns a list of (first, second) channel numbers
+    """
+    pairs = []
+    for part in text.split(","):
+        part = part.strip()
+        if part == "":
+            continue
+        try:
+            first, second = part.split(":")
+            pairs.append((int(first), int(second)))
+        except ValueError:
+            raise ValueError(f"{part} is not a pair of channel numbers like 1:2")
+    return pairs
+
+
+def iter_labels(objects, pixels, mask, dimensions):
+    """Iterate over the labels matrices of an object set
+
+    objects - the object set
+    pixels - the (z, y, x, c) image stack to be measured
+    mask - the (z, y, x) image mask or None
+    dimensions - the dimensionality of the image
+
+    yields the (z, y, x) labels cropped to the image, the numbers of the
+    labels to be measured and the cropped mask or None
+    """
+    for labels, lindexes in objects.get_labels():
+        lindexes = lindexes[lindexes != 0]
+
+        if dimensions == 2:
+            labels = labels.reshape(1, *labels.shape)
+
+        labels, _ = crop_labels_and_image(labels, pixels)
+        if mask is not None:
+            _, cropped_mask = crop_labels_and_image(labels, mask)
+        else:
+            cropped_mask = None
+        yield labels, lindexes, cropped_mask
+
+
+class LabelIndex:
+    """Everything derived from a labels matrix to measure its objects
+
+    The masked pixels of all objects are ordered by label, such that the
+    pixels of an object are consecutive and every feature can be computed
+    as a reduction over the label segments of an (n_pixels, c) matrix.
+    The index holds the coordinates of these pixels, the pixel counts of
+    the objects, the edge pixels as well as the incidence matrices and the
+    sort layout of the segments. It only depends on the labels and the
+    image mask and is thus shared by all images and channels measured.
+    """
+
+    def __init__(self, labels, lindexes, mask=None, offset=(0, 0, 0), ring_width=0):
+        """Index the pixels of a labels matrix
+
+        labels - a (z, y, x) labels matrix
+        lindexes - the numbers of the labels to be measured
+        mask - a (z, y, x) mask of the pixels to be measured or None
+        offset - the (z, y, x) position of the labels matrix in the image,
+                 added to the coordinates of the location features
+        ring_width - the width of the inner and outer rings of the objects,
+                     0 to not index the rings
+        """
+        all_labels = labels
+        outlines = skimage.segmentation.find_boundaries(labels, mode="inner")
+        all_outlines = outlines.copy() if ring_width > 0 else outlines
+        if mask is not None:
+            labels = labels.copy()
+            labels[~mask] = 0
+            outlines[~mask] = False
+
+        self.lindexes = lindexes
+        nobjects = len(lindexes)
+        #
+        # Map the label numbers to their position in lindexes, labels that
+        # are not measured map to -1.
+        #
+        lookup = numpy.full(
+            max(all_labels.max(), numpy.max(lindexes, initial=0)) + 1, -1
+        )
+        lookup[lindexes] = numpy.arange(nobjects)
+        label_positions = lookup[labels]
+        lmask = label_positions >= 0
+
+        positions = label_positions[lmask]
+        order = numpy.argsort(positions, kind="stable")
+        self.npixels = len(positions)
+        self.counts = numpy.bincount(positions, minlength=nobjects)
+        self.segments = positions[order]
+        # z, y, x indices of the pixels ordered by label
+        self.coordinates = tuple(c[order] for c in numpy.nonzero(lmask))
+        # x, y, z coordinates of the pixels ordered by label
+        self.mesh = numpy.column_stack(self.coordinates[::-1]) + offset[::-1]
+        # Objects without pixels are located at the first pixel in raster order
+        self.first_pixel = self.mesh[numpy.argmin(order)] if self.npixels > 0 else None
+        self.incidence = label_incidence_matrix(self.counts)
+        self.layout = segment_sort_layout(self.counts)
+
+        self.edges = outlines[lmask][order]
+        self.ecounts = numpy.bincount(self.segments[self.edges], minlength=nobjects)
+        self.eincidence = label_incidence_matrix(self.ecounts)
+
+        self.ring_width = ring_width
+        if ring_width > 0:
+            self._index_rings(all_labels, all_outlines, mask, lmask, order, lookup)
+
+    def _index_rings(self, labels, outlines, mask, lmask, order, lookup):
+        """Index the inner and outer rings of the objects
+
+        The inner ring are the pixels of an object closer than the ring
+        width to its edge, a subset of the object pixels like the edges.
+        The outer ring are the background pixels within the ring width of
+        an object, each belonging to the closest object. Both are found
+        with one distance transform of the unmasked labels each.
+        """
+        nobjects = len(self.lindexes)
+        if numpy.any(outlines):
+            inner = scipy.ndimage.distance_transform_edt(~outlines) < self.ring_width
+            self.inner_ring = inner[lmask][order]
+        else:
+            self.inner_ring = numpy.zeros(self.npixels, bool)
+        self.icounts = numpy.bincount(
+            self.segments[self.inner_ring], minlength=nobjects
+        )
+        self.iincidence = label_incidence_matrix(self.icounts)
+
+        background = labels == 0
+        if numpy.any(background) and not numpy.all(background):
+            distances, indices = scipy.ndimage.distance_transform_edt(
+                background, return_indices=True
+            )
+            ring = background & (distances <= self.ring_width)
+            if mask is not None:
+                ring &= mask
+            closest = labels[tuple(index[ring] for index in indices)]
+            positions = lookup[closest]
+            measured = positions >= 0
+            positions = positions[measured]
+            ring_order = numpy.argsort(positions, kind="stable")
+            self.outer_coordinates = tuple(
+                c[measured][ring_order] for c in numpy.nonzero(ring)
+            )
+            self.ocounts = numpy.bincount(positions, minlength=nobjects)
+        else:
+            self.outer_coordinates = tuple(
+                numpy.zeros(0, int) for _ in range(labels.ndim)
+            )
+            self.ocounts = numpy.zeros(nobjects, int)
+        self.oincidence = label_incidence_matrix(self.ocounts)
+
+
+class LabelIndexCache:
+    """The label indices of the object sets of the current image set
+
+    Several images are often measured against the same object set, e.g.
+    a raw and a spillover corrected stack. The label indices are cached
+    by object set and image set number so that all these measurements
+    reuse them. The cache is dropped as soon as another image set is
+    measured. The label indices are held weakly by their object set, so
+    they are freed with the objects of the last image set as well, also
+    in worker processes that never run post_run.
+    """
+
+    def __init__(self):
+        self.image_set_number = None
+        self.entries = weakref.WeakKeyDictionary()
+
+    def get(
+        self,
+        image_set_number,
+        object_name,
+        objects,
+        pixels,
+        mask,
+        dimensions,
+        ring_width=0,
+    ):
+        """Get the label indices of an object set, computing them if needed
+
+        image_set_number - the number of the current image set
+        object_name - the name of the object set
+        objects - the object set
+        pixels - the (z, y, x, c) image stack to be measured
+        mask - the (z, y, x) image mask or None
+        dimensions - the dimensionality of the image
+        ring_width - the width of the rings to index, 0 for none
+
+        returns a list with a LabelIndex per labels matrix of the objects
+        """
+        if image_set_number != self.image_set_number:
+            self.clear()
+            self.image_set_number = image_set_number
+        if mask is None:
+            mask_digest = None
+        else:
+            mask_digest = hashlib.md5(numpy.packbits(mask)).hexdigest()
+        key = (object_name, pixels.shape[:-1], mask_digest, ring_width)
+        # The entries are looked up by the object set itself, another object
+        # set of the same name, e.g. when rerunning modules in test mode, is
+        # indexed anew.
+        entries = self.entries.setdefault(objects, {})
+        label_indices = entries.get(key)
+        if label_indices is None:
+            label_indices = [
+                LabelIndex(labels, lindexes, labels_mask, ring_width=ring_width)
+                for labels, lindexes, labels_mask in iter_labels(
+                    objects, pixels, mask, dimensions
+                )
+            ]
+            entries[key] = label_indices
+        return label_indices
+
+    def clear(self):
+        self.image_set_number = None
+        self.entries = weakref.WeakKeyDictionary()
+
+
+label_index_cache = LabelIndexCache()
+
+
+class PixelGather:
+    """The pixels of the objects of several label indices, gathered at once
+
+    Measuring e.g. nuclei, cells and cytoplasm against the same stack
+    gathers nested pixels several times. Instead, the union of the pixels
+    of all objects is read once per channel, in raster order, into a
+    channel-major buffer. Every label index then takes its rows from this
+    compact buffer. The values are channel-major as well, such that the
+    per-channel sorts and reductions run over contiguous memory.
+    """
+
+    def __init__(self, pixels, label_indices):
+        """Gather the pixels of the objects of label indices
+
+        pixels - a (z, y, x, c) image stack
+        label_indices - the LabelIndex of every labels matrix of every
+                        object set measured on the pixels
+        """
+        shape = pixels.shape[:-1]
+        nchannels = pixels.shape[-1]
+        flat_indices = [
+            numpy.ravel_multi_index(label_index.coordinates, shape)
+            for label_index in label_indices
+        ]
+        in_union = numpy.zeros(numpy.prod(shape), bool)
+        for indices in flat_indices:
+            in_union[indices] = True
+        union = numpy.flatnonzero(in_union)
+        channel_major = numpy.moveaxis(pixels, -1, 0)
+        if channel_major.flags.c_contiguous:
+            self.buffer = channel_major.reshape(nchannels, -1).take(union, axis=1)
+        else:
+            self.buffer = numpy.ascontiguousarray(
+                pixels.reshape(-1, nchannels).take(union, axis=0).T
+            )
+        self.rows = {
+            id(label_index): numpy.searchsorted(union, indices)
+            for label_index, indices in zip(label_indices, flat_indices)
+        }
+
+    def get(self, label_index):
+        """Get the (n_pixels, c) channel-major intensities of a label index"""
+        return self.buffer.take(self.rows[id(label_index)], axis=1).T
+
+
+def measure_object_intensities(
+    pixels, label_index, dimensions, features=None, values=None
+):
+    """Measure the intensity features of objects in all channels at once
+
+    pixels - a (z, y, x, c) image stack
+    label_index - the LabelIndex of the objects
+    dimensions - the dimensionality of the image, used for the MAD
+    features - the names of the features to measure, None for all of them.
+               The intermediate results of feature groups that are not
+               requested are not computed.
+    values - the (n_pixels, c) intensities of the pixels of label_index if
+             they are already gathered, e.g. by a PixelGather
+
+    returns a dictionary of feature name to a (len(lindexes), c) array
+    """
+    if features is None:
+        features = [feature_name for _, feature_name in ALL_FEATURES]
+    nobjects = len(label_index.lindexes)
+    nchannels = pixels.shape[-1]
+    result = {
+        feature_name: numpy.zeros((nobjects, nchannels))
+        for feature_name in [name for _, name in ALL_FEATURES] + RING_MEASUREMENTS
+        if feature_name in features
+    }
+    if label_index.npixels == 0 or len(result) == 0:
+        return result
+
+    if values is None:
+        values = pixels[label_index.coordinates]
+    #
+    # IMC channels are often without any signal in the objects of an image.
+    # Their measurements are the same for all of them and are computed once
+    # on a single zero channel.
+    #
+    zero_channels = ~numpy.any(values, axis=0)
+    if not numpy.any(zero_channels):
+        result.update(_measure_values(values, label_index, dimensions, features))
+    else:
+        for channels, channel_values in (
+            (zero_channels, numpy.zeros((len(values), 1))),
+            (~zero_channels, values[:, ~zero_channels]),
+        ):
+            if channel_values.shape[1] == 0:
+                continue
+            channel_result = _measure_values(
+                channel_values, label_index, dimensions, features
+            )
+            for feature_name, value in channel_result.items():
+                result[feature_name][:, channels] = value
+    #
+    # The outer rings are outside of the objects, so their channels can
+    # have signal even if the objects have none.
+    #
+    result.update(_measure_rings(pixels, values, label_index, features))
+    return result
+
+
+def _measure_rings(pixels, values, label_index, features):
+    """Measure the intensities of the inner and outer rings of objects
+
+    pixels - the (z, y, x, c) image stack
+    values - the (n_pixels, c) intensities of the pixels of label_index
+    label_index - the LabelIndex of the objects, indexed with a ring width
+    features - the names of the features to measure
+
+    returns a dictionary of feature name to a (len(lindexes), c) array.
+    Like for the edges, the mean of objects without ring pixels is NaN
+    unless no object has any.
+    """
+    features = set(features)
+    if label_index.ring_width == 0 or features.isdisjoint(RING_MEASUREMENTS):
+        return {}
+    result = {}
+    for (integrated, mean), counts, incidence, get_values in (
+        (
+            (INTEGRATED_INTENSITY_INNER_RING, MEAN_INTENSITY_INNER_RING),
+            label_index.icounts,
+            label_index.iincidence,
+            lambda: values[label_index.inner_ring],
+        ),
+        (
+            (INTEGRATED_INTENSITY_OUTER_RING, MEAN_INTENSITY_OUTER_RING),
+            label_index.ocounts,
+            label_index.oincidence,
+            lambda: pixels[label_index.outer_coordinates],
+        ),
+    ):
+        if features.isdisjoint((integrated, mean)) or not numpy.any(counts):
+            continue
+        total = incidence @ get_values()
+        result[integrated] = total
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            result[mean] = total / counts[:, numpy.newaxis]
+    return {
+        feature_name: value
+        for feature_name, value in result.items()
+        if feature_name in features
+    }
+
+
+def _measure_values(values, label_index, dimensions, features):
+    """Measure the intensity features of objects from their gathered pixels
+
+    values - the (n_pixels, c) intensities of the pixels of label_index
+    label_index - the LabelIndex of the objects, with at least one pixel
+    dimensions - the dimensionality of the image, used for the MAD
+    features - the names of the features to measure
+
+    returns a dictionary of feature name to a (len(lindexes), c) array
+    """
+    features = set(features)
+    wants_basic = not features.isdisjoint(BASIC_MEASUREMENTS)
+    wants_edge = not features.isdisjoint(EDGE_MEASUREMENTS)
+    wants_quantiles = not features.isdisjoint(QUANTILE_MEASUREMENTS)
+    wants_center_mass = not features.isdisjoint(
+        (MASS_DISPLACEMENT, LOC_CMI_X, LOC_CMI_Y, LOC_CMI_Z)
+    )
+    wants_max_position = not features.isdisjoint((LOC_MAX_X, LOC_MAX_Y, LOC_MAX_Z))
+
+    nobjects = len(label_index.lindexes)
+    nchannels = values.shape[1]
+    result = {}
+
+    counts = label_index.counts
+    segments = label_index.segments
+    mesh = label_index.mesh
+    incidence = label_index.incidence
+
+    #
+    # The count, sum and sum of squared deviations of the intensities, the
+    # coordinate sums and the coordinate weighted intensity sums of all
+    # channels are collected in one pass.
+    #
+    moments = ObjectMoments.from_segments(
+        values, counts, incidence, mesh if wants_center_mass else None
+    )
+
+    if wants_basic or wants_max_position:
+        basic = {
+            INTEGRATED_INTENSITY: moments.total,
+            MEAN_INTENSITY: moments.mean,
+            STD_INTENSITY: moments.std,
+        }
+        basic[MIN_INTENSITY], basic[MAX_INTENSITY] = _segment_extrema(values, counts)
+
+    #
+    # Compute the position of the intensity maximum, objects without
+    # pixels get the position of the first pixel in raster order.
+    #
+    if wants_max_position:
+        max_position = _segment_argmax(values, counts, basic[MAX_INTENSITY])
+        nonempty = counts[:, numpy.newaxis] > 0
+        for axis, feature_name in enumerate((LOC_MAX_X, LOC_MAX_Y, LOC_MAX_Z)):
+            result[feature_name] = numpy.where(
+                nonempty, mesh[max_position, axis], label_index.first_pixel[axis]
+            )
+
+    #
+    # The mass displacement is the distance between the center
+    # of mass of the binary image and of the intensity image. The
+    # center of mass is the average X or Y for the binary image
+    # and the sum of X or Y * intensity / integrated intensity
+    #
+    if wants_center_mass:
+        center_of_mass = moments.center_of_mass
+        intensity_center_of_mass = moments.intensity_center_of_mass
+        squared_displacement = numpy.zeros((nobjects, nchannels))
+        for axis, feature_name in enumerate((LOC_CMI_X, LOC_CMI_Y, LOC_CMI_Z)):
+            result[feature_name] = intensity_center_of_mass[:, axis]
+            diff = center_of_mass[:, axis, numpy.newaxis] - result[feature_name]
+            squared_displacement += diff * diff
+        result[MASS_DISPLACEMENT] = numpy.sqrt(squared_displacement)
+
+    if wants_basic:
+        result.update(basic)
+
+    #
+    # Sort the intensities within each label, for all channels at once.
+    # For each label, find the index above and below
+    # the 25%, 50% and 75% mark and take the weighted
+    # average.
+    #
+    if wants_quantiles:
+        (
+            result[LOWER_QUARTILE_INTENSITY],
+            result[MEDIAN_INTENSITY],
+            result[UPPER_QUARTILE_INTENSITY],
+        ) = _segment_quantiles(values, label_index, (1.0 / 4.0, 1.0 / 2.0, 3.0 / 4.0))
+
+        #
+        # Once again, for the MAD
+        #
+        madimg = numpy.abs(values - result[MEDIAN_INTENSITY][segments])
+        (result[MAD_INTENSITY],) = _segment_quantiles(
+            madimg, label_index, (1.0 / dimensions,)
+        )
+
+    edges = label_index.edges
+    if wants_edge and numpy.any(edges):
+        ecounts = label_index.ecounts
+        evalues = values[edges]
+        emoments = ObjectMoments.from_segments(evalues, ecounts, label_index.eincidence)
+        result[INTEGRATED_INTENSITY_EDGE] = emoments.total
+        result[MEAN_INTENSITY_EDGE] = emoments.mean
+        result[STD_INTENSITY_EDGE] = emoments.std
+        (
+            result[MIN_INTENSITY_EDGE],
+            result[MAX_INTENSITY_EDGE],
+        ) = _segment_extrema(evalues, ecounts)
+    return {
+        feature_name: value
+        for feature_name, value in result.items()
+        if feature_name in features
+    }
+
+
+class ObjectMoments:
+    """The intensity moments of objects in all channels
+
+    count - the number of pixels of each object
+    total - the (n, c) sums of the intensities
+    m2 - the (n, c) sums of the squared deviations from the mean intensity
+    weighted - the (n, 3, c) sums of the x, y and z coordinates times the
+               intensities or None
+    coordinates - the (n, 3) sums of the x, y and z coordinates or None
+    """
+
+    def __init__(self, count, total, m2, weighted=None, coordinates=None):
+        self.count = count
+        self.total = total
+        self.m2 = m2
+        self.weighted = weighted
+        self.coordinates = coordinates
+
+    @classmethod
+    def from_segments(cls, values, counts, incidence, mesh=None):
+        """Collect the moments of segments in one sparse-dense product
+
+        values - an (n, c) array ordered by segment
+        counts - the number of values in each segment
+        incidence - the incidence matrix of the segments
+        mesh - the (n, 3) x, y, z coordinates of the values or None to
+               skip the coordinate moments
+
+        The squared deviations are summed as deviations from the first
+        value of each segment, which is then corrected to the mean. This
+        shifted sum is exact for constant segments and does not lose
+        precision like the sum of squares when the mean is large compared
+        to the spread.
+        """
+        nchannels = values.shape[1]
+        starts = numpy.minimum(numpy.cumsum(counts) - counts, len(values) - 1)
+        segments = numpy.repeat(numpy.arange(len(counts)), counts)
+        deviations = values - values[starts][segments]
+        columns = [values, deviations, deviations * deviations]
+        if mesh is not None:
+            columns += [values * mesh[:, axis, numpy.newaxis] for axis in range(3)]
+            columns += [mesh]
+        sums = incidence @ numpy.hstack(columns)
+        total = sums[:, :nchannels]
+        shifted = sums[:, nchannels : 2 * nchannels]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            m2 = sums[:, 2 * nchannels : 3 * nchannels] - numpy.where(
+                counts[:, numpy.newaxis] > 0,
+                shifted * shifted / counts[:, numpy.newaxis],
+                0,
+            )
+        # Rounding can make the differences slightly negative
+        m2 = numpy.maximum(m2, 0)
+        if mesh is None:
+            return cls(counts, total, m2)
+        weighted = sums[:, 3 * nchannels : 6 * nchannels].reshape(-1, 3, nchannels)
+        return cls(counts, total, m2, weighted, sums[:, 6 * nchannels :])
+
+    @property
+    def mean(self):
+        return self.total / self.count[:, numpy.newaxis]
+
+    @property
+    def std(self):
+        return numpy.sqrt(self.m2 / self.count[:, numpy.newaxis])
+
+    @property
+    def center_of_mass(self):
+        """The (n, 3) x, y, z center of the pixels of each object"""
+        return self.coordinates / self.count[:, numpy.newaxis]
+
+    @property
+    def intensity_center_of_mass(self):
+        """The (n, 3, c) intensity weighted x, y, z center of each object
+
+        NaN for the channels without intensity in the object.
+        """
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            return self.weighted / self.total[:, numpy.newaxis, :]
+
+
+def measure_object_correlations(pixels, label_index, pairs, values=None):
+    """Measure the covariance and correlation of pairs of channels
+
+    Only the channels of the pairs are gathered. The co-moments of all
+    objects are collected like the moments of ObjectMoments, in one
+    sparse-dense product of the deviations and their pairwise products.
+    The deviations are taken from the first pixel of each object, so
+    constant channels have exactly no variance.
+
+    pixels - a (z, y, x, c) image stack
+    label_index - the LabelIndex of the objects
+    pairs - a list of pairs of channel positions in pixels
+    values - the (n_pixels, c) intensities of the pixels of label_index if
+             they are already gathered
+
+    returns a dictionary of feature name to a (len(lindexes), len(pairs))
+    array. Objects without pixels have a NaN covariance and correlation,
+    channels without variance within an object a NaN correlation.
+    """
+    nobjects = len(label_index.lindexes)
+    pairs = numpy.asarray(pairs, int).reshape(-1, 2)
+    result = {
+        feature_name: numpy.full((nobjects, len(pairs)), numpy.nan)
+        for feature_name in ALL_PAIR_MEASUREMENTS
+    }
+    if label_index.npixels == 0 or len(pairs) == 0:
+        return result
+    channels, pair_positions = numpy.unique(pairs, return_inverse=True)
+    first, second = pair_positions.reshape(pairs.shape).T
+    if values is None:
+        z, y, x = (c[:, numpy.newaxis] for c in label_index.coordinates)
+        values = pixels[z, y, x, channels]
+    else:
+        values = values[:, channels]
+    counts = label_index.counts
+    nchannels = len(channels)
+    starts = numpy.minimum(numpy.cumsum(counts) - counts, len(values) - 1)
+    segments = numpy.repeat(numpy.arange(len(counts)), counts)
+    deviations = values - values[starts][segments]
+    sums = label_index.incidence @ numpy.hstack(
+        [
+            deviations,
+            deviations * deviations,
+            deviations[:, first] * deviations[:, second],
+        ]
+    )
+    shifted = sums[:, :nchannels]
+    nonempty = counts > 0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        mean_shifted = shifted / counts[:, numpy.newaxis]
+        # Rounding can make the variances slightly negative
+        variances = numpy.maximum(
+            sums[:, nchannels : 2 * nchannels] - shifted * mean_shifted, 0
+        )
+        comoments = (
+            sums[:, 2 * nchannels :] - shifted[:, first] * mean_shifted[:, second]
+        )
+        covariances = comoments / counts[:, numpy.newaxis]
+        correlations = numpy.clip(
+            comoments / numpy.sqrt(variances[:, first] * variances[:, second]),
+            -1,
+            1,
+        )
+    result[COVARIANCE][nonempty] = covariances[nonempty]
+    result[CORRELATION][nonempty] = correlations[nonempty]
+    return result
+
+
+def measure_channel_blocks(
+    pixels, label_index, dimensions, features=None, workers=1, values=None, pairs=()
+):
+    """Measure blocks of channels in parallel threads
+
+    The features of a channel do not depend on the other channels, such
+    that the channels can be split into contiguous blocks that are
+    measured independently. The blocks are concatenated in channel order,
+    so the result does not depend on the number of workers. The channel
+    pairs are split into blocks as well, which are correlated by the same
+    threads.
+
+    pixels - a (z, y, x, c) image stack
+    label_index - the LabelIndex of the objects
+    dimensions - the dimensionality of the image, used for the MAD
+    features - the names of the features to measure, None for all of them
+    workers - the number of threads
+    values - the (n_pixels, c) intensities of the pixels of label_index if
+             they are already gathered
+    pairs - the pairs of channel positions in pixels to correlate
+
+    returns a dictionary of feature name to a (len(lindexes), c) array and,
+    if pairs are given, of the pair feature names to a (len(lindexes),
+    len(pairs)) array
+    """
+    pairs = list(pairs)
+    nchannels = pixels.shape[-1]
+    nblocks = min(workers, nchannels)
+    if nblocks <= 1:
+        result = measure_object_intensities(
+            pixels, label_index, dimensions, features, values
+        )
+        if len(pairs) > 0:
+            result.update(
+                measure_object_correlations(pixels, label_index, pairs, values)
+            )
+        return result
+    bounds = numpy.linspace(0, nchannels, nblocks + 1).astype(int)
+    pair_bounds = numpy.linspace(0, len(pairs), min(nblocks, len(pairs)) + 1)
+    pair_bounds = pair_bounds.astype(int)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nblocks) as executor:
+        pair_futures = [
+            executor.submit(
+                measure_object_correlations,
+                pixels,
+                label_index,
+                pairs[start:stop],
+                values,
+            )
+            for start, stop in zip(pair_bounds[:-1], pair_bounds[1:])
+        ]
+        results = list(
+            executor.map(
+                lambda block: measure_object_intensities(
+                    pixels[..., block[0] : block[1]],
+                    label_index,
+                    dimensions,
+                    features,
+                    None if values is None else values[:, block[0] : block[1]],
+                ),
+                zip(bounds[:-1], bounds[1:]),
+            )
+        )
+        pair_results = [future.result() for future in pair_futures]
+    return {
+        feature_name: numpy.concatenate(
+            [block_result[feature_name] for block_result in block_results], axis=1
+        )
+        for block_results in (results, pair_results)
+        if len(block_results) > 0
+        for feature_name in block_results[0]
+    }
+
+
+def iter_label_index_tiles(labels, lindexes, mask, tile_size, ring_width=0):
+    """Split the objects of a labels matrix into tiles
+
+    Every object belongs to the tile of the y, x origin of its bounding
+    box. The region of a tile covers the bounding boxes of its objects plus
+    one pixel, such that the objects and their edges are the same as in the
+    whole labels matrix. With rings, the region also covers twice the ring
+    width, the outer ring plus the objects that can be closer to its pixels.
+
+    labels - a (z, y, x) labels matrix
+    lindexes - the numbers of the labels to be measured
+    mask - a (z, y, x) mask of the pixels to be measured or None
+    tile_size - the width and height of the tiles
+    ring_width - the width of the rings to index, 0 for none
+
+    yields the (z, y, x) region of the tile, the positions of its objects
+    in lindexes and their LabelIndex
+    """
+    shape = labels.shape
+    bounding_boxes = scipy.ndimage.find_objects(labels)
+    starts = numpy.zeros((len(lindexes), 2), int)
+    stops = numpy.zeros((len(lindexes), 2), int)
+    for position, lindex in enumerate(lindexes):
+        if lindex <= len(bounding_boxes) and bounding_boxes[lindex - 1] is not None:
+            bounding_box = bounding_boxes[lindex - 1]
+            starts[position] = [s.start for s in bounding_box[1:]]
+            stops[position] = [s.stop for s in bounding_box[1:]]
+    tiles = starts // tile_size
+    ntiles_x = (shape[2] + tile_size - 1) // tile_size
+    tile_numbers = tiles[:, 0] * ntiles_x + tiles[:, 1]
+    order = numpy.argsort(tile_numbers, kind="stable")
+    tile_numbers, tile_starts = numpy.unique(tile_numbers[order], return_index=True)
+    for positions in numpy.split(order, tile_starts[1:]):
+        margin = 1 + 2 * ring_width
+        start = numpy.maximum(starts[positions].min(axis=0) - margin, 0)
+        stop = numpy.minimum(stops[positions].max(axis=0) + margin, shape[1:])
+        region = (
+            slice(None),
+            slice(start[0], stop[0]),
+            slice(start[1], stop[1]),
+        )
+        yield region, positions, LabelIndex(
+            labels[region],
+            lindexes[positions],
+            None if mask is None else mask[region],
+            (0, start[0], start[1]),
+            ring_width,
+        )
+
+
+def measure_object_tiles(
+    pixels,
+    labels,
+    lindexes,
+    mask,
+    dimensions,
+    tile_size,
+    features=None,
+    workers=1,
+    pairs=(),
+    ring_width=0,
+    channels=None,
+    dtype=None,
+):
+    """Measure the objects of a labels matrix tile by tile
+
+    Only the label index and the pixels of one tile are held in memory at a
+    time. Every object is measured as a whole in one tile, so the
+    measurements are the same as those of measure_object_intensities on the
+    whole image. The channels are selected and converted tile by tile as
+    well, the image itself is not copied.
+
+    pixels - a (z, y, x, c) image stack
+    labels - a (z, y, x) labels matrix
+    lindexes - the numbers of the labels to be measured
+    mask - a (z, y, x) mask of the pixels to be measured or None
+    dimensions - the dimensionality of the image, used for the MAD
+    tile_size - the width and height of the tiles
+    features - the names of the features to measure, None for all of them
+    workers - the number of threads per tile
+    pairs - the pairs of positions in the measured channels to correlate
+    ring_width - the width of the rings, 0 to not measure them
+    channels - the positions of the channels in pixels to measure or None
+               for all of them
+    dtype - the dtype to convert the pixels to or None to keep theirs
+
+    returns a dictionary of feature name to a (len(lindexes), c) array and,
+    if pairs are given, of the pair feature names to a (len(lindexes),
+    len(pairs)) array
+    """
+    if features is None:
+        features = [feature_name for _, feature_name in ALL_FEATURES]
+    nobjects = len(lindexes)
+    nchannels = pixels.shape[-1] if channels is None else len(channels)
+    result = {
+        feature_name: numpy.zeros((nobjects, nchannels)) for feature_name in features
+    }
+    if len(pairs) > 0:
+        result.update(
+            {
+                feature_name: numpy.full((nobjects, len(pairs)), numpy.nan)
+                for feature_name in ALL_PAIR_MEASUREMENTS
+            }
+        )
+    counts = numpy.zeros(nobjects, int)
+    ecounts = numpy.zeros(nobjects, int)
+    icounts = numpy.zeros(nobjects, int)
+    ocounts = numpy.zeros(nobjects, int)
+    first_pixel = None
+    for region, positions, label_index in iter_label_index_tiles(
+        labels, lindexes, mask, tile_size, ring_width
+    ):
+        tile = pixels[region]
+        if channels is not None:
+            tile = tile[..., channels]
+        if dtype is not None:
+            tile = tile.astype(dtype, copy=False)
+        tile_result = measure_channel_blocks(
+            tile, label_index, dimensions, features, workers, pairs=pairs
+        )
+        for feature_name, values in tile_result.items():
+            result[feature_name][positions] = values
+        counts[positions] = label_index.counts
+        ecounts[positions] = label_index.ecounts
+        if ring_width > 0:
+            icounts[positions] = label_index.icounts
+            ocounts[positions] = label_index.ocounts
+        if label_index.first_pixel is not None and (
+            first_pixel is None
+            or tuple(label_index.first_pixel[::-1]) < tuple(first_pixel[::-1])
+        ):
+            first_pixel = label_index.first_pixel
+    #
+    # Objects without pixels or edge pixels are measured like in the
+    # whole image, even if all objects of their tile are empty.
+    #
+    if first_pixel is not None:
+        empty = counts == 0
+        for feature_name, value in (
+            (INTEGRATED_INTENSITY, 0),
+            (MEAN_INTENSITY, numpy.nan),
+            (STD_INTENSITY, numpy.nan),
+            (MIN_INTENSITY, 0),
+            (MAX_INTENSITY, 0),
+            (MASS_DISPLACEMENT, numpy.nan),
+            (LOWER_QUARTILE_INTENSITY, 0),
+            (MEDIAN_INTENSITY, 0),
+            (MAD_INTENSITY, 0),
+            (UPPER_QUARTILE_INTENSITY, 0),
+            (LOC_CMI_X, numpy.nan),
+            (LOC_CMI_Y, numpy.nan),
+            (LOC_CMI_Z, numpy.nan),
+            (LOC_MAX_X, first_pixel[0]),
+            (LOC_MAX_Y, first_pixel[1]),
+            (LOC_MAX_Z, first_pixel[2]),
+        ):
+            if feature_name in result:
+                result[feature_name][empty] = value
+    if numpy.any(ecounts):
+        empty = ecounts == 0
+        for feature_name, value in (
+            (INTEGRATED_INTENSITY_EDGE, 0),
+            (MEAN_INTENSITY_EDGE, numpy.nan),
+            (STD_INTENSITY_EDGE, numpy.nan),
+            (MIN_INTENSITY_EDGE, 0),
+            (MAX_INTENSITY_EDGE, 0),
+        ):
+            if feature_name in result:
+                result[feature_name][empty] = value
+    for ring_counts, feature_name in (
+        (icounts, MEAN_INTENSITY_INNER_RING),
+        (ocounts, MEAN_INTENSITY_OUTER_RING),
+    ):
+        if numpy.any(ring_counts) and feature_name in result:
+            result[feature_name][ring_counts == 0] = numpy.nan
+    return result
+
+
+def label_incidence_matrix(counts):
+    """Objects x pixels incidence matrix of pixels ordered by label
+
+    counts - the number of pixels of each object, the pixels of an object
+             being consecutive
+
+    returns a CSR matrix with a 1 for each pixel of each object, such that
+    a product with an (n_pixels, c) matrix sums the pixels of each object
+    for all c columns at once.
+    """
+    indptr = numpy.zeros(len(counts) + 1, dtype=int)
+    numpy.cumsum(counts, out=indptr[1:])
+    npixels = indptr[-1]
+    return scipy.sparse.csr_matrix(
+        (numpy.ones(npixels), numpy.arange(npixels), indptr),
+        shape=(len(counts), npixels),
+    )
+
+
+def _segment_extrema(values, counts):
+    """Minimum and maximum of segments
+
+    values - an (n, c) array ordered by segment
+    counts - the number of values in each segment
+
+    Empty segments have a minimum and maximum of zero and NaNs are only
+    reported as the minimum if all values are NaN, like the scipy.ndimage
+    functions.
+    """
+    minimum = numpy.zeros((len(counts), values.shape[1]))
+    maximum = numpy.zeros((len(counts), values.shape[1]))
+    nonempty = counts > 0
+    if numpy.any(nonempty):
+        starts = (numpy.cumsum(counts) - counts)[nonempty]
+        minimum[nonempty] = numpy.fmin.reduceat(values, starts, axis=0)
+        maximum[nonempty] = numpy.maximum.reduceat(values, starts, axis=0)
+    return minimum, maximum
+
+
+def _segment_argmax(values, counts, maximum):
+    """Index of the first maximal value of each segment
+
+    values - an (n, c) array ordered by segment
+    counts - the number of values in each segment
+    maximum - the (len(counts), c) maxima of the segments
+
+    returns a (len(counts), c) array of indices into values, 0 for
+    empty segments. Ties resolve to the first value of the segment.
+    """
+    segments = numpy.repeat(numpy.arange(len(counts)), counts)
+    hits = values == maximum[segments]
+    if numpy.any(numpy.isnan(maximum)):
+        hits |= numpy.isnan(values) & numpy.isnan(maximum[segments])
+    index = numpy.where(hits, numpy.arange(len(values))[:, numpy.newaxis], len(values))
+    position = numpy.zeros(maximum.shape, dtype=int)
+    nonempty = counts > 0
+    if numpy.any(nonempty):
+        starts = (numpy.cumsum(counts) - counts)[nonempty]
+        position[nonempty] = numpy.minimum.reduceat(index, starts, axis=0)
+    return position
+
+
+def segment_sort_layout(counts):
+    """Layout to sort consecutive segments of values in size buckets
+
+    counts - the number of values in each segment
+
+    The segments are grouped into buckets of segments with up to a power
+    of two values. The values of the segments of a bucket are laid out as
+    the rows of a (n_segments, width) block padded with NaN, such that
+    they can be sorted along the rows for all channels at once while wasting
+    at most half of the block.
+
+    returns a list of (width, rows, columns, indices) tuples, placing the
+    values at indices at the given rows and columns of a bucket block.
+    """
+    layout = []
+    nonempty = counts > 0
+    starts = numpy.cumsum(counts) - counts
+    widths = numpy.ones(len(counts), dtype=int)
+    widths[nonempty] = 2 ** numpy.ceil(numpy.log2(counts[nonempty])).astype(int)
+    for width in numpy.unique(widths[nonempty]):
+        members = numpy.flatnonzero(nonempty & (widths == width))
+        member_counts = counts[members]
+        rows = numpy.repeat(numpy.arange(len(members)), member_counts)
+        row_starts = numpy.cumsum(member_counts) - member_counts
+        columns = numpy.arange(len(rows)) - row_starts[rows]
+        indices = starts[members][rows] + columns
+        layout.append((width, rows, columns, indices))
+    return layout
+
+
+def _sort_segments(values, layout):
+    """Sort the values within each segment for all channels at once
+
+    values - an (n, c) array ordered by segment
+    layout - the segment layout from segment_sort_layout
+
+    NaNs are sorted to the end of their segment.
+    """
+    sorted_values = numpy.empty_like(values)
+    for width, rows, columns, indices in layout:
+        block = numpy.full(
+            (rows[-1] + 1, width, values.shape[1]), numpy.nan, dtype=values.dtype
+        )
+        block[rows, columns] = values[indices]
+        block.sort(axis=1)
+        sorted_values[indices] = block[rows, columns]
+    return sorted_values
+
+
+def _segment_quantiles(values, label_index, fractions):
+    """Interpolated quantiles of the segments of a label index
+
+    values - an (n, c) array ordered by segment
+    label_index - the LabelIndex of the segments
+    fractions - the quantiles to compute
+
+    Channels that are mostly zero and not negative are sorted without their
+    zeros, which come first in each segment, see _segment_quantile_with_zeros.
+
+    returns a list with a (len(counts), c) array per fraction
+    """
+    counts = label_index.counts
+    quantiles = [numpy.zeros((len(counts), values.shape[1])) for _ in fractions]
+    nonzero = values != 0
+    sparse = (numpy.count_nonzero(nonzero, axis=0) <= len(values) // 2) & ~numpy.any(
+        values < 0, axis=0
+    )
+    dense = ~sparse
+    if numpy.any(dense):
+        sorted_values = _sort_segments(values[:, dense], label_index.layout)
+        for quantile, fraction in zip(quantiles, fractions):
+            quantile[:, dense] = _segment_quantile(sorted_values, counts, fraction)
+    for channel in numpy.flatnonzero(sparse):
+        channel_nonzero = nonzero[:, channel]
+        nonzero_counts = numpy.bincount(
+            label_index.segments[channel_nonzero], minlength=len(counts)
+        )
+        sorted_nonzero = _sort_segments(
+            values[channel_nonzero, channel, numpy.newaxis],
+            segment_sort_layout(nonzero_counts),
+        )
+        for quantile, fraction in zip(quantiles, fractions):
+            quantile[:, channel] = _segment_quantile_with_zeros(
+                sorted_nonzero[:, 0], nonzero_counts, counts, fraction
+            )
+    return quantiles
+
+
+def _segment_quantile_with_zeros(sorted_nonzero, nonzero_counts, counts, fraction):
+    """Interpolated quantile of segments of zeros and positive values
+
+    sorted_nonzero - the nonzero values ordered by segment and sorted within
+                     each segment
+    nonzero_counts - the number of nonzero values in each segment
+    counts - the number of values in each segment, including the zeros
+    fraction - the quantile to compute
+
+    The sorted segments start with their zeros, so the value at a position
+    of a segment is zero or is looked up in the sorted nonzero values.
+    The quantile is the same as the one of _segment_quantile.
+    """
+    quantile = numpy.zeros(len(counts))
+    zeros = counts - nonzero_counts
+    nonzero_starts = numpy.cumsum(nonzero_counts) - nonzero_counts
+    indices = numpy.cumsum(counts) - counts
+    qindex = indices.astype(float) + counts * fraction
+    qfraction = qindex - numpy.floor(qindex)
+    qindex = qindex.astype(int) - indices
+
+    def value_at(mask, position):
+        value = numpy.zeros(numpy.count_nonzero(mask))
+        nonzero = position >= zeros[mask]
+        value[nonzero] = sorted_nonzero[
+            nonzero_starts[mask][nonzero] + position[nonzero] - zeros[mask][nonzero]
+        ]
+        return value
+
+    qmask = qindex < counts - 1
+    qi = qindex[qmask]
+    qf = qfraction[qmask]
+    quantile[qmask] = value_at(qmask, qi) * (1 - qf) + value_at(qmask, qi + 1) * qf
+    qmask = (~qmask) & (counts > 0)
+    quantile[qmask] = value_at(qmask, qindex[qmask])
+    return quantile
+
+
+def _segment_quantile(sorted_values, counts, fraction):
+    """Interpolated quantile of each segment
+
+    sorted_values - an (n, c) array ordered by segment and sorted within
+                    each segment
+    counts - the number of values in each segment
+    fraction - the quantile to compute
+
+    For each segment, the values below and above the fraction mark are
+    averaged, weighted by their distance to the mark. Empty segments are 0.
+    """
+    quantile = numpy.zeros((len(counts), sorted_values.shape[1]))
+    indices = numpy.cumsum(counts) - counts
+    qindex = indices.astype(float) + counts * fraction
+    qfraction = qindex - numpy.floor(qindex)
+    qindex = qindex.astype(int)
+    qmask = qindex < indices + counts - 1
+    qi = qindex[qmask]
+    qf = qfraction[qmask, numpy.newaxis]
+    quantile[qmask] = sorted_values[qi] * (1 - qf) + sorted_values[qi + 1] * qf
+    #
+    # In some situations (e.g., only 3 points), there may
+    # not be an upper bound.
+    #
+    qmask = (~qmask) & (counts > 0)
+    quantile[qmask] = sorted_values[qindex[qmask]]
+    return quantile
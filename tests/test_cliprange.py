@@ -78,3 +78,37 @@ def test_clip_multichan():
     module.run(workspace)
     result = workspace.image_set.get_image(OUTPUT_IMAGE_NAME).pixel_data
     np.testing.assert_almost_equal(result.max(axis=(0, 1)), maxvals)
+
+
+def test_clip_float32():
+    img = np.reshape(np.arange(1, 201.0) / 200, (10, 10, 2), order="F")
+    expected = C.clip_percentile(img, 0.95)
+    result = C.clip_percentile(img, 0.95, C.PRECISION_FLOAT32)
+    assert result.dtype == np.float32
+    np.testing.assert_array_equal(result, expected.astype(np.float32))
+
+
+def test_clip_counts():
+    """
+    Images of counts are clipped at the same percentiles from the
+    histograms of the counts
+    """
+    np.random.seed(0)
+    counts = np.random.poisson(2, size=(40, 50, 3))
+    img = counts.astype(np.float32) / np.float32(65535)
+    assert C._count_percentiles(img, 0.95, 65535) is not None
+    expected = C.clip_percentile(img, 0.95, C.PRECISION_FLOAT32)
+    result = C.clip_percentile(img, 0.95, C.PRECISION_FLOAT32, scale=65535)
+    np.testing.assert_array_equal(result, expected)
+    result = C.clip_percentile(counts[:, :, 0].astype(float), 0.95, scale=1)
+    np.testing.assert_array_equal(
+        result, C.clip_percentile(counts[:, :, 0].astype(float), 0.95)
+    )
+    # Not counts
+    assert C._count_percentiles(img + 0.5, 0.95, 65535) is None
+
+
+def test_clip_keeps_dtype():
+    img = np.reshape(np.arange(1, 201.0) / 200, (10, 10, 2), order="F")
+    result = C.clip_percentile(img.astype(np.float32), 0.95)
+    assert result.dtype == np.float32
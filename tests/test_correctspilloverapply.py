@@ -1,4 +1,7 @@
+import concurrent.futures
+
 import numpy as np
+import scipy.optimize as spo
 import pytest
 import io
 from dataclasses import dataclass
@@ -18,6 +21,7 @@ IMAGE_NAME = "image"
 SM_IMAGE_NAME = "sm"
 OUTPUT_IMAGE = "outputimage"
 
+import plugins._spillover as spillover
 import plugins.correctspilloverapply as correctspilloverapply
 
 
@@ -72,7 +76,11 @@ def test_init(module):
 
 
 @pytest.fixture(
-    params=[correctspilloverapply.METHOD_LS, correctspilloverapply.METHOD_NNLS]
+    params=[
+        correctspilloverapply.METHOD_LS,
+        correctspilloverapply.METHOD_NNLS,
+        correctspilloverapply.METHOD_APPROXIMATE_NNLS,
+    ]
 )
 def method(request):
     return request.param
@@ -116,7 +124,7 @@ def testcase(request, method):
                 [[0.0, 0.0], [0.0, 0.0], [0.0, 0.0]],
             ]
         )
-        if method == correctspilloverapply.METHOD_NNLS:
+        if method != correctspilloverapply.METHOD_LS:
             expected[0, 0, 1] = 0
             expected[0, 0, 0] = 0.990099
 
@@ -158,6 +166,26 @@ def test_compensate_image_ls(method):
     np.testing.assert_array_almost_equal(out, expected)
 
 
+def test_compensate_image_ls_float32(method):
+    rng = np.random.default_rng(0)
+    img = rng.random((10, 12, 3))
+    sm = np.eye(3) + rng.random((3, 3)) * 0.05
+    out64 = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, method
+    )
+    out32 = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, method, correctspilloverapply.PRECISION_FLOAT32
+    )
+    assert out64.dtype == np.float64
+    assert out32.dtype == np.float32
+    np.testing.assert_allclose(out32, out64, rtol=1e-5, atol=1e-6)
+    # By default the image keeps its precision
+    out = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img.astype(np.float32), sm, method
+    )
+    assert out.dtype == np.float32
+
+
 def test_compensate_image(testcase, image, sm_image, module, workspace):
     image.pixel_data = testcase.img
     sm_image.pixel_data = testcase.sm
@@ -169,3 +197,213 @@ def test_compensate_image(testcase, image, sm_image, module, workspace):
     result = workspace.image_set.get_image(OUTPUT_IMAGE).pixel_data
 
     np.testing.assert_array_almost_equal(testcase.expected, result)
+
+
+def test_compensate_nnls():
+    rng = np.random.default_rng(0)
+    sm = np.eye(5) + np.diag(rng.uniform(0, 0.05, 4), 1) + rng.random((5, 5)) * 0.01
+    dat = rng.poisson(1.0, (500, 5)).astype(float)
+    dat[:100] = 0
+    out = correctspilloverapply.compensate_nnls(dat, sm, block_size=64)
+    expected = np.array([spo.nnls(sm.T, x)[0] for x in dat])
+    assert (out >= 0).all()
+    np.testing.assert_allclose(out, expected, atol=1e-7)
+    # The coordinate descent falls back to scipy for unconverged pixels
+    out = correctspilloverapply.compensate_nnls(dat, sm, max_sweeps=1)
+    np.testing.assert_allclose(out, expected, atol=1e-7)
+
+
+def test_unique_pixels():
+    rng = np.random.default_rng(0)
+    dat = rng.poisson(0.3, (2000, 4)).astype(float)
+    index, inverse = correctspilloverapply.unique_pixels(dat)
+    assert len(index) == len(np.unique(dat, axis=0))
+    np.testing.assert_array_equal(dat[index][inverse], dat)
+
+
+def test_compensate_image_unique(method):
+    rng = np.random.default_rng(0)
+    img = rng.poisson(0.5, (10, 12, 3)).astype(float)
+    sm = np.eye(3) + rng.random((3, 3)) * 0.05
+    expected = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, method
+    )
+    out = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, method, unique=True
+    )
+    np.testing.assert_allclose(out, expected, atol=1e-12)
+    assert (out[img.sum(axis=2) == 0] == 0).all()
+
+
+def test_factorization_cache():
+    rng = np.random.default_rng(0)
+    sm = np.eye(4) + rng.random((4, 4)) * 0.05
+    cache = spillover.FactorizationCache(max_entries=2)
+    factorization = cache.get(sm, correctspilloverapply.METHOD_NNLS)
+    assert cache.get(sm.copy(), correctspilloverapply.METHOD_NNLS) is factorization
+    assert cache.get(sm, correctspilloverapply.METHOD_LS) is not factorization
+    np.testing.assert_allclose(factorization["ata"], sm @ sm.T)
+    dat = rng.random((100, 4))
+    np.testing.assert_allclose(
+        dat @ factorization["pinv"], np.linalg.lstsq(sm.T, dat.T, rcond=None)[0].T
+    )
+    # The least recently used matrix is dropped
+    cache.get(sm * 2, correctspilloverapply.METHOD_LS)
+    assert cache.get(sm, correctspilloverapply.METHOD_NNLS) is not factorization
+
+
+def test_compensate_image_threads(method):
+    rng = np.random.default_rng(0)
+    img = rng.poisson(0.5, (100, 100, 3)).astype(float)
+    sm = np.eye(3) + rng.random((3, 3)) * 0.05
+    expected = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, method
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        out = correctspilloverapply.compensate_chunks(
+            img.reshape(-1, 3), sm, method, executor, chunk_size=4096
+        )
+    np.testing.assert_array_equal(out.reshape(img.shape), expected)
+
+
+@pytest.mark.parametrize(
+    "precision",
+    [correctspilloverapply.PRECISION_FLOAT64, correctspilloverapply.PRECISION_FLOAT32],
+)
+@pytest.mark.parametrize("tile_rows", [1, 7, 64])
+def test_compensate_image_tiles(precision, tile_rows):
+    rng = np.random.default_rng(0)
+    img = rng.poisson(2, (64, 70, 12)).astype(float)
+    sm = np.eye(12) + rng.random((12, 12)) * 0.05
+    expected = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, correctspilloverapply.METHOD_LS, precision
+    )
+    out = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+        img, sm, correctspilloverapply.METHOD_LS, precision, tile_rows=tile_rows
+    )
+    assert out.dtype == expected.dtype
+    np.testing.assert_array_equal(out, expected)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        out = correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+            img,
+            sm,
+            correctspilloverapply.METHOD_NNLS,
+            precision,
+            executor=executor,
+            tile_rows=tile_rows,
+        )
+    np.testing.assert_allclose(
+        out,
+        correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+            img, sm, correctspilloverapply.METHOD_NNLS, precision
+        ),
+        atol=1e-5,
+    )
+
+
+def test_dot_blocks():
+    rng = np.random.default_rng(0)
+    dat = rng.random((10000, 7))
+    mat = rng.random((7, 7))
+    expected = correctspilloverapply.dot_blocks(dat, mat)
+    np.testing.assert_allclose(expected, np.dot(dat, mat))
+    for start, stop in [(0, 1), (3, 5), (4095, 4097), (17, 9000)]:
+        np.testing.assert_array_equal(
+            correctspilloverapply.dot_blocks(dat[start:stop], mat),
+            expected[start:stop],
+        )
+
+
+def test_workers(image, sm_image, module, workspace):
+    rng = np.random.default_rng(0)
+    image.pixel_data = rng.random((10, 12, 2))
+    sm_image.pixel_data = np.asarray([[1, 0.1], [0, 1]])
+    module.images[0].workers.value = 2
+    assert module.prepare_run(workspace)
+    executor = module.executor
+    assert executor is not None
+    module.run(workspace)
+    assert module.executor is executor
+    module.post_run(workspace)
+    assert module.executor is None
+    result = workspace.image_set.get_image(OUTPUT_IMAGE).pixel_data
+    np.testing.assert_array_almost_equal(
+        result,
+        correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+            image.pixel_data,
+            sm_image.pixel_data,
+            module.images[0].spill_correct_method.value,
+        ),
+    )
+
+
+def test_tiles(image, sm_image, module, workspace):
+    rng = np.random.default_rng(0)
+    image.pixel_data = rng.random((10, 12, 2))
+    sm_image.pixel_data = np.asarray([[1, 0.1], [0, 1]])
+    module.images[0].spill_correct_method.value = correctspilloverapply.METHOD_LS
+    module.images[0].wants_tiles.value = True
+    module.images[0].tile_rows.value = 3
+    assert module.images[0].tile_rows in module.visible_settings()
+    module.run(workspace)
+    result = workspace.image_set.get_image(OUTPUT_IMAGE).pixel_data
+    np.testing.assert_array_almost_equal(
+        result,
+        correctspilloverapply.CorrectSpilloverApply.compensate_image_ls(
+            image.pixel_data,
+            sm_image.pixel_data,
+            module.images[0].spill_correct_method.value,
+        ),
+    )
+
+
+def test_approximate_nnls():
+    rng = np.random.default_rng(0)
+    sm = np.eye(5) + np.diag(rng.uniform(0, 0.05, 4), 1) + rng.random((5, 5)) * 0.01
+    dat = rng.poisson(1.0, (500, 5)).astype(float)
+    expected = np.array([spo.nnls(sm.T, x)[0] for x in dat])
+    residuals = np.sum((expected @ sm - dat) ** 2, axis=1)
+    out = correctspilloverapply.compensate_dat(
+        dat, sm, correctspilloverapply.METHOD_APPROXIMATE_NNLS
+    )
+    assert (out >= 0).all()
+    gaps, out_residuals = correctspilloverapply.residual_gaps(dat, out, sm)
+    np.testing.assert_allclose(out_residuals, np.sum((out @ sm - dat) ** 2, axis=1))
+    # The gap bounds the excess over the exact residuals
+    assert (gaps >= out_residuals - residuals - 1e-10).all()
+    gaps, _ = correctspilloverapply.residual_gaps(dat, expected, sm)
+    np.testing.assert_allclose(gaps, 0, atol=1e-10)
+    clipped = np.maximum(dat @ np.linalg.inv(sm), 0)
+    assert (
+        correctspilloverapply.residual_gaps(dat, clipped, sm)[0].sum() > gaps.sum()
+    )
+
+
+def test_residual_gap_measurements(image, sm_image, module, workspace):
+    rng = np.random.default_rng(0)
+    image.pixel_data = rng.poisson(1.0, (10, 12, 2)).astype(float)
+    sm_image.pixel_data = np.asarray([[1, 0.1], [0.05, 1]])
+    module.images[0].spill_correct_method.value = (
+        correctspilloverapply.METHOD_APPROXIMATE_NNLS
+    )
+    # The image is loaded in single precision, compare the gaps in double
+    module.images[0].precision.value = correctspilloverapply.PRECISION_FLOAT64
+    columns = module.get_measurement_columns(workspace.pipeline)
+    assert [column[1] for column in columns] == [
+        f % OUTPUT_IMAGE
+        for f in (
+            correctspilloverapply.F_RESIDUAL_GAP,
+            correctspilloverapply.F_RELATIVE_RESIDUAL_GAP,
+            correctspilloverapply.F_MAX_RESIDUAL_GAP,
+        )
+    ]
+    assert module.get_measurement_images(
+        workspace.pipeline,
+        "Image",
+        correctspilloverapply.C_SPILLOVER,
+        "ResidualGap",
+    ) == [OUTPUT_IMAGE]
+    module.run(workspace)
+    for column in columns:
+        value = workspace.measurements.get_current_image_measurement(column[1])
+        assert 0 <= value < 1e-6
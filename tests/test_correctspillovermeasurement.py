@@ -28,6 +28,7 @@ COMP_SUFFIX = "Comp"
 N_CHANNEL = 2
 
 
+import plugins.correctspilloverapply as correctspilloverapply
 import plugins.correctspillovermeasurements as correctspillovermeasurements
 import plugins.measureobjectintensitymultichannel as moimc
 
@@ -118,6 +119,7 @@ def workspace(image, sm_image, objects, measurements, module, meas_module):
     params=[
         correctspillovermeasurements.METHOD_LS,
         correctspillovermeasurements.METHOD_NNLS,
+        correctspillovermeasurements.METHOD_APPROXIMATE_NNLS,
     ]
 )
 def method(request):
@@ -164,7 +166,7 @@ def testcase(request, method):
             [0.0, 0.0],
             [0.0, 0.0],
         ]
-        if method == correctspillovermeasurements.METHOD_NNLS:
+        if method != correctspillovermeasurements.METHOD_LS:
             expected[0][1] = 0
             expected[0][0] = 0.990099
 
@@ -220,3 +222,52 @@ def test_compensation(testcase, sm_image, module, workspace):
     ]
     expected = testcase.expected
     np.testing.assert_almost_equal(results, list(zip(*expected)))
+
+
+def test_residual_gap(sm_image, module, workspace):
+    rng = np.random.default_rng(0)
+    data = rng.poisson(1.0, (50, 2)).astype(float)
+    m = workspace.measurements
+    for i in range(2):
+        m.add_measurement(OBJECT_NAME, f"{MEASUREMENT_NAME}_c{i+1}", data[:, i])
+    sm_image.pixel_data = np.asarray([[1, 0.1], [0.05, 1]])
+    cpm = module.compmeasurements[0]
+    cpm.spill_correct_method.value = correctspillovermeasurements.METHOD_APPROXIMATE_NNLS
+    module.run(workspace)
+    gap_name = f"{OBJECT_NAME}_{TEST_CATEGORY}_{TEST_MEASUREMENT}{COMP_SUFFIX}_{TEST_IMAGE}"
+    columns = [
+        c for c in module.get_measurement_columns(workspace.pipeline) if c[0] == "Image"
+    ]
+    assert [c[1] for c in columns] == [
+        f % gap_name
+        for f in (
+            correctspillovermeasurements.F_RESIDUAL_GAP,
+            correctspillovermeasurements.F_RELATIVE_RESIDUAL_GAP,
+            correctspillovermeasurements.F_MAX_RESIDUAL_GAP,
+        )
+    ]
+    for c in columns:
+        assert 0 <= m.get_current_image_measurement(c[1]) < 1e-6
+    # Clipped least squares solutions fit worse than the exact solution
+    clipped = np.maximum(data @ np.linalg.inv(sm_image.pixel_data), 0)
+    gaps, residuals = correctspillovermeasurements.residual_gaps(
+        data, clipped, sm_image.pixel_data
+    )
+    assert gaps.sum() > 1e-6
+
+
+def test_approximate_nnls_matches_apply(module):
+    """Measurements and images are compensated by the same approximation"""
+    rng = np.random.default_rng(0)
+    data = rng.poisson(1.0, (500, 4)).astype(float)
+    data[:10] = np.nan
+    sm = np.eye(4) + rng.random((4, 4)) * 0.2
+    method = correctspillovermeasurements.METHOD_APPROXIMATE_NNLS
+    compdat = module.compensate_dat(data, sm, method)
+    assert np.all(np.isnan(compdat[:10]))
+    expected = correctspilloverapply.compensate_dat(data[10:], sm, method)
+    np.testing.assert_array_equal(compdat[10:], expected)
+    np.testing.assert_array_equal(
+        correctspillovermeasurements.residual_gaps(data[10:], compdat[10:], sm),
+        correctspilloverapply.residual_gaps(data[10:], expected, sm),
+    )
@@ -8,6 +8,7 @@ import cellprofiler_core.measurement
 import cellprofiler_core.modules.injectimage
 import cellprofiler_core.object
 import cellprofiler_core.pipeline
+import cellprofiler_core.preferences
 import cellprofiler_core.workspace
 from cellprofiler_core.constants.measurement import COLTYPE_FLOAT, COLTYPE_INTEGER
 from cellprofiler_core.utilities.core import modules as cpmodules
@@ -452,3 +453,351 @@ def test_get_measurement_columns_object_mode(module):
                     for column in columns
                 ]
             )
+
+
+def test_channel_numbers(image, measurements, module, workspace):
+    """Only the selected channels are measured and keep their number"""
+    image.pixel_data = numpy.random.uniform(size=(10, 10, N_CHANNELS))
+
+    module.channel_choice.value = mimc.CHANNELS_NUMBERS
+
+    module.channel_numbers.value = "2-3"
+
+    module.run(workspace)
+
+    features = measurements.get_feature_names("Image")
+
+    columns = module.get_measurement_columns(workspace.pipeline)
+
+    assert len(columns) == len(features)
+
+    for column in columns:
+        assert column[1] in features
+
+        assert column[1].endswith("_c2") or column[1].endswith("_c3")
+
+    numpy.testing.assert_almost_equal(
+        measurements.get_current_measurement(
+            "Image", "Intensity_TotalIntensity_image_c3"
+        ),
+        numpy.sum(image.pixel_data[:, :, 2]),
+    )
+
+
+def test_channel_names(tmpdir, module):
+    """Channels are selected by their name in the annotation file"""
+    annotation = tmpdir.join("channels.txt")
+
+    annotation.write("Ir191\nIr193\nHH3\nCD45\n")
+
+    module.channel_choice.value = mimc.CHANNELS_NAMES
+
+    module.channel_names.value = "CD45, Ir191"
+
+    module.annotation_location.value = module.annotation_location.static_join_string(
+        cellprofiler_core.preferences.ABSOLUTE_FOLDER_NAME, str(tmpdir)
+    )
+
+    module.annotation_filename.value = "channels.txt"
+
+    assert module.get_channels() == [0, 3]
+
+
+def test_channel_names_missing_annotation(tmpdir, module):
+    """The columns of all channels are listed without the annotation file"""
+    module.nchannels.value = 4
+
+    module.channel_choice.value = mimc.CHANNELS_NAMES
+
+    module.channel_names.value = "CD45, Ir191"
+
+    module.annotation_location.value = module.annotation_location.static_join_string(
+        cellprofiler_core.preferences.ABSOLUTE_FOLDER_NAME, str(tmpdir)
+    )
+
+    module.annotation_filename.value = "missing.txt"
+
+    columns = module.get_measurement_columns(None)
+
+    for c in range(4):
+        assert any(column[1].endswith(f"_c{c + 1}") for column in columns)
+
+
+def test_parse_channel_numbers():
+    assert mimc.parse_channel_numbers("1-3, 5,7-7") == [1, 2, 3, 5, 7]
+
+
+def test_measure_intensities_float32():
+    """The statistics of single precision pixels are double precision"""
+    numpy.random.seed(0)
+
+    values = numpy.random.uniform(size=(3, 100)).astype(numpy.float32)
+
+    statistics = mimc.measure_intensities(values.copy())
+
+    for feature in mimc.ALL_MEASUREMENTS:
+        if feature != "TotalArea":
+            assert statistics[feature].dtype == numpy.float64
+
+    for c in range(3):
+        assert statistics["MeanIntensity"][c] == numpy.sum(values[c]) / 100.0
+
+
+def test_select_order_statistics():
+    pixels = numpy.random.poisson(0.2, size=1001) * numpy.random.uniform(size=1001)
+
+    sorted_pixels = numpy.sort(pixels)
+
+    ranks = [0, 250, 500, 501, 750, 1000]
+
+    for non_negative in (True, False):
+        selected = mimc.select_order_statistics(pixels.copy(), ranks, non_negative)
+
+        for k in ranks:
+            assert selected[k] == sorted_pixels[k]
+
+
+def test_measure_intensities():
+    numpy.random.seed(0)
+
+    values = numpy.random.normal(size=(3, 100))
+
+    values[1] = numpy.random.poisson(0.5, size=100)
+
+    values[2, :10] = numpy.nan
+
+    statistics = mimc.measure_intensities(values.copy())
+
+    for c in range(3):
+        pixels = values[c][numpy.isfinite(values[c])]
+
+        sorted_pixels = numpy.sort(pixels)
+
+        median = numpy.median(pixels)
+
+        assert statistics["TotalArea"][c] == len(pixels)
+
+        assert statistics["TotalIntensity"][c] == numpy.sum(pixels)
+
+        assert statistics["StdIntensity"][c] == numpy.std(pixels)
+
+        assert statistics["MedianIntensity"][c] == median
+
+        assert statistics["MADIntensity"][c] == numpy.median(numpy.abs(pixels - median))
+
+        assert (
+            statistics["LowerQuartileIntensity"][c]
+            == sorted_pixels[int(len(pixels) * 0.25)]
+        )
+
+        assert (
+            statistics["UpperQuartileIntensity"][c]
+            == sorted_pixels[int(len(pixels) * 0.75)]
+        )
+
+
+def test_gather_channels():
+    numpy.random.seed(0)
+
+    pixels = numpy.random.uniform(size=(10, 20, N_CHANNELS))
+
+    mask = numpy.random.uniform(size=(10, 20)) < 0.5
+
+    values = mimc.gather_channels(
+        pixels, numpy.flatnonzero(mask), [0, 2], block_size=7
+    )
+
+    assert values.flags.c_contiguous
+
+    numpy.testing.assert_array_equal(values[0], pixels[:, :, 0][mask])
+
+    numpy.testing.assert_array_equal(values[1], pixels[:, :, 2][mask])
+
+    values = mimc.gather_channels(pixels)
+
+    for c in range(N_CHANNELS):
+        numpy.testing.assert_array_equal(values[c], pixels[:, :, c].flatten())
+
+
+def test_count_histograms():
+    numpy.random.seed(0)
+
+    counts = numpy.random.poisson(3, size=(2, 1000))
+
+    values = counts.astype(numpy.float32) / numpy.float32(65535)
+
+    histograms, bin_values = mimc.count_histograms(values, 65535)
+
+    for c in range(2):
+        numpy.testing.assert_array_equal(
+            histograms[c], numpy.bincount(counts[c], minlength=len(bin_values))
+        )
+
+    numpy.testing.assert_array_equal(bin_values[counts], values)
+
+    assert mimc.count_histograms(values + 0.5, 65535) is None
+
+    assert mimc.count_histograms(values - 1, 65535) is None
+
+
+def test_measure_intensities_counts():
+    numpy.random.seed(0)
+
+    values = numpy.random.poisson(3, size=(3, 1001)).astype(numpy.float32) / 255
+
+    expected = mimc.measure_intensities(values.copy())
+
+    statistics = mimc.measure_intensities(values.copy(), scale=255)
+
+    for feature in mimc.ALL_MEASUREMENTS:
+        numpy.testing.assert_array_equal(statistics[feature], expected[feature])
+
+
+def nearest_percentile(pixels, percentile):
+    sorted_pixels = numpy.sort(pixels)
+
+    return sorted_pixels[int(numpy.around((len(pixels) - 1) * percentile))]
+
+
+def test_intensity_summary_counts():
+    numpy.random.seed(0)
+
+    images = [
+        numpy.random.poisson(rate, size=1000).astype(numpy.float32) / 65535
+        for rate in (0.5, 3, 20)
+    ]
+
+    summaries = [
+        mimc.IntensitySummary.from_json(
+            mimc.IntensitySummary.from_pixels(pixels, 65535).to_json()
+        )
+        for pixels in images
+    ]
+
+    assert all(summary.accuracy == 0 for summary in summaries)
+
+    summary = summaries[0].merge(*summaries[1:])
+
+    pixels = numpy.concatenate(images)
+
+    assert summary.count == len(pixels)
+
+    for percentile in (0.001, 0.25, 0.5, 0.99, 0.999):
+        assert summary.quantile(percentile) == nearest_percentile(pixels, percentile)
+
+
+def test_intensity_summary_sketch():
+    numpy.random.seed(0)
+
+    images = [
+        numpy.random.normal(size=1000) * 10 ** numpy.random.uniform(-3, 3, size=1000)
+        for _ in range(3)
+    ]
+
+    images[0][:100] = 0
+
+    images[1][:10] = numpy.nan
+
+    summaries = [
+        mimc.IntensitySummary.from_pixels(pixels, 65535, 0.02) for pixels in images
+    ]
+
+    summary = summaries[0].merge(*summaries[1:])
+
+    assert summary.accuracy == 0.02
+
+    pixels = numpy.concatenate(images)
+
+    pixels = pixels[numpy.isfinite(pixels)]
+
+    for percentile in numpy.linspace(0, 1, 101):
+        expected = nearest_percentile(pixels, percentile)
+
+        assert abs(summary.quantile(percentile) - expected) <= 0.02 * abs(
+            expected
+        ) * (1 + 1e-9)
+
+    assert numpy.isnan(mimc.IntensitySummary().quantile(0.5))
+
+
+def test_summary_post_run(image, measurements, module, workspace):
+    """The summaries of the image sets are merged into experiment measurements"""
+    numpy.random.seed(0)
+
+    module.wants_summary.value = True
+
+    module.summary_percentiles.value = "0.5, 0.99"
+
+    images = []
+
+    for image_number in (1, 2):
+        if image_number > 1:
+            measurements.next_image_set(image_number)
+
+        image.pixel_data = numpy.random.poisson(3, size=(10, 10, N_CHANNELS)) * 1.0
+
+        images.append(image.pixel_data.reshape(-1, N_CHANNELS))
+
+        module.run(workspace)
+
+    module.post_run(workspace)
+
+    pixels = numpy.concatenate(images)
+
+    for c in range(N_CHANNELS):
+        assert measurements.get_experiment_measurement(
+            f"Intensity_PercentileIntensity_image_99_c{c+1}"
+        ) == nearest_percentile(pixels[:, c], 0.99)
+
+    features = measurements.get_feature_names("Image") + [
+        (feature, "Experiment")
+        for feature in measurements.get_feature_names("Experiment")
+    ]
+
+    for column in module.get_measurement_columns(workspace.pipeline):
+        if column[0] == "Experiment":
+            assert (column[1], "Experiment") in features
+        else:
+            assert column[1] in features
+
+
+def test_parse_percentiles():
+    assert mimc.parse_percentiles("0.5, 0.99,0.999") == [0.5, 0.99, 0.999]
+
+    with pytest.raises(ValueError):
+        mimc.parse_percentiles("0.5, 99")
+
+    assert mimc.get_percentile_name("image", 0.999, 0) == "image_999_c1"
+
+
+def test_get_measurements_summary(module):
+    assert "PercentileIntensity" not in module.get_measurements(
+        None, "Experiment", "Intensity"
+    )
+
+    module.wants_summary.value = True
+
+    module.summary_percentiles.value = "0.5, 0.99"
+
+    assert module.get_categories(None, "Experiment") == ["Intensity"]
+
+    assert module.get_measurements(None, "Image", "Intensity") == (
+        mimc.ALL_MEASUREMENTS + ["Summary"]
+    )
+
+    assert module.get_measurements(None, "Experiment", "Intensity") == [
+        "Summary",
+        "PercentileIntensity",
+    ]
+
+    assert module.get_measurement_images(
+        None, "Experiment", "Intensity", "PercentileIntensity"
+    ) == ["image_5", "image_99"]
+
+    assert module.get_measurement_images(
+        None, "Experiment", "Intensity", "Summary"
+    ) == ["image"]
+
+    module.summary_percentiles.value = ""
+
+    assert module.get_measurements(None, "Experiment", "Intensity") == ["Summary"]
@@ -1,9 +1,11 @@
+import gc
 import math
 
 import centrosome.outline
 import numpy
 import numpy.testing
 import pytest
+import scipy.ndimage
 import skimage.measure
 import skimage.segmentation
 
@@ -804,3 +806,580 @@ def test_median_intensity_masked(image, measurements, module, objects, workspace
         assert len(values) == 1
 
         assert exp == values[0]
+
+
+def test_channels_measured_together(image, measurements, module, objects, workspace):
+    """Channels of a stack are measured like the individual planes"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    labels[12:15, 20:28] = 3
+
+    numpy.random.seed(0)
+
+    plane = numpy.random.uniform(size=labels.shape)
+
+    image.pixel_data = numpy.dstack([plane * (c + 1) for c in range(N_CHANNELS)])
+
+    objects.segmented = labels
+
+    module.nchannels.value = N_CHANNELS
+
+    module.run(workspace)
+
+    def get(category, feature, c):
+        return measurements.get_current_measurement(
+            OBJECT_NAME, "_".join((category, feature, IMAGE_NAME, f"c{c+1}"))
+        )
+
+    for c in range(N_CHANNELS):
+        for feature in (
+            momc.INTEGRATED_INTENSITY,
+            momc.MEAN_INTENSITY,
+            momc.STD_INTENSITY,
+            momc.MIN_INTENSITY,
+            momc.MAX_INTENSITY,
+            momc.MEAN_INTENSITY_EDGE,
+            momc.LOWER_QUARTILE_INTENSITY,
+            momc.MEDIAN_INTENSITY,
+            momc.MAD_INTENSITY,
+            momc.UPPER_QUARTILE_INTENSITY,
+        ):
+            # The image is float32
+            numpy.testing.assert_allclose(
+                get(momc.INTENSITY, feature, c),
+                get(momc.INTENSITY, feature, 0) * (c + 1),
+                rtol=1e-6,
+            )
+
+        for feature in momc.ALL_LOCATION_MEASUREMENTS:
+            numpy.testing.assert_allclose(
+                get(C_LOCATION, feature, c), get(C_LOCATION, feature, 0), rtol=1e-6
+            )
+
+
+def test_label_incidence_matrix():
+    """The incidence matrix sums the pixels of each object"""
+    counts = numpy.array([2, 0, 3])
+
+    values = numpy.arange(10, dtype=float).reshape(5, 2)
+
+    incidence = momc.label_incidence_matrix(counts)
+
+    assert incidence.shape == (3, 5)
+
+    numpy.testing.assert_array_equal(
+        incidence @ values, [[2, 4], [0, 0], [18, 21]]
+    )
+
+
+def test_label_index_cache(objects):
+    """The label index is shared by images of the same image set"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    objects.segmented = labels
+
+    pixels = numpy.zeros((1, 20, 30, N_CHANNELS))
+
+    cache = momc.LabelIndexCache()
+
+    label_indices = cache.get(1, OBJECT_NAME, objects, pixels, None, 2)
+
+    assert cache.get(1, OBJECT_NAME, objects, pixels, None, 2) is label_indices
+
+    numpy.testing.assert_array_equal(label_indices[0].counts, [54, 32])
+
+    mask = numpy.ones((1, 20, 30), bool)
+
+    mask[:, :, :5] = False
+
+    masked_indices = cache.get(1, OBJECT_NAME, objects, pixels, mask, 2)
+
+    assert masked_indices is not label_indices
+
+    numpy.testing.assert_array_equal(masked_indices[0].counts, [42, 32])
+
+    assert cache.get(2, OBJECT_NAME, objects, pixels, None, 2) is not label_indices
+
+
+def test_label_index_cache_weak():
+    """The label indices are freed with their object set"""
+    objects = cellprofiler_core.object.Objects()
+
+    objects.segmented = numpy.ones((20, 30), int)
+
+    cache = momc.LabelIndexCache()
+
+    cache.get(1, OBJECT_NAME, objects, numpy.zeros((1, 20, 30, 2)), None, 2)
+
+    assert len(cache.entries) == 1
+
+    del objects
+
+    gc.collect()
+
+    assert len(cache.entries) == 0
+
+
+def test_feature_subset(image, measurements, module, objects, workspace):
+    """Only the selected feature groups are measured"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    numpy.random.seed(0)
+
+    image.pixel_data = numpy.random.uniform(size=(20, 30, N_CHANNELS))
+
+    objects.segmented = labels
+
+    module.nchannels.value = N_CHANNELS
+
+    module.wants_intensity.value = False
+
+    module.wants_edge.value = False
+
+    module.wants_mass_displacement.value = False
+
+    module.wants_location.value = False
+
+    assert module.get_categories(None, OBJECT_NAME) == [momc.INTENSITY]
+
+    assert module.get_measurements(None, OBJECT_NAME, momc.INTENSITY) == (
+        momc.QUANTILE_MEASUREMENTS
+    )
+
+    assert module.get_measurements(None, OBJECT_NAME, C_LOCATION) == []
+
+    module.run(workspace)
+
+    assert_features_and_columns_match(measurements, module)
+
+    assert len(module.get_measurement_columns(None)) == N_CHANNELS * len(
+        momc.QUANTILE_MEASUREMENTS
+    )
+
+
+def test_channel_numbers(image, measurements, module, objects, workspace):
+    """Only the selected channels are measured and keep their number"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    numpy.random.seed(0)
+
+    image.pixel_data = numpy.random.uniform(size=(20, 30, N_CHANNELS))
+
+    objects.segmented = labels
+
+    module.nchannels.value = N_CHANNELS
+
+    module.channel_choice.value = momc.CHANNELS_NUMBERS
+
+    module.channel_numbers.value = "2, 4"
+
+    module.run(workspace)
+
+    assert_features_and_columns_match(measurements, module)
+
+    for column in module.get_measurement_columns(None):
+        assert column[1].endswith("_c2") or column[1].endswith("_c4")
+
+    # The image is float32
+    numpy.testing.assert_allclose(
+        measurements.get_current_measurement(
+            OBJECT_NAME, f"Intensity_IntegratedIntensity_{IMAGE_NAME}_c4"
+        ),
+        [numpy.sum(image.pixel_data[labels == i, 3]) for i in (1, 2)],
+        rtol=1e-6,
+    )
+
+
+def test_measure_channel_blocks():
+    """The measurements do not depend on the number of worker threads"""
+    labels = numpy.zeros((1, 20, 30), int)
+
+    labels[0, 2:8, 3:12] = 1
+
+    labels[0, 10:18, 5:9] = 2
+
+    numpy.random.seed(0)
+
+    pixels = numpy.random.uniform(size=(1, 20, 30, 5))
+
+    label_index = momc.LabelIndex(labels, numpy.array([1, 2]))
+
+    pairs = [(0, 1), (0, 2), (3, 4)]
+
+    expected = momc.measure_object_intensities(pixels, label_index, 2)
+
+    expected.update(momc.measure_object_correlations(pixels, label_index, pairs))
+
+    for workers in (1, 2, 3, 8):
+        result = momc.measure_channel_blocks(
+            pixels, label_index, 2, workers=workers, pairs=pairs
+        )
+
+        assert set(result) == set(expected)
+
+        for feature_name, value in expected.items():
+            numpy.testing.assert_array_equal(result[feature_name], value)
+
+
+def test_measure_object_tiles():
+    """Measuring in tiles gives the same measurements as the whole image"""
+    numpy.random.seed(0)
+
+    labels = skimage.measure.label(numpy.random.uniform(size=(60, 70)) > 0.45)
+
+    labels = labels.reshape(1, *labels.shape)
+
+    pixels = numpy.random.uniform(size=(1, 60, 70, 3))
+
+    mask = numpy.random.uniform(size=(1, 60, 70)) > 0.2
+
+    lindexes = numpy.arange(1, labels.max() + 1)
+
+    expected = momc.measure_object_intensities(
+        pixels, momc.LabelIndex(labels, lindexes, mask), 2
+    )
+
+    for tile_size in (16, 25, 100):
+        result = momc.measure_object_tiles(
+            pixels, labels, lindexes, mask, 2, tile_size
+        )
+
+        for feature_name, value in expected.items():
+            numpy.testing.assert_array_equal(result[feature_name], value)
+
+
+def test_measure_object_tiles_channels():
+    """The channels are selected and converted tile by tile"""
+    numpy.random.seed(0)
+
+    labels = skimage.measure.label(numpy.random.uniform(size=(1, 60, 70)) > 0.45)
+
+    pixels = numpy.random.uniform(size=(1, 60, 70, 4))
+
+    lindexes = numpy.arange(1, labels.max() + 1)
+
+    channels = [1, 3]
+
+    selected = pixels[..., channels].astype(numpy.float32)
+
+    expected = momc.measure_object_intensities(
+        selected, momc.LabelIndex(labels, lindexes), 2
+    )
+
+    expected.update(
+        momc.measure_object_correlations(
+            selected, momc.LabelIndex(labels, lindexes), [(0, 1)]
+        )
+    )
+
+    result = momc.measure_object_tiles(
+        pixels,
+        labels,
+        lindexes,
+        None,
+        2,
+        25,
+        pairs=[(0, 1)],
+        channels=channels,
+        dtype=numpy.float32,
+    )
+
+    for feature_name, value in expected.items():
+        numpy.testing.assert_array_equal(result[feature_name], value)
+
+
+def test_object_moments():
+    """The one pass moments are stable"""
+    numpy.random.seed(0)
+
+    counts = numpy.array([5, 1, 200])
+
+    values = 1e9 + numpy.random.uniform(size=(counts.sum(), 2))
+
+    segments = numpy.split(values, numpy.cumsum(counts)[:-1])
+
+    expected = numpy.array([segment.std(axis=0) for segment in segments])
+
+    moments = momc.ObjectMoments.from_segments(
+        values, counts, momc.label_incidence_matrix(counts)
+    )
+
+    numpy.testing.assert_allclose(moments.std, expected, atol=1e-9)
+
+
+def test_segment_quantiles_zero_inflated():
+    """Mostly zero channels give the same quantiles without sorting zeros"""
+    numpy.random.seed(0)
+
+    labels = skimage.measure.label(numpy.random.uniform(size=(1, 40, 50)) > 0.4)
+
+    label_index = momc.LabelIndex(labels, numpy.arange(1, labels.max() + 1))
+
+    values = numpy.random.poisson(0.3, size=(label_index.npixels, 3)).astype(float)
+
+    values[:, 0] = 0
+
+    sorted_values = momc._sort_segments(values, label_index.layout)
+
+    fractions = (0.25, 0.5, 0.75)
+
+    quantiles = momc._segment_quantiles(values, label_index, fractions)
+
+    for quantile, fraction in zip(quantiles, fractions):
+        numpy.testing.assert_array_equal(
+            quantile,
+            momc._segment_quantile(sorted_values, label_index.counts, fraction),
+        )
+
+
+def test_correlation(image, measurements, module, objects, workspace):
+    """The channel pairs are correlated within each object"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    numpy.random.seed(0)
+
+    image.pixel_data = numpy.random.uniform(size=(20, 30, N_CHANNELS))
+
+    image.pixel_data[:, :, 2] = 0.5
+
+    objects.segmented = labels
+
+    module.nchannels.value = N_CHANNELS
+
+    module.wants_correlation.value = True
+
+    module.correlation_pairs.value = "1:2, 1:3, 2:4"
+
+    module.run(workspace)
+
+    assert_features_and_columns_match(measurements, module)
+
+    for first, second in ((1, 2), (2, 4)):
+        expected = [
+            numpy.corrcoef(image.pixel_data[labels == i][:, [first - 1, second - 1]].T)[
+                0, 1
+            ]
+            for i in (1, 2)
+        ]
+
+        numpy.testing.assert_almost_equal(
+            measurements.get_current_measurement(
+                OBJECT_NAME,
+                f"Correlation_Correlation_{IMAGE_NAME}_c{first}_c{second}",
+            ),
+            expected,
+        )
+
+    # A constant channel has no correlation
+    assert numpy.all(
+        numpy.isnan(
+            measurements.get_current_measurement(
+                OBJECT_NAME, f"Correlation_Correlation_{IMAGE_NAME}_c1_c3"
+            )
+        )
+    )
+
+    numpy.testing.assert_array_equal(
+        measurements.get_current_measurement(
+            OBJECT_NAME, f"Correlation_Covariance_{IMAGE_NAME}_c1_c3"
+        ),
+        0,
+    )
+
+
+def test_measure_object_correlations():
+    """The covariance and correlation match NumPy for all channel pairs"""
+    numpy.random.seed(0)
+
+    labels = skimage.measure.label(numpy.random.uniform(size=(1, 40, 50)) > 0.4)
+
+    lindexes = numpy.arange(1, labels.max() + 2)
+
+    pixels = numpy.random.uniform(size=(1, 40, 50, 3))
+
+    label_index = momc.LabelIndex(labels, lindexes)
+
+    pairs = [(0, 1), (0, 2), (1, 2), (2, 2)]
+
+    result = momc.measure_object_correlations(pixels, label_index, pairs)
+
+    for position, lindex in enumerate(lindexes):
+        values = pixels[labels == lindex]
+
+        for index, (first, second) in enumerate(pairs):
+            if len(values) == 0:
+                assert numpy.isnan(result[momc.COVARIANCE][position, index])
+
+                continue
+
+            covariance = numpy.cov(values[:, first], values[:, second], bias=True)
+
+            numpy.testing.assert_almost_equal(
+                result[momc.COVARIANCE][position, index], covariance[0, 1]
+            )
+
+            if len(values) > 1:
+                numpy.testing.assert_almost_equal(
+                    result[momc.CORRELATION][position, index],
+                    covariance[0, 1] / numpy.sqrt(covariance[0, 0] * covariance[1, 1]),
+                )
+
+
+def test_rings(image, measurements, module, objects, workspace):
+    """The rings are measured inside and outside along the object edges"""
+    labels = numpy.zeros((20, 30), int)
+
+    labels[2:8, 3:12] = 1
+
+    labels[10:18, 5:9] = 2
+
+    numpy.random.seed(0)
+
+    image.pixel_data = numpy.random.uniform(size=(20, 30, N_CHANNELS))
+
+    objects.segmented = labels
+
+    module.nchannels.value = N_CHANNELS
+
+    module.wants_rings.value = True
+
+    module.ring_width.value = 1
+
+    module.run(workspace)
+
+    assert_features_and_columns_match(measurements, module)
+
+    assert module.get_measurement_scales(
+        None, OBJECT_NAME, momc.INTENSITY, momc.MEAN_INTENSITY_INNER_RING, IMAGE_NAME
+    ) == ["1"]
+
+    for channel in range(N_CHANNELS):
+        numpy.testing.assert_almost_equal(
+            measurements.get_current_measurement(
+                OBJECT_NAME,
+                f"Intensity_IntegratedIntensityInnerRing_{IMAGE_NAME}_1_c{channel + 1}",
+            ),
+            measurements.get_current_measurement(
+                OBJECT_NAME,
+                f"Intensity_IntegratedIntensityEdge_{IMAGE_NAME}_c{channel + 1}",
+            ),
+        )
+
+        # The image is float32
+        numpy.testing.assert_allclose(
+            measurements.get_current_measurement(
+                OBJECT_NAME,
+                f"Intensity_IntegratedIntensityOuterRing_{IMAGE_NAME}_1_c{channel + 1}",
+            ),
+            [
+                numpy.sum(
+                    image.pixel_data[
+                        scipy.ndimage.binary_dilation(labels == i) & (labels == 0),
+                        channel,
+                    ]
+                )
+                for i in (1, 2)
+            ],
+            rtol=1e-6,
+        )
+
+
+def test_measure_object_tiles_rings():
+    """The rings measured in tiles are the same as in the whole image"""
+    numpy.random.seed(0)
+
+    labels = skimage.measure.label(numpy.random.uniform(size=(1, 60, 70)) > 0.5)
+
+    pixels = numpy.random.uniform(size=(1, 60, 70, 2))
+
+    lindexes = numpy.arange(1, labels.max() + 1)
+
+    expected = momc.measure_object_intensities(
+        pixels,
+        momc.LabelIndex(labels, lindexes, ring_width=2),
+        2,
+        momc.RING_MEASUREMENTS,
+    )
+
+    for tile_size in (16, 25):
+        result = momc.measure_object_tiles(
+            pixels,
+            labels,
+            lindexes,
+            None,
+            2,
+            tile_size,
+            momc.RING_MEASUREMENTS,
+            ring_width=2,
+        )
+
+        for feature_name, value in expected.items():
+            numpy.testing.assert_array_equal(result[feature_name], value)
+
+
+def test_pixel_gather():
+    """The pixels of nested object sets are gathered once for all of them"""
+    numpy.random.seed(0)
+
+    cells = skimage.measure.label(numpy.random.uniform(size=(1, 40, 50)) > 0.4)
+
+    nuclei = cells * (numpy.random.uniform(size=cells.shape) > 0.5)
+
+    cytoplasm = cells * (nuclei == 0)
+
+    lindexes = numpy.arange(1, cells.max() + 1)
+
+    label_indices = [
+        momc.LabelIndex(labels, lindexes) for labels in (cells, nuclei, cytoplasm)
+    ]
+
+    for pixels in (
+        numpy.random.uniform(size=(1, 40, 50, 3)),
+        numpy.moveaxis(numpy.random.uniform(size=(3, 1, 40, 50)), 0, -1),
+    ):
+        pixel_gather = momc.PixelGather(pixels, label_indices)
+
+        for label_index in label_indices:
+            values = pixel_gather.get(label_index)
+
+            numpy.testing.assert_array_equal(
+                values, pixels[label_index.coordinates]
+            )
+
+            expected = momc.measure_object_intensities(pixels, label_index, 2)
+
+            result = momc.measure_object_intensities(
+                pixels, label_index, 2, values=values
+            )
+
+            for feature_name, value in expected.items():
+                numpy.testing.assert_array_equal(result[feature_name], value)
+
+            numpy.testing.assert_array_equal(
+                momc.measure_object_correlations(
+                    pixels, label_index, [(0, 1), (1, 2)], values
+                )[momc.CORRELATION],
+                momc.measure_object_correlations(pixels, label_index, [(0, 1), (1, 2)])[
+                    momc.CORRELATION
+                ],
+            )